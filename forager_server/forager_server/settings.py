@@ -187,3 +187,7 @@ EMBEDDING_CLUSTER_NODES = 35
 
 SVM_NUM_NEGS_MULTIPLIER = 7
 BGSPLIT_NUM_NEGS_MULTIPLIER = 10
+
+# Send the include/exclude-filtered item set along with knn/svm queries (so the index
+# server only scores those items) when it covers at most this fraction of the dataset
+QUERY_PREFILTER_MAX_FRACTION = 0.5
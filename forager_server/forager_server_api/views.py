@@ -1,7 +1,9 @@
+import base64
 from collections import defaultdict, namedtuple
 from dataclasses import dataclass
 import distutils.util
 import functools
+import io
 import itertools
 import json
 import math
@@ -24,6 +26,7 @@ from google.cloud import storage
 from rest_framework.decorators import api_view
 import requests
 from expiringdict import ExpiringDict
+import numpy as np
 
 from .models import (
     Dataset,
@@ -41,6 +44,19 @@ BUILTIN_MODES = ["POSITIVE", "NEGATIVE", "HARD_NEGATIVE", "UNSURE"]
 
 logger = logging.getLogger(__name__)
 
+
+# Arrays are exchanged with the index server as base64-encoded .npy files
+def numpy_to_base64(nda):
+    with io.BytesIO() as nda_buffer:
+        np.save(nda_buffer, nda, allow_pickle=False)
+        return base64.b64encode(nda_buffer.getvalue()).decode("ascii")
+
+
+def base64_to_numpy(nda_base64):
+    nda_bytes = base64.b64decode(nda_base64)
+    with io.BytesIO(nda_bytes) as nda_buffer:
+        return np.load(nda_buffer, allow_pickle=False)
+
 @api_view(["POST"])
 @csrf_exempt
 def start_cluster(request):
@@ -378,6 +394,31 @@ current_result_sets = ExpiringDict(
 )  # type: Dict[str, ResultSet]
 
 
+# Index server row index -> DatasetItem pk (or -1), used to decode columnar results
+pks_by_ind_cache = ExpiringDict(
+    max_age_seconds=30 * 60,
+    max_len=10,
+)  # type: Dict[str, np.ndarray]
+
+
+def get_pks_by_ind_v2(dataset, index_id) -> np.ndarray:
+    pks_by_ind = pks_by_ind_cache.get(index_id)
+    if pks_by_ind is None:
+        r = requests.post(
+            settings.EMBEDDING_SERVER_ADDRESS + "/get_identifiers_by_ind",
+            json={"index_id": index_id},
+        )
+        identifiers = r.json()["identifiers"]
+        pks_by_identifier = dict(
+            DatasetItem.objects.filter(dataset=dataset).values_list("identifier", "pk")
+        )
+        pks_by_ind = np.array(
+            [pks_by_identifier.get(id, -1) for id in identifiers], dtype=np.int64
+        )
+        pks_by_ind_cache[index_id] = pks_by_ind
+    return pks_by_ind
+
+
 def parse_tag_set_from_query_v2(s):
     if isinstance(s, list):
         parts = s
@@ -524,8 +565,36 @@ def filtered_images_v2(request, dataset, exclude_pks=None) -> List[PkType]:
     return result
 
 
-def process_image_query_results_v2(request, dataset, query_response):
-    filtered_pks = filtered_images_v2(request, dataset)
+def get_allowed_inds_v2(dataset, index_id, filtered_pks) -> Optional[str]:
+    # Narrow filters are applied inside the index server's search; broad ones aren't
+    # worth the request size, so their results are filtered here afterwards instead.
+    # The allowed images are sent as a base64-encoded .npy array of index row indices.
+    pks_by_ind = get_pks_by_ind_v2(dataset, index_id)
+    if len(filtered_pks) > settings.QUERY_PREFILTER_MAX_FRACTION * len(pks_by_ind):
+        return None
+    allowed_inds = np.flatnonzero(
+        np.isin(pks_by_ind, np.fromiter(filtered_pks, dtype=np.int64))
+    )
+    return numpy_to_base64(allowed_inds.astype("<i4"))
+
+
+def process_image_query_results_v2(
+    request, dataset, index_id, query_response, filtered_pks=None
+):
+    if filtered_pks is None:
+        filtered_pks = filtered_images_v2(request, dataset)
+
+    if query_response.get("format") == "columnar":
+        # Join on pks with array ops rather than building a dict per result
+        pks_by_ind = get_pks_by_ind_v2(dataset, index_id)
+        pks = pks_by_ind[base64_to_numpy(query_response["ids"])]
+        distances = base64_to_numpy(query_response["dists"])
+        is_filtered = np.isin(pks, np.fromiter(filtered_pks, dtype=np.int64))
+        return dict(
+            pks=pks[is_filtered].tolist(),
+            distances=distances[is_filtered].tolist(),
+        )
+
     # TODO(mihirg): Eliminate this database call by directly returning pks from backend
     dataset_items = DatasetItem.objects.filter(pk__in=filtered_pks)
     dataset_items_by_path = {di.path: di for di in dataset_items}
@@ -587,6 +656,18 @@ def get_results_v2(request, dataset_name):
     if clustering_model:
         params["model"] = clustering_model
 
+    # Have the index server cluster the next page while this one is displayed
+    next_pks = result_set.ranking[
+        offset_to_return + num_to_return : offset_to_return + 2 * num_to_return
+    ]
+    if len(next_pks) > 1:
+        next_identifiers_by_pk = dict(
+            DatasetItem.objects.filter(pk__in=next_pks).values_list("pk", "identifier")
+        )
+        params["prefetch_identifiers"] = [
+            next_identifiers_by_pk[pk] for pk in next_pks
+        ]  # preserve order
+
     r = requests.post(
         settings.EMBEDDING_SERVER_ADDRESS + "/perform_clustering",
         json=params,
@@ -655,6 +736,7 @@ def query_knn_v2(request, dataset_name):
     model = payload.get("model", "imagenet")
 
     dataset = get_object_or_404(Dataset, name=dataset_name)
+    filtered_pks = filtered_images_v2(request, dataset)
 
     query_knn_start = time.time()
     params = {
@@ -663,7 +745,11 @@ def query_knn_v2(request, dataset_name):
         "use_full_image": use_full_image,
         "use_dot_product": use_dot_product,
         "model": model,
+        "result_format": "columnar",
     }
+    allowed_inds = get_allowed_inds_v2(dataset, index_id, filtered_pks)
+    if allowed_inds is not None:
+        params["allowed_inds"] = allowed_inds
     r = requests.post(
         settings.EMBEDDING_SERVER_ADDRESS + "/query_knn_v2",
         json=params,
@@ -675,7 +761,9 @@ def query_knn_v2(request, dataset_name):
     results = process_image_query_results_v2(
         request,
         dataset,
+        index_id,
         response_data,
+        filtered_pks,
     )
     return JsonResponse(create_result_set_v2(results, "knn", model=model))
 
@@ -740,6 +828,10 @@ def train_svm_v2(request, dataset_name):
         "pos_identifiers": pos_dataset_item_internal_identifiers,
         "neg_identifiers": neg_dataset_item_internal_identifiers,
         "model": model,
+        # Successive rounds of training on the same tags warm-start from each other
+        "session_id": "\n".join(
+            [dataset_name, request.GET["pos_tags"], request.GET.get("neg_tags", "")]
+        ),
     }
     r = requests.post(
         settings.EMBEDDING_SERVER_ADDRESS + "/train_svm_v2",
@@ -759,6 +851,7 @@ def query_svm_v2(request, dataset_name):
     model = payload.get("model", "imagenet")
 
     dataset = get_object_or_404(Dataset, name=dataset_name)
+    filtered_pks = filtered_images_v2(request, dataset)
 
     params = {
         "index_id": index_id,
@@ -766,7 +859,11 @@ def query_svm_v2(request, dataset_name):
         "score_min": score_min,
         "score_max": score_max,
         "model": model,
+        "result_format": "columnar",
     }
+    allowed_inds = get_allowed_inds_v2(dataset, index_id, filtered_pks)
+    if allowed_inds is not None:
+        params["allowed_inds"] = allowed_inds
     r = requests.post(
         settings.EMBEDDING_SERVER_ADDRESS + "/query_svm_v2",
         json=params,
@@ -779,7 +876,9 @@ def query_svm_v2(request, dataset_name):
     results = process_image_query_results_v2(
         request,
         dataset,
+        index_id,
         response_data,
+        filtered_pks,
     )
     return JsonResponse(create_result_set_v2(results, "svm"))
 
@@ -800,6 +899,7 @@ def query_ranking_v2(request, dataset_name):
         "score_min": score_min,
         "score_max": score_max,
         "model": model,
+        "result_format": "columnar",
     }
     r = requests.post(
         settings.EMBEDDING_SERVER_ADDRESS + "/query_ranking_v2",
@@ -813,6 +913,7 @@ def query_ranking_v2(request, dataset_name):
     results = process_image_query_results_v2(
         request,
         dataset,
+        index_id,
         response_data,
     )
     return JsonResponse(create_result_set_v2(results, "ranking", model=model))
@@ -21,7 +21,7 @@ from knn.utils import JSONType
 from knn.jobs import MapReduceJob, MapperSpec
 from knn.reducers import Reducer
 
-from index_jobs import Trainer
+from index_jobs import LocalFlatIndex, Trainer
 
 import config
 
@@ -251,6 +251,12 @@ class BGSplitInferenceReducer(Reducer):
 
     def finish(self):
         self.embeddings.flush()
+        if config.LOCAL_INDEX_QUANTIZATION:
+            LocalFlatIndex.quantize(
+                self.embeddings,
+                self.collected_data_dir,
+                config.LOCAL_INDEX_QUANTIZATION,
+            )
         np.save(self.collected_data_dir / config.MODEL_SCORES_FILE_NAME, self.scores)
         if self.job_id:
             job_path = os.path.join(
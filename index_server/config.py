@@ -12,6 +12,16 @@ INSTANCE_IP = urlopen(ip_request).read().decode()
 # INSTANCE_IP = ""
 
 SANIC_RESPONSE_TIMEOUT = 10 * 60  # seconds
+# Queries, clustering, SVM training and AIS sampling run on this many threads off the
+# event loop; requests beyond CPU_EXECUTOR_MAX_QUEUED waiting ones get a 503
+CPU_EXECUTOR_NUM_THREADS = 8
+CPU_EXECUTOR_MAX_QUEUED = 64
+# With more than one worker process, requests that touch mutable state (clusters,
+# index building and loading, training jobs) are forwarded to a single coordinator
+# process listening locally on COORDINATOR_PORT. Queries are served by any worker;
+# workers share index data through the OS page cache since it's memory-mapped.
+SERVER_NUM_WORKERS = 1
+COORDINATOR_PORT = 5001
 
 CLOUD_RUN_N_MAPPERS = 50
 CLOUD_RUN_N_RETRIES = 1
@@ -28,8 +38,16 @@ MAPPER_REQUEST_TIMEOUT = (
     3 * 60
 )  # seconds; more than a minute per image is probably too much
 MAPPER_CLOUD_RUN_URL = "https://forager-index-mapper-g6rwrca4fq-uc.a.run.app"
+# Part of the embedding cache's keys; change it when the mapper's model, weights or
+# preprocessing change
+MAPPER_MODEL_VERSION = "resnet50-res5"
 
 LOCAL_INDEX_BUILDING_NUM_THREADS = 10
+LOCAL_INDEX_DISTANCE_MATRIX_DTYPE = "float32"  # or "float16" to halve its size
+# Quantized copies are only scanned by brute-force queries that set num_results, which
+# the frontend doesn't yet, so they aren't built by default
+LOCAL_INDEX_QUANTIZATION = None  # or "int8" or "float16"
+LOCAL_INDEX_MERGING_NUM_THREADS = 8  # per index type
 
 ADDER_NUM_RETRIES = 5
 ADDER_CHUNK_SIZE = lambda nproc: 1
@@ -98,6 +116,11 @@ MODEL_OUTPUTS_UPLOAD_GCS_PATH = (
 
 QUERY_PATCHES_PER_IMAGE = 8
 QUERY_NUM_RESULTS_MULTIPLE = 80
+# Adaptive spatial queries start at this multiple of num_results patch hits and grow
+# by this factor per round, up to QUERY_NUM_RESULTS_MULTIPLE
+ADAPTIVE_SPATIAL_QUERIES = False  # default when a request doesn't set "adaptive"
+ADAPTIVE_QUERY_INITIAL_RESULTS_MULTIPLE = 10
+ADAPTIVE_QUERY_GROWTH_FACTOR = 2
 
 UPLOADED_IMAGE_BUCKET = "foragerml"
 UPLOADED_IMAGE_DIR = "uploads/"
@@ -107,6 +130,24 @@ CLIP_TEXT_INFERENCE_CLOUD_RUN_URL = (
 )
 
 BRUTE_FORCE_QUERY_CHUNK_SIZE = 512
+# Concurrent unfiltered brute-force queries on the same index and model are batched
+BRUTE_FORCE_BATCH_MAX_SIZE = 16
+BRUTE_FORCE_BATCH_MAX_WAIT = 0.005  # seconds
+# Filtered brute-force queries normalize distances by their extremes over all rows,
+# which are cached for this many recent query vectors
+BRUTE_FORCE_DIST_EXTREMES_CACHE_SIZE = 1000
+CLUSTERING_CACHE_MAX_SIZE = 100_000  # total images across cached clusterings
+SVM_SESSION_CACHE_SIZE = 100  # SVMs kept to warm-start the next training round
+# Mapper-computed embeddings of query and SVM training images
+EMBEDDING_CACHE_DIR = Path("~/forager/embedding_cache").expanduser().resolve()
+EMBEDDING_CACHE_MAX_MEMORY = 1 * GIGABYTE
+EMBEDDING_CACHE_MAX_DISK = 20 * GIGABYTE
+# Requests for at least this many images use approximate clustering: PCA, then
+# mini-batch k-means into micro-clusters, then Ward linkage
+APPROX_CLUSTERING_MIN_SIZE = 2000
+APPROX_CLUSTERING_PCA_DIM = 64
+APPROX_CLUSTERING_NUM_CLUSTERS = 256
+APPROX_CLUSTERING_BATCH_SIZE = 1024
 DEFAULT_QUERY_MODEL = "imagenet"
 EMBEDDING_DIMS_BY_MODEL = {
     "imagenet": 2048,
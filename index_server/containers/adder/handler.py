@@ -19,7 +19,7 @@ class IndexBuildingMapper(Mapper):
             self.worker_id
         ).format("*")
 
-    async def initialize_job(self, job_args) -> InteractiveIndex:
+    async def initialize_job(self, job_args) -> JSONType:
         index_dicts = job_args["indexes"]
 
         job_args["indexes_by_reduction"] = defaultdict(dict)
@@ -31,7 +31,11 @@ class IndexBuildingMapper(Mapper):
             index.SHARD_INDEX_NAME_TMPL = config.SHARD_INDEX_NAME_TMPL.format(
                 self.worker_id
             )
-            job_args["indexes_by_reduction"][reduction][index_name] = index
+
+            # Keep this worker's current shard open in memory across chunks; it's
+            # written to disk when full and when the job is finalized
+            writer = index.writer(update_metadata=False)
+            job_args["indexes_by_reduction"][reduction][index_name] = writer
 
         return job_args
 
@@ -74,17 +78,22 @@ class IndexBuildingMapper(Mapper):
                 ]
 
             # Step 3: Add to applicable on-disk indexes
-            for index_name, index in indexes.items():
+            for index_name, writer in indexes.items():
                 with self.profiler(request_id, f"{index_name}_add_time_chunk"):
-                    index.add(
+                    writer.add(
                         all_embeddings,
                         all_image_ids,
                         ids_extra=all_spatial_ids,
-                        update_metadata=False,
                     )
 
         return True  # success
 
+    async def finalize_job(self, job_id, job_args):
+        # Write out the partially filled shard of each index
+        for indexes in job_args["indexes_by_reduction"].values():
+            for writer in indexes.values():
+                writer.close()
+
     async def process_element(self, *args, **kwargs):
         raise NotImplementedError()
 
@@ -4,6 +4,8 @@ import numpy as np
 
 GCS_URL_PREFIX = "https://storage.googleapis.com"
 DOWNLOAD_NUM_RETRIES = 3
+MAX_PREFETCHED_CHUNKS = 3  # chunks downloaded ahead of (or in) processing
+DECODE_NUM_THREADS = 4
 
 BATCH_SIZE = 128
 DATA_FILE_TMPL = "/shared/dnn_outputs/{}/{}/{}-{{}}.npy"
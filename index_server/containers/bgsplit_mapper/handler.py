@@ -1,6 +1,7 @@
 import numpy as np
 import aiohttp
 import asyncio
+import concurrent.futures
 import os.path
 from pathlib import Path
 import torch
@@ -8,6 +9,7 @@ import torch.nn.functional as F
 from torchvision import transforms, utils, io
 from typing import Dict, List, Optional, Tuple, Union, Any
 from enum import Enum
+import warnings
 
 from knn import utils
 from knn.mappers import Mapper
@@ -16,7 +18,16 @@ from knn.utils import JSONType
 import config
 from model import Model
 
+# transform_image wraps read-only bytes, which torch warns about; it runs on several
+# threads at once, so this can't be scoped with warnings.catch_warnings
+warnings.filterwarnings(
+    "ignore", message="The given buffer is not writable", category=UserWarning
+)
+
 class BGSplittingMapper(Mapper):
+    MAX_PREFETCHED_CHUNKS = config.MAX_PREFETCHED_CHUNKS
+    MAX_CONCURRENT_CHUNKS = 1
+
     class ReturnType(Enum):
         SAVE = 0
         SERIALIZE = 1
@@ -25,6 +36,13 @@ class BGSplittingMapper(Mapper):
         # Create connection pool
         self.session = aiohttp.ClientSession()
         self.use_cuda = False
+        # Inference runs on its own thread so that while one chunk is in the model,
+        # the next one is downloaded and decoded
+        self.inference_executor = concurrent.futures.ThreadPoolExecutor(1)
+
+    def register_executor(self):
+        # Decodes and transforms images
+        return concurrent.futures.ThreadPoolExecutor(config.DECODE_NUM_THREADS)
 
     async def initialize_job(self, job_args):
         return_type = job_args.get("return_type", "serialize")
@@ -73,9 +91,9 @@ class BGSplittingMapper(Mapper):
         return job_args
 
     @utils.log_exception_from_coro_but_return_none
-    async def process_chunk(
+    async def fetch_chunk(
         self, chunk: List[JSONType], job_id: str, job_args: Any, request_id: str
-    ) -> Tuple[np.ndarray, np.ndarray]:
+    ) -> List[torch.Tensor]:
         image_paths = [c["path"] for c in chunk]
 
         # Download images
@@ -87,19 +105,41 @@ class BGSplittingMapper(Mapper):
 
         transform = job_args["transform"]
         async def download_transform(image_path):
-            return await self.transform_image(
+            return await self.apply_in_executor(
+                self.transform_image,
                 await self.download_image(image_path),
-                transform=transform)
+                transform,
+                request_id=request_id,
+                profiler_name="decode_time")
         with self.profiler(request_id, "download_time"):
-            input_images = await asyncio.gather(
+            return await asyncio.gather(
                 *[
                     download_transform(image_path)
                     for image_path in image_paths
                 ])
 
+    @utils.log_exception_from_coro_but_return_none
+    async def process_chunk(
+        self,
+        input_images: List[torch.Tensor],
+        job_id: str,
+        job_args: Any,
+        request_id: str,
+    ) -> Tuple[np.ndarray, np.ndarray]:
         # Run inference
-        model = job_args["model"]
+        loop = asyncio.get_running_loop()
         with self.profiler(request_id, "inference_time"):
+            return await loop.run_in_executor(
+                self.inference_executor,
+                self.run_model,
+                job_args["model"],
+                input_images)
+
+    def run_model(
+            self, model, input_images: List[torch.Tensor],
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        # Grad mode is per thread, so disable it here
+        with torch.no_grad():
             image_batch = torch.stack(input_images)
             if self.use_cuda:
                 image_batch = image_batch.cuda()
@@ -124,12 +164,12 @@ class BGSplittingMapper(Mapper):
                     raise
         assert False  # unreachable
 
-    async def transform_image(
+    def transform_image(
             self, image_bytes: bytes, transform,
     ) -> torch.Tensor:
-        data = torch.tensor(
-            list(image_bytes),
-            dtype=torch.uint8)
+        # Wraps the bytes without copying them; they're read-only, but decoding never
+        # writes to its input
+        data = torch.frombuffer(image_bytes, dtype=torch.uint8)
         image = io.decode_image(data, mode=io.image.ImageReadMode.RGB)
         return transform(image)
 
@@ -8,6 +8,8 @@ RESNET_CONFIG.MODEL.RESNETS.OUT_FEATURES = ["res5"]
 
 GCS_URL_PREFIX = "https://storage.googleapis.com"
 DOWNLOAD_NUM_RETRIES = 3
+MAX_PREFETCHED_CHUNKS = 3  # chunks downloaded ahead of (or in) processing
+INFERENCE_BATCH_SIZE = 8  # images of the same size per forward pass
 
 EMBEDDINGS_FILE_TMPL = "/shared/embeddings/{}/{}/{}-{{}}.npy"
 REDUCTIONS = {
@@ -1,7 +1,12 @@
 import asyncio
+from collections import defaultdict
+import concurrent.futures
 from enum import Enum
 import os
 from pathlib import Path
+import textwrap
+import time
+import traceback
 
 import aiohttp
 import numpy as np
@@ -11,7 +16,7 @@ from detectron2.layers import ShapeSpec
 from detectron2.checkpoint.detection_checkpoint import DetectionCheckpointer
 from detectron2.modeling.backbone.resnet import build_resnet_backbone
 
-from typing import List, Optional, Tuple, Union
+from typing import DefaultDict, List, Optional, Tuple, Union
 
 from knn import utils
 from knn.mappers import Mapper
@@ -21,6 +26,9 @@ import inference
 
 
 class IndexEmbeddingMapper(Mapper):
+    MAX_PREFETCHED_CHUNKS = config.MAX_PREFETCHED_CHUNKS
+    MAX_CONCURRENT_CHUNKS = 1
+
     class ReturnType(Enum):
         SAVE = 0
         SERIALIZE = 1
@@ -49,6 +57,10 @@ class IndexEmbeddingMapper(Mapper):
         # Create connection pool
         self.session = aiohttp.ClientSession()
 
+    def register_executor(self):
+        # Runs inference, so the event loop can download the next chunk meanwhile
+        return concurrent.futures.ThreadPoolExecutor(1)
+
     async def initialize_job(self, job_args):
         return_type = job_args.get("return_type", "serialize")
         if return_type == "save":
@@ -61,10 +73,28 @@ class IndexEmbeddingMapper(Mapper):
         job_args["n_chunks_saved"] = 0
         return job_args
 
+    async def fetch_chunk(
+        self, chunk, job_id, job_args, request_id
+    ) -> List[Optional[torch.Tensor]]:
+        # Download and preprocess the images concurrently
+        return await super().process_chunk(chunk, job_id, job_args, request_id)
+
+    async def process_chunk(
+        self, images, job_id, job_args, request_id
+    ) -> List[Optional[np.ndarray]]:
+        # Embed them in batched forward passes
+        return await self.apply_in_executor(
+            self.embed,
+            images,
+            request_id,
+            request_id=request_id,
+            profiler_name="embed_time",
+        )
+
     @utils.log_exception_from_coro_but_return_none
     async def process_element(
         self, input, job_id, job_args, request_id, element_index
-    ) -> np.ndarray:
+    ) -> torch.Tensor:
         image_path = input["image"]
         image_patch = input.get("patch", (0, 0, 1, 1))
         augmentations = input.get("augmentations", {})
@@ -75,23 +105,69 @@ class IndexEmbeddingMapper(Mapper):
             image_path = os.path.join(config.GCS_URL_PREFIX, image_bucket, image_path)
         image_bytes = await self.download_image(image_path)
 
-        # Run inference
-        with self.profiler(request_id, "inference_time"):
-            model_output_dict = inference.run(
+        with self.profiler(request_id, "preprocess_time"):
+            return inference.preprocess(
                 image_bytes,
                 image_patch,
                 augmentations,
                 self.input_format,
                 self.pixel_mean,
                 self.pixel_std,
-                self.model,
             )
 
+    def embed(
+        self, images: List[Optional[torch.Tensor]], request_id: str
+    ) -> List[Optional[np.ndarray]]:
+        # Spatial embeddings (h * w x c) of each image (None if it failed). Only images
+        # of the same size can share a batch, since padding would change embeddings.
+        inds_by_shape: DefaultDict[torch.Size, List[int]] = defaultdict(list)
+        for i, image in enumerate(images):
+            if image is not None:
+                inds_by_shape[image.shape].append(i)
+
+        embeddings: List[Optional[np.ndarray]] = [None] * len(images)
+        batch_size = config.INFERENCE_BATCH_SIZE
+        start_time = time.perf_counter()
+        for inds in inds_by_shape.values():
+            for batch_start in range(0, len(inds), batch_size):
+                batch_inds = inds[batch_start : batch_start + batch_size]
+                self.embed_batch(images, batch_inds, embeddings, request_id)
+        elapsed_time = time.perf_counter() - start_time
+
+        n_embedded = sum(1 for e in embeddings if e is not None)
+        if n_embedded:
+            self.record(request_id, "images_per_sec", n_embedded / elapsed_time)
+        return embeddings
+
+    def embed_batch(
+        self,
+        images: List[Optional[torch.Tensor]],
+        batch_inds: List[int],
+        embeddings: List[Optional[np.ndarray]],
+        request_id: str,
+    ):
+        try:
+            with self.profiler(request_id, "inference_time"):
+                model_output_dict = inference.run_batch(
+                    [images[i] for i in batch_inds], self.model
+                )
+        except Exception:
+            print(f"Error from embed_batch ({len(batch_inds)} images)")
+            print(textwrap.indent(traceback.format_exc(), "  "))
+            if len(batch_inds) > 1:
+                # Retry individually so only the images that fail are lost
+                for i in batch_inds:
+                    self.embed_batch(images, [i], embeddings, request_id)
+            return
+
         with self.profiler(request_id, "flatten_time"):
             spatial_embeddings = next(iter(model_output_dict.values())).numpy()
             n, c, h, w = spatial_embeddings.shape
-            assert n == 1
-            return np.ascontiguousarray(spatial_embeddings.reshape((c, h * w)).T)
+            assert n == len(batch_inds)
+            for i, spatial_embedding in zip(batch_inds, spatial_embeddings):
+                embeddings[i] = np.ascontiguousarray(
+                    spatial_embedding.reshape((c, h * w)).T
+                )
 
     async def download_image(
         self, image_path: str, num_retries: int = config.DOWNLOAD_NUM_RETRIES
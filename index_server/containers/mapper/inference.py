@@ -52,6 +52,20 @@ def run(
     pixel_std: torch.Tensor,
     model: torch.nn.Module,
 ) -> Dict[str, torch.Tensor]:
+    image = preprocess(
+        image_bytes, image_patch, augmentations, input_format, pixel_mean, pixel_std
+    )
+    return run_batch([image], model)
+
+
+def preprocess(
+    image_bytes: bytes,
+    image_patch: List[float],
+    augmentations: Dict[str, Any],
+    input_format: str,
+    pixel_mean: torch.Tensor,
+    pixel_std: torch.Tensor,
+) -> torch.Tensor:
     with io.BytesIO(image_bytes) as image_buffer:
         image = Image.open(image_buffer)
 
@@ -86,8 +100,15 @@ def run(
             image = torch.flip(image, dims=(0,))  # RGB -> BGR
         image = image.contiguous()
         image = (image - pixel_mean) / pixel_std
+    return image  # CHW
 
+
+def run_batch(
+    images: List[torch.Tensor], model: torch.nn.Module
+) -> Dict[str, torch.Tensor]:
+    # Images must all be the same size (padding would change the embeddings)
     # Input: NCHW
-    # Output: {'res4': NCHW, 'res5': NCHW} where N = 1
-    output_dict = model(image.unsqueeze(dim=0))
+    # Output: {'res4': NCHW, 'res5': NCHW} where N = len(images)
+    with torch.no_grad():  # grad mode is per thread, and this may not be the main one
+        output_dict = model(torch.stack(images))
     return {k: v.detach() for k, v in output_dict.items()}
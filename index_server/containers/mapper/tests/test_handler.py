@@ -0,0 +1,127 @@
+import asyncio
+from pathlib import Path
+import threading
+import time
+
+import numpy as np
+import pytest
+
+# Only runs where the mapper's image is built: importing handler loads the model
+torch = pytest.importorskip("torch")
+pytest.importorskip("detectron2")
+
+import config  # noqa: E402
+
+if not Path(config.WEIGHTS_PATH).exists():
+    pytest.skip("Model weights not downloaded", allow_module_level=True)
+
+import handler  # noqa: E402
+import inference  # noqa: E402
+
+
+class DummyRequest:
+    def __init__(self, json):
+        self.json = json
+
+    async def receive_body(self):
+        pass
+
+
+class FakeModel:
+    # Stands in for the ResNet backbone: each image's "res5" output is its top-left
+    # 2 x 2 x 2 corner. Images whose first element is negative make the batch fail.
+    def __init__(self, delay=0.0):
+        self.delay = delay
+        self.batch_shapes = []
+        self.running = threading.Event()
+
+    def __call__(self, images):
+        self.batch_shapes.append(tuple(images.shape))
+        if (images[:, 0, 0, 0] < 0).any():
+            raise RuntimeError("Bad image")
+        self.running.set()
+        time.sleep(self.delay)
+        self.running.clear()
+        return {"res5": images[:, :2, :2, :2].clone()}
+
+
+class FakeModelMapper(handler.IndexEmbeddingMapper):
+    MAX_PREFETCHED_CHUNKS = 2
+
+    def initialize_container(self, model):
+        self.model = model
+        self.input_format = "BGR"
+        self.pixel_mean = self.pixel_std = None
+        self.session = None
+
+
+def expected_embedding(image):
+    return image[:2, :2, :2].reshape(2, 4).T.numpy()
+
+
+def image(h, w, value=1.0):
+    return torch.full((3, h, w), value)
+
+
+def test_embed_batches_images_of_the_same_size(monkeypatch):
+    monkeypatch.setattr(config, "INFERENCE_BATCH_SIZE", 2)
+    model = FakeModel()
+    mapper = FakeModelMapper(model, start_server=False)
+    images = [image(4, 4, 1), image(4, 6, 2), None, image(4, 4, 3), image(4, 4, 4)]
+
+    embeddings = mapper.embed(images, "request")
+    assert sorted(model.batch_shapes) == [(1, 3, 4, 4), (1, 3, 4, 6), (2, 3, 4, 4)]
+    assert embeddings[2] is None
+    for embedding, im in zip(embeddings, images):
+        if im is not None:
+            np.testing.assert_array_equal(embedding, expected_embedding(im))
+
+
+def test_failed_batches_are_retried_one_image_at_a_time():
+    model = FakeModel()
+    mapper = FakeModelMapper(model, start_server=False)
+    images = [image(4, 4, 1), image(4, 4, -1), image(4, 4, 3)]
+
+    embeddings = mapper.embed(images, "request")
+    assert model.batch_shapes == [(3, 3, 4, 4)] + [(1, 3, 4, 4)] * 3
+    assert embeddings[1] is None
+    np.testing.assert_array_equal(embeddings[0], expected_embedding(images[0]))
+    np.testing.assert_array_equal(embeddings[2], expected_embedding(images[2]))
+
+
+def test_next_chunk_downloads_while_current_one_is_embedded(monkeypatch):
+    model = FakeModel(delay=0.05)
+    mapper = FakeModelMapper(model, start_server=False)
+    downloaded_while_embedding = []
+
+    async def download_image(image_path):
+        await asyncio.sleep(0.01)
+        downloaded_while_embedding.append(model.running.is_set())
+        return image_path.encode()
+
+    monkeypatch.setattr(mapper, "download_image", download_image)
+    monkeypatch.setattr(inference, "preprocess", lambda *args: image(4, 4))
+
+    def make_request(i):
+        return DummyRequest(
+            {
+                "job_id": "job",
+                "job_args": {"input_bucket": "bucket"},
+                "inputs": [{"image": f"{i}.jpg"}],
+            }
+        )
+
+    async def main():
+        return await asyncio.gather(
+            *[mapper._handle_request(make_request(i)) for i in range(6)]
+        )
+
+    responses = asyncio.run(main())
+    assert all(
+        len(response["outputs"]) == 1 and response["outputs"][0] is not None
+        for response in responses
+    )
+    # Beyond the first MAX_PREFETCHED_CHUNKS chunks, each one is downloaded while
+    # an earlier one is embedded
+    assert any(downloaded_while_embedding)
+    assert all(shape[0] == 1 for shape in model.batch_shapes)
@@ -1,2 +1,3 @@
 GCS_URL_PREFIX = "https://storage.googleapis.com"
 DOWNLOAD_NUM_RETRIES = 3
+MAX_PREFETCHED_CHUNKS = 3  # chunks downloaded ahead of (or in) processing
@@ -1,4 +1,5 @@
 import asyncio
+import concurrent.futures
 import io
 import os
 
@@ -6,56 +7,118 @@ import aiohttp
 from gcloud.aio.storage import Storage
 from PIL import Image
 
+from typing import Any, List, Optional, Tuple
+
 from knn import utils
 from knn.mappers import Mapper
+from knn.utils import JSONType
 
 import config
 
 
 class ImageResizingMapper(Mapper):
+    # Downloads (fetch stage), resizes (process stage) and uploads (postprocess stage)
+    # each chunk, so that uploads and the next chunk's downloads overlap resizing
+    MAX_PREFETCHED_CHUNKS = config.MAX_PREFETCHED_CHUNKS
+    MAX_CONCURRENT_CHUNKS = 1
+
     def initialize_container(self):
         self.session = aiohttp.ClientSession()
         self.storage_client = Storage(session=self.session)
 
-    @utils.log_exception_from_coro_but_return_none
-    async def process_element(
-        self, input, job_id, job_args, request_id, element_index
-    ) -> str:
-        image_path = input["image"]
-        identifier = input["identifier"]
-
-        output_bucket = job_args["output_bucket"]
-        output_dir = job_args["output_dir"]
-        resize_max_width = job_args.get("resize_max_width")
-        resize_max_height = job_args.get("resize_max_height")
+    def register_executor(self):
+        # Resizes images off the event loop
+        return concurrent.futures.ThreadPoolExecutor(1)
 
-        assert resize_max_width or resize_max_height
-        output_path = os.path.join(output_dir, f"{identifier}.jpg")
+    async def fetch_chunk(
+        self, chunk, job_id, job_args, request_id
+    ) -> List[Optional[bytes]]:
+        with self.profiler(request_id, "download_time"):
+            return await asyncio.gather(
+                *[self.fetch_element(input, job_args) for input in chunk]
+            )
 
-        # Download image
+    @utils.log_exception_from_coro_but_return_none
+    async def fetch_element(self, input, job_args) -> bytes:
+        image_path = input["image"]
         if "http" not in image_path:
             image_bucket = job_args["input_bucket"]
             image_path = os.path.join(config.GCS_URL_PREFIX, image_bucket, image_path)
-        image_bytes = await self.download_image(image_path)
+        return await self.download_image(image_path)
+
+    async def process_chunk(
+        self, images, job_id, job_args, request_id
+    ) -> List[Optional[bytes]]:
+        return await self.apply_in_executor(
+            self.resize_images,
+            images,
+            job_args,
+            request_id=request_id,
+            profiler_name="resize_time",
+        )
+
+    def resize_images(
+        self, images: List[Optional[bytes]], job_args
+    ) -> List[Optional[bytes]]:
+        assert job_args.get("resize_max_width") or job_args.get("resize_max_height")
+        return [
+            None if image_bytes is None else self.resize_image(image_bytes, job_args)
+            for image_bytes in images
+        ]
 
+    @utils.log_exception_but_return_none
+    def resize_image(self, image_bytes: bytes, job_args) -> bytes:
+        resize_max_width = job_args.get("resize_max_width")
+        resize_max_height = job_args.get("resize_max_height")
         with io.BytesIO(image_bytes) as image_buffer:
-            # Resize
             image = Image.open(image_buffer)
             image = image.convert("RGB")
             image.thumbnail(
-                (resize_max_width or image.width, resize_max_height or image.height)
+                (
+                    resize_max_width or image.width,
+                    resize_max_height or image.height,
+                )
             )
-
-            # Upload to Cloud Storage
             with io.BytesIO() as output_buffer:
                 image.save(output_buffer, "jpeg")
-                output_buffer.seek(0)
-                await self.storage_client.upload(
-                    output_bucket, output_path, output_buffer
-                )
+                return output_buffer.getvalue()
+
+    async def postprocess_chunk(
+        self, inputs, outputs: List[Optional[bytes]], job_id, job_args, request_id
+    ) -> Tuple[None, List[Optional[str]]]:
+        with self.profiler(request_id, "upload_time"):
+            return None, await asyncio.gather(
+                *[
+                    self.upload_image(input, image_bytes, job_args)
+                    for input, image_bytes in zip(inputs, outputs)
+                ]
+            )
+
+    @utils.log_exception_from_coro_but_return_none
+    async def upload_image(
+        self, input, image_bytes: Optional[bytes], job_args
+    ) -> Optional[str]:
+        if image_bytes is None:
+            return None
+
+        # Upload to Cloud Storage
+        output_bucket = job_args["output_bucket"]
+        output_path = os.path.join(job_args["output_dir"], f"{input['identifier']}.jpg")
+        with io.BytesIO(image_bytes) as output_buffer:
+            await self.storage_client.upload(output_bucket, output_path, output_buffer)
 
         return os.path.join(config.GCS_URL_PREFIX, output_bucket, output_path)
 
+    async def process_element(
+        self,
+        input: JSONType,
+        job_id: str,
+        job_args: Any,
+        request_id: str,
+        element_index: int,
+    ) -> Any:
+        pass  # process_chunk handles the whole chunk at once
+
     async def download_image(
         self, image_path: str, num_retries: int = config.DOWNLOAD_NUM_RETRIES
     ) -> bytes:
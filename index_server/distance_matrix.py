@@ -0,0 +1,119 @@
+import concurrent.futures
+from pathlib import Path
+import os
+
+import numpy as np
+
+from typing import Union
+
+
+class CondensedDistanceMatrix:
+    # Stores the Euclidean distances between n vectors as the upper triangle of the
+    # n x n distance matrix, in the same row-major "condensed" layout as
+    # scipy.spatial.distance.pdist: d(i, j) for i < j is at
+    # n * i - i * (i + 1) / 2 + (j - i - 1). Each row's entries are contiguous.
+
+    @classmethod
+    def create(cls, path: Path, n: int, dtype: Union[str, np.dtype] = np.float32):
+        return cls(cls._memmap(path, n, np.dtype(dtype), "w+"), n)
+
+    @classmethod
+    def load(cls, path: Path, n: int):
+        # The dtype (float32 or float16) is implied by the file size
+        itemsize = os.path.getsize(path) // max(cls.size(n), 1)
+        dtype = {4: np.dtype(np.float32), 2: np.dtype(np.float16)}[itemsize]
+        return cls(cls._memmap(path, n, dtype, "r"), n)
+
+    @staticmethod
+    def size(n: int) -> int:
+        return n * (n - 1) // 2
+
+    @classmethod
+    def _memmap(cls, path: Path, n: int, dtype: np.dtype, mode: str) -> np.ndarray:
+        if cls.size(n) == 0:
+            return np.empty(0, dtype=dtype)  # can't memmap an empty file
+        return np.memmap(path, dtype=dtype, mode=mode, shape=(cls.size(n),))
+
+    # Don't use this directly - use a @classmethod constructor
+    def __init__(self, data: np.ndarray, n: int):
+        self.data = data
+        self.n = n
+
+    def build(
+        self,
+        embeddings: np.ndarray,
+        block_bytes: int = 256 * 1024 * 1024,
+        chunk_size: int = 16384,
+        n_threads: int = 1,
+    ):
+        # Computes distances a block of rows at a time as ||a||^2 + ||b||^2 - 2ab,
+        # with one GEMM per chunk_size columns, so neither the embeddings nor the
+        # square matrix ever need to fit in memory. Blocks are independent, so they
+        # are computed in parallel and written straight to their rows' slices.
+        assert len(embeddings) == self.n
+        n = self.n
+        sq_norms = np.empty(n, dtype=np.float32)
+        for start in range(0, n, chunk_size):
+            chunk = np.asarray(embeddings[start : start + chunk_size], np.float32)
+            sq_norms[start : start + chunk_size] = np.einsum("ij,ij->i", chunk, chunk)
+
+        # Row i's block holds distances to columns [block start, n)
+        rows_per_block = max(1, min(n, block_bytes // (4 * max(n, 1))))
+
+        def build_block(block_start: int):
+            block_end = min(block_start + rows_per_block, n)
+            a = np.asarray(embeddings[block_start:block_end], np.float32)
+            dists = np.empty((block_end - block_start, n - block_start), np.float32)
+            for start in range(block_start, n, chunk_size):
+                end = min(start + chunk_size, n)
+                b = np.asarray(embeddings[start:end], np.float32)
+                np.matmul(a, b.T, out=dists[:, start - block_start : end - block_start])
+
+            dists *= -2
+            dists += sq_norms[block_start:block_end, None]
+            dists += sq_norms[None, block_start:]
+            np.maximum(dists, 0, out=dists)  # rounding error
+            np.sqrt(dists, out=dists)
+
+            for i in range(block_start, block_end):
+                offset = self._offset(i, i + 1)
+                self.data[offset : offset + n - i - 1] = dists[
+                    i - block_start, i - block_start + 1 :
+                ]
+
+        with concurrent.futures.ThreadPoolExecutor(n_threads) as pool:
+            for _ in pool.map(build_block, range(0, n, rows_per_block)):
+                pass
+
+    def flush(self):
+        if isinstance(self.data, np.memmap):
+            self.data.flush()
+
+    def block(self, rows: np.ndarray, cols: np.ndarray) -> np.ndarray:
+        # len(rows) x len(cols) matrix of distances
+        rows = np.asarray(rows, dtype=np.int64)
+        cols = np.asarray(cols, dtype=np.int64)
+        return self.pairwise(rows[:, None], cols[None, :])
+
+    def condensed(self, inds: np.ndarray) -> np.ndarray:
+        # Condensed distance matrix (as from pdist) of just the given vectors
+        inds = np.asarray(inds, dtype=np.int64)
+        i, j = np.triu_indices(len(inds), k=1)
+        return self.pairwise(inds[i], inds[j])
+
+    def pairwise(self, a: np.ndarray, b: np.ndarray) -> np.ndarray:
+        # Elementwise (broadcast) distances d(a, b)
+        a, b = np.broadcast_arrays(
+            np.asarray(a, dtype=np.int64), np.asarray(b, dtype=np.int64)
+        )
+        i = np.minimum(a, b)
+        j = np.maximum(a, b)
+        off_diagonal = i != j
+        dists = np.zeros(a.shape, dtype=self.data.dtype)
+        dists[off_diagonal] = self.data[
+            self._offset(i[off_diagonal], j[off_diagonal])
+        ]
+        return dists
+
+    def _offset(self, i, j):
+        return self.n * i - i * (i + 1) // 2 + (j - i - 1)
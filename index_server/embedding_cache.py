@@ -0,0 +1,96 @@
+from dataclasses import dataclass
+import hashlib
+import json
+from pathlib import Path
+import shutil
+import tempfile
+import weakref
+
+from dataclasses_json import dataclass_json
+import numpy as np
+
+from typing import Optional
+
+from knn.utils import JSONType
+
+from utils import LRUCache
+
+
+class EmbeddingCache:
+    # Caches embeddings computed by the mapper for query and SVM training images,
+    # keyed by everything that determines them: which mapper (and model) computed
+    # them, the mapper job's arguments (bucket, reduction) and the image, patch and
+    # augmentations. Recently used embeddings are
+    # kept in memory; ones evicted from memory spill to .npy files on local disk,
+    # which are in turn evicted least recently used first. Each cache spills to its own
+    # new subdirectory of dir (server workers share dir), which is removed along with
+    # the cache.
+
+    @dataclass_json
+    @dataclass
+    class Stats:
+        n_memory_hits: int = 0
+        n_disk_hits: int = 0
+        n_misses: int = 0
+
+    def __init__(self, dir: Path, max_memory_bytes: int, max_disk_bytes: int):
+        dir.mkdir(parents=True, exist_ok=True)
+        self.dir = Path(tempfile.mkdtemp(dir=dir))
+        weakref.finalize(self, shutil.rmtree, self.dir, ignore_errors=True)
+
+        self.memory: LRUCache[str, np.ndarray] = LRUCache(
+            max_memory_bytes, lambda embedding: embedding.nbytes, self._spill
+        )
+        self.disk: LRUCache[str, Path] = LRUCache(
+            max_disk_bytes,
+            lambda path: path.stat().st_size,
+            lambda key, path: path.unlink(missing_ok=True),
+        )
+        self.stats = EmbeddingCache.Stats()
+
+    @staticmethod
+    def key(mapper_id: JSONType, job_args: JSONType, input: JSONType) -> str:
+        # mapper_id identifies the mapper deployment and the model it runs. Other
+        # fields of the input (e.g., an SVM example's label) don't affect the
+        # embedding; defaults match the mapper's.
+        embedding_args = {
+            "image": input["image"],
+            "patch": [float(x) for x in input.get("patch", (0, 0, 1, 1))],
+            "augmentations": input.get("augmentations", {}),
+        }
+        return hashlib.sha1(
+            json.dumps([mapper_id, job_args, embedding_args], sort_keys=True).encode()
+        ).hexdigest()
+
+    def get(self, key: str) -> Optional[np.ndarray]:
+        if key in self.memory:
+            self.stats.n_memory_hits += 1
+            return self.memory[key]
+
+        embedding = None
+        path = self.disk.pop(key, None)
+        if path is not None:
+            try:
+                embedding = np.load(path)
+            except Exception:
+                pass  # e.g., the file was deleted; treat it as a miss
+            path.unlink(missing_ok=True)
+        if embedding is None:
+            self.stats.n_misses += 1
+            return None
+
+        self.stats.n_disk_hits += 1
+        self.memory[key] = embedding
+        return embedding
+
+    def put(self, key: str, embedding: np.ndarray):
+        # Each key is in at most one tier
+        path = self.disk.pop(key, None)
+        if path is not None:
+            path.unlink(missing_ok=True)
+        self.memory[key] = embedding
+
+    def _spill(self, key: str, embedding: np.ndarray):
+        path = self.dir / f"{key}.npy"
+        np.save(path, embedding)
+        self.disk[key] = path
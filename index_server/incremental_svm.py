@@ -0,0 +1,145 @@
+import threading
+
+import numpy as np
+
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+
+class IncrementalLinearSVC:
+    # Linear SVM with the same objective as sklearn.svm.LinearSVC's defaults (L2
+    # regularization, squared hinge loss, regularized intercept with
+    # intercept_scaling=1), solved by dual coordinate descent (Hsieh et al., ICML
+    # 2008). Unlike LinearSVC, it keeps its training examples and dual variables
+    # between fits: refitting after a few labels change only fetches the new
+    # examples' features and starts from the previous solution, which is usually a
+    # handful of passes away from the new optimum.
+
+    def __init__(
+        self,
+        C: float = 1.0,
+        tol: float = 1e-4,
+        max_iter: int = 1000,
+        random_state: Optional[int] = None,
+    ):
+        self.C = C
+        self.tol = tol
+        self.max_iter = max_iter
+        self.rng = np.random.default_rng(random_state)
+        self.lock = threading.RLock()  # hold to read a consistent fit
+
+        self.keys: List[int] = []  # e.g., embedding row index of each example
+        self.features: Optional[np.ndarray] = None  # with a trailing bias column
+        self.signs = np.empty(0, dtype=np.float32)  # +1 (positive) or -1 (negative)
+        self.alpha = np.empty(0, dtype=np.float32)
+        self.w: Optional[np.ndarray] = None  # coefficients, then intercept
+
+        self.n_fetched = 0  # examples whose features were fetched by the last fit
+        self.n_iter_ = 0
+
+    @property
+    def coef_(self) -> np.ndarray:
+        assert self.w is not None
+        return self.w[None, :-1]
+
+    @property
+    def intercept_(self) -> np.ndarray:
+        assert self.w is not None
+        return self.w[-1:]
+
+    def fit(
+        self,
+        keys: Sequence[int],
+        labels: Sequence[int],
+        get_features: Callable[[List[int]], np.ndarray],
+    ) -> "IncrementalLinearSVC":
+        # labels are 1 (positive) or 0 (negative); get_features returns a
+        # len(keys) x d array and is only called with keys not seen before
+        with self.lock:
+            self._update_examples(list(keys), np.asarray(labels), get_features)
+            self._solve()
+        return self
+
+    def decision_function(self, X: np.ndarray) -> np.ndarray:
+        return X @ self.coef_[0] + self.intercept_[0]
+
+    def predict(self, X: np.ndarray) -> np.ndarray:
+        return (self.decision_function(X) > 0).astype(np.int64)
+
+    def training_features(self) -> np.ndarray:
+        assert self.features is not None
+        return self.features[:, :-1]
+
+    def _update_examples(
+        self,
+        keys: List[int],
+        labels: np.ndarray,
+        get_features: Callable[[List[int]], np.ndarray],
+    ):
+        signs = np.where(labels > 0, 1, -1).astype(np.float32)
+        old_rows: Dict[int, int] = {key: i for i, key in enumerate(self.keys)}
+        reused: List[Tuple[int, int]] = []  # (new row, old row)
+        new_keys: List[int] = []
+        new_rows: List[int] = []
+        for i, key in enumerate(keys):
+            if key in old_rows:
+                reused.append((i, old_rows[key]))
+            else:
+                new_keys.append(key)
+                new_rows.append(i)
+
+        fetched = (
+            np.asarray(get_features(new_keys), dtype=np.float32)
+            if new_keys
+            else None
+        )
+        dim = (
+            fetched.shape[1]
+            if fetched is not None
+            else self.features.shape[1] - 1  # type: ignore
+        )
+
+        features = np.ones((len(keys), dim + 1), dtype=np.float32)
+        alpha = np.zeros(len(keys), dtype=np.float32)
+        if reused:
+            reused_new, reused_old = map(np.array, zip(*reused))
+            assert self.features is not None
+            features[reused_new] = self.features[reused_old]
+            # Dual variables only carry over for examples whose label is unchanged
+            same_label = signs[reused_new] == self.signs[reused_old]
+            alpha[reused_new[same_label]] = self.alpha[reused_old[same_label]]
+        if fetched is not None:
+            features[new_rows, :-1] = fetched
+
+        self.keys = keys
+        self.features = features
+        self.signs = signs
+        self.alpha = alpha
+        self.n_fetched = len(new_keys)
+
+    def _solve(self):
+        assert self.features is not None
+        x = self.features
+        y = self.signs
+        alpha = self.alpha
+        diag = 0.5 / self.C
+        q_diag = np.einsum("ij,ij->i", x, x) + diag
+        w = (alpha * y) @ x
+
+        # Coordinate descent on the dual, in a random order each pass, until the
+        # projected gradient's spread drops below tol (as in liblinear)
+        for self.n_iter_ in range(1, self.max_iter + 1):
+            pg_max = -np.inf
+            pg_min = np.inf
+            for i in self.rng.permutation(len(y)):
+                g = y[i] * (w @ x[i]) - 1 + diag * alpha[i]
+                pg = g if alpha[i] > 0 else min(g, 0.0)
+                pg_max = max(pg_max, pg)
+                pg_min = min(pg_min, pg)
+                if pg != 0:
+                    old_alpha = alpha[i]
+                    alpha[i] = max(old_alpha - g / q_diag[i], 0.0)
+                    w += (alpha[i] - old_alpha) * y[i] * x[i]
+            if pg_max - pg_min <= self.tol:
+                break
+
+        self.w = w
@@ -11,7 +11,7 @@ import uuid
 import logging
 import hashlib
 
-from typing import Any, Callable, Dict, List, Optional, Set
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
 
 import aiohttp
 
@@ -22,6 +22,7 @@ from knn.utils import JSONType
 from knn.reducers import Reducer
 
 import config
+from distance_matrix import CondensedDistanceMatrix
 
 logger = logging.getLogger("index_server")
 
@@ -321,7 +322,9 @@ class TrainingJob:
 class LocalFlatIndex:
     INDEX_FILENAME = config.EMBEDDING_FILE_NAME
     SCORES_FILENAME = config.MODEL_SCORES_FILE_NAME
-    DISTANCE_MATRIX_FILENAME = "distances.npy"
+    DISTANCE_MATRIX_FILENAME = "condensed_distances.npy"
+    QUANTIZED_INDEX_FILENAME = "embeddings_quantized.npy"
+    QUANTIZATION_PARAMS_FILENAME = "embeddings_quantization.npy"
 
     @classmethod
     def load(cls, dir: Path, num_images: int, dim: int):
@@ -333,16 +336,18 @@ class LocalFlatIndex:
             shape=(num_images, dim),
         )
         try:
-            self.distance_matrix = np.memmap(
-                dir / self.DISTANCE_MATRIX_FILENAME,
-                dtype=np.float32,
-                mode="r",
-                shape=(num_images, num_images),
+            self.distance_matrix = CondensedDistanceMatrix.load(
+                dir / self.DISTANCE_MATRIX_FILENAME, num_images
             )
         except Exception:
             pass
         try:
-            self.scores = np.load(dir / self.SCORES_FILENAME)
+            self._load_quantized_index(dir)
+        except Exception:
+            self.quantized_index = None
+        self.scores_path = dir / self.SCORES_FILENAME
+        try:
+            self._load_scores()
         except Exception:
             pass
         return self
@@ -358,11 +363,10 @@ class LocalFlatIndex:
             mode="w+",
             shape=(num_images, dim),
         )
-        self.distance_matrix = np.memmap(
+        self.distance_matrix = CondensedDistanceMatrix.create(
             dir / self.DISTANCE_MATRIX_FILENAME,
-            dtype=np.float32,
-            mode="w+",
-            shape=(num_images, num_images),
+            num_images,
+            config.LOCAL_INDEX_DISTANCE_MATRIX_DTYPE,
         )
         self.cluster_mount_parent_dir = cluster_mount_parent_dir
         return self
@@ -370,8 +374,17 @@ class LocalFlatIndex:
     # Don't use this directly - use a @classmethod constructor
     def __init__(self):
         self.index: Optional[np.ndarray] = None
-        self.distance_matrix: Optional[np.ndarray] = None
+        self.distance_matrix: Optional[CondensedDistanceMatrix] = None
+        # Scalar-quantized copy of index (int8 or float16) for fast approximate scans;
+        # for int8, quantization_params holds the per-dimension minimum and step
+        self.quantized_index: Optional[np.ndarray] = None
+        self.quantization_params: Optional[np.ndarray] = None
         self.scores: Optional[np.ndarray] = None
+        self.scores_path: Optional[Path] = None
+        self.scores_mtime: Optional[int] = None
+        # Ascending order of scores and the scores in that order, for range queries;
+        # one attribute so that a concurrent reload replaces both at once
+        self.sorted_scores: Optional[Tuple[np.ndarray, np.ndarray]] = None
         self.cluster_mount_parent_dir: Optional[Path] = None
 
     def add_from_file(self, path_tmpl: str):
@@ -387,27 +400,119 @@ class LocalFlatIndex:
             assert len(embeddings) == 1
             self.index[int(id)] = embeddings[0]
 
+    @classmethod
+    def quantize(
+        cls,
+        embeddings: np.ndarray,
+        dir: Path,
+        dtype: str = "int8",
+        chunk_size: int = 65536,
+    ):
+        # Writes a scalar-quantized copy of the embeddings next to them; int8 uses
+        # 256 evenly spaced levels between each dimension's minimum and maximum
+        dtype = np.dtype(dtype)
+        assert dtype in (np.int8, np.float16)
+
+        params = None
+        if dtype == np.int8:
+            lo = np.full(embeddings.shape[1], np.inf, dtype=np.float32)
+            hi = np.full(embeddings.shape[1], -np.inf, dtype=np.float32)
+            for start in range(0, len(embeddings), chunk_size):
+                chunk = embeddings[start : start + chunk_size]
+                np.minimum(lo, chunk.min(axis=0), out=lo)
+                np.maximum(hi, chunk.max(axis=0), out=hi)
+            step = (hi - lo) / 255
+            step[step == 0] = 1
+            params = np.stack([lo, step])
+            np.save(dir / cls.QUANTIZATION_PARAMS_FILENAME, params)
+
+        # Write to a temporary file first so that any existing memmaps of the old file
+        # stay valid
+        tmp_path = dir / f"{cls.QUANTIZED_INDEX_FILENAME}.tmp"
+        quantized = np.lib.format.open_memmap(
+            tmp_path, mode="w+", dtype=dtype, shape=embeddings.shape
+        )
+        for start in range(0, len(embeddings), chunk_size):
+            chunk = np.asarray(embeddings[start : start + chunk_size], np.float32)
+            if params is None:
+                quantized[start : start + chunk_size] = chunk
+            else:
+                levels = np.rint((chunk - params[0]) / params[1]) - 128
+                quantized[start : start + chunk_size] = np.clip(levels, -128, 127)
+        quantized.flush()
+        del quantized
+        os.replace(tmp_path, dir / cls.QUANTIZED_INDEX_FILENAME)
+
+    def build_quantized_index(self, dir: Path, dtype: str = "int8"):
+        assert self.index is not None
+        self.quantize(self.index, dir, dtype)
+        self._load_quantized_index(dir)
+
+    def _load_quantized_index(self, dir: Path):
+        quantized_index = np.load(dir / self.QUANTIZED_INDEX_FILENAME, mmap_mode="r")
+        self.quantization_params = (
+            np.load(dir / self.QUANTIZATION_PARAMS_FILENAME)
+            if quantized_index.dtype == np.int8
+            else None
+        )
+        self.quantized_index = quantized_index
+
+    def dequantize(self, quantized: np.ndarray) -> np.ndarray:
+        vectors = quantized.astype(np.float32)
+        if self.quantization_params is not None:
+            vectors += 128
+            vectors *= self.quantization_params[1]
+            vectors += self.quantization_params[0]
+        return vectors
+
+    def quantization_error(self, vectors: np.ndarray) -> np.ndarray:
+        # Bounds on the absolute error of each element of dequantized vectors,
+        # broadcastable to them: half a step for int8, and for float16 the rounding
+        # error of an 11-bit significand (or of a subnormal)
+        if self.quantization_params is not None:
+            return self.quantization_params[1] / 2
+        return np.abs(vectors) * 2.0 ** -10 + 2.0 ** -25
+
+    def refresh_scores(self):
+        # Reload scores if inference has rewritten them since they were loaded
+        if self.scores_path is None:
+            return
+        try:
+            mtime = os.stat(self.scores_path).st_mtime_ns
+        except OSError:
+            return
+        if mtime != self.scores_mtime:
+            self._load_scores()
+
+    def _load_scores(self):
+        assert self.scores_path is not None
+        mtime = os.stat(self.scores_path).st_mtime_ns
+        scores = np.load(self.scores_path)
+        sorted_score_inds = np.argsort(scores, kind="stable")
+        self.sorted_scores = (sorted_score_inds, scores[sorted_score_inds])
+        self.scores = scores
+        self.scores_mtime = mtime
+
+    def score_range(
+        self, min_s: float, max_s: float
+    ) -> Tuple[np.ndarray, np.ndarray]:  # ids, scores
+        # Views (no copies) of the rows with min_s <= score <= max_s, highest first
+        assert self.sorted_scores is not None
+        sorted_score_inds, sorted_scores = self.sorted_scores
+        start = np.searchsorted(sorted_scores, min_s, side="left")
+        end = np.searchsorted(sorted_scores, max_s, side="right")
+        return (
+            sorted_score_inds[start:end][::-1],
+            sorted_scores[start:end][::-1],
+        )
+
     def build_distance_matrix(self):
-        self._pdist(self.index, self.distance_matrix)
+        assert self.index is not None and self.distance_matrix is not None
+        self.distance_matrix.build(
+            self.index, n_threads=config.LOCAL_INDEX_BUILDING_NUM_THREADS
+        )
 
     def save(self, dir: Path):
         assert self.index is not None and self.distance_matrix is not None
         self.index.flush()
         self.distance_matrix.flush()
-
-    # TODO(mihirg): Does this even work? Probably should verify... or just use Scipy
-    @staticmethod
-    def _pdist(M, out):
-        # TODO(mihirg): Consider using cosine similarity instead
-        # Alternative to scipy's pdist that respects dtype; modified from
-        # http://www.xavierdupre.fr/app/mlprodict/helpsphinx/notebooks/onnx_pdist.html
-        n = M.shape[0]
-        buffer = np.empty((n - 1, M.shape[1]), dtype=M.dtype)  # TODO(mihirg): Eliminate
-        a = np.empty(n, dtype=M.dtype)
-        for i in range(1, n):
-            np.subtract(M[:i], M[i], out=buffer[:i])  # broadcasted substraction
-            np.square(buffer[:i], out=buffer[:i])
-            np.sum(buffer[:i], axis=1, out=a[:i])
-            np.sqrt(np.max(a[i], 0), out=a[:i])
-            out[:i, i] = a[:i]
-            out[i, :i] = a[:i]
@@ -4,17 +4,20 @@ import concurrent
 from collections import defaultdict
 from dataclasses import dataclass
 import functools
+import hashlib
 import heapq
 import itertools
 from io import BytesIO
 import json
 import logging
 import math
+import multiprocessing
 import operator
 import os
 from pathlib import Path
 import re
 import shutil
+import threading
 import time
 import uuid
 
@@ -28,12 +31,28 @@ from sanic import Sanic
 import sanic.response as resp
 from scipy.spatial.distance import cdist
 from sklearn import svm
+from sklearn.cluster import MiniBatchKMeans
+from sklearn.decomposition import PCA
 from sklearn.metrics import accuracy_score, precision_score, recall_score
 
-from typing import Callable, DefaultDict, Dict, List, Optional, Set, Tuple, Iterable
+from typing import (
+    Callable,
+    DefaultDict,
+    Dict,
+    List,
+    Optional,
+    Set,
+    Tuple,
+    Iterable,
+    Union,
+)
 
 from interactive_index import InteractiveIndex
-from interactive_index.utils import sample_farthest_vectors
+from interactive_index.utils import (
+    MergeProgress,
+    bitmap_add,
+    sample_farthest_vectors,
+)
 
 from knn import utils
 from knn.clusters import TerraformModule
@@ -55,7 +74,9 @@ from bgsplit_jobs import (
     BGSplitTrainingJob,
     BGSplitInferenceJob,
 )
-from utils import CleanupDict
+from embedding_cache import EmbeddingCache
+from incremental_svm import IncrementalLinearSVC
+from utils import BoundedExecutor, CleanupDict, ExecutorBusyError, LRUCache
 
 
 # Create a logger for the server
@@ -93,6 +114,14 @@ class LabeledIndex:
         spatial_dists: Optional[List[Tuple[int, float]]] = None
         label: str = ""
 
+    @dataclass
+    class BruteForceQuery:
+        query_vector: np.ndarray
+        dot_product: bool = False
+        min_d: float = 0.0
+        max_d: float = 1.0
+        num_results: Optional[int] = None  # if None, all results
+
     @dataclass
     class FurthestQueryResult:
         id: int
@@ -115,6 +144,11 @@ class LabeledIndex:
         self.val_identifiers: Optional[Dict[str, int]] = None
         self.indexes: Dict[IndexType, InteractiveIndex] = {}
         self.local_flat_indexes: Dict[str, LocalFlatIndex] = {}
+        # Brute-force distance extremes over all rows, by model and query vector
+        self.dist_extremes: LRUCache[str, Tuple[float, float]] = LRUCache(
+            config.BRUTE_FORCE_DIST_EXTREMES_CACHE_SIZE
+        )
+        self.dist_extremes_lock = threading.Lock()
 
         # Will only be used by the start_building() pathway
         self.bucket: Optional[str] = None
@@ -129,6 +163,7 @@ class LabeledIndex:
         self.adder_job: Optional[MapReduceJob] = None
         self.resizer_job: Optional[MapReduceJob] = None
         self.merge_task: Optional[asyncio.Task] = None
+        self.merge_progress: Dict[IndexType, MergeProgress] = {}
         self.cluster_unlock_fn: Optional[Callable[[None], None]] = None
 
     def get_local_flat_index(self, model: str):
@@ -147,20 +182,27 @@ class LabeledIndex:
     def rank_brute_force(
         self, model: str, min_s: float = 0.0, max_s: float = 1.0
     ) -> List[QueryResult]:
+        return self.to_query_results(
+            *self.rank_brute_force_columnar(model, min_s, max_s)
+        )
+
+    def rank_brute_force_columnar(
+        self,
+        model: str,
+        min_s: float = 0.0,
+        max_s: float = 1.0,
+        offset: int = 0,
+        num_results: Optional[int] = None,  # if None, all results after offset
+    ) -> Tuple[np.ndarray, np.ndarray]:  # ids, scores
         local_flat_index = self.get_local_flat_index(model)
+        local_flat_index.refresh_scores()
         assert local_flat_index.scores is not None
 
-        ranking = np.argsort(local_flat_index.scores)[::-1]
-        sorted_results = []
-        for i in ranking:
-            i = int(i)
-            s = float(local_flat_index.scores[i])
-            if min_s <= s <= max_s:
-                sorted_results.append(LabeledIndex.QueryResult(i, s))
-
-        for result in sorted_results:
-            result.label = self.labels[result.id]
-        return sorted_results
+        # Slices of the precomputed sorted order; nothing is copied until the
+        # requested page is serialized
+        ids, scores = local_flat_index.score_range(min_s, max_s)
+        end = None if num_results is None else offset + num_results
+        return ids[offset:end], scores[offset:end]
 
     def query_brute_force(
         self,
@@ -170,41 +212,381 @@ class LabeledIndex:
         max_d: float = 1.0,
         chunk_size: int = config.BRUTE_FORCE_QUERY_CHUNK_SIZE,
         model: str = config.DEFAULT_QUERY_MODEL,
+        allowed_inds: Optional[np.ndarray] = None,  # sorted; if None, all rows
+        num_results: Optional[int] = None,  # if None, all results
     ) -> List[QueryResult]:
+        return self.to_query_results(
+            *self.query_brute_force_columnar(
+                query_vector,
+                dot_product,
+                min_d,
+                max_d,
+                chunk_size,
+                model,
+                allowed_inds,
+                num_results,
+            )
+        )
+
+    def query_brute_force_columnar(
+        self,
+        query_vector: np.ndarray,
+        dot_product: bool = False,
+        min_d: float = 0.0,
+        max_d: float = 1.0,
+        chunk_size: int = config.BRUTE_FORCE_QUERY_CHUNK_SIZE,
+        model: str = config.DEFAULT_QUERY_MODEL,
+        allowed_inds: Optional[np.ndarray] = None,  # sorted; if None, all rows
+        num_results: Optional[int] = None,  # if None, all results
+    ) -> Tuple[np.ndarray, np.ndarray]:  # ids, dists
+        query = LabeledIndex.BruteForceQuery(
+            query_vector, dot_product, min_d, max_d, num_results
+        )
+        return self.query_brute_force_batch_columnar(
+            [query], model, allowed_inds, chunk_size
+        )[0]
+
+    def query_brute_force_batch_columnar(
+        self,
+        queries: List[BruteForceQuery],
+        model: str = config.DEFAULT_QUERY_MODEL,
+        allowed_inds: Optional[np.ndarray] = None,  # sorted; if None, all rows
+        chunk_size: int = config.BRUTE_FORCE_QUERY_CHUNK_SIZE,
+    ) -> List[Tuple[np.ndarray, np.ndarray]]:  # ids, dists for each query
         local_flat_index = self.get_local_flat_index(model)
 
-        self.logger.info(f"Brute force query: dot_product={dot_product}")
+        self.logger.info(
+            f"Brute force query: n_queries={len(queries)}, "
+            f"n_allowed={'all' if allowed_inds is None else len(allowed_inds)}"
+        )
         start = time.perf_counter()
 
-        # TODO(mihirg): Process CHUNK_SIZE rows at a time for large datasets
-        if dot_product:
-            dists = local_flat_index.index @ query_vector
+        # Only scan the allowed rows
+        n_rows = (
+            len(local_flat_index.index) if allowed_inds is None else len(allowed_inds)
+        )
+        if n_rows == 0:
+            empty = (np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32))
+            return [empty for _ in queries]
+
+        # The quantized copy of the embeddings (if any) is scanned only when every
+        # query wants a bounded number of results, since any row that might be
+        # returned has its distance recomputed exactly
+        exact = any(query.num_results is None for query in queries)
+        dists_by_query, errors_by_query = self._brute_force_dists(
+            local_flat_index, queries, allowed_inds, chunk_size, exact
+        )
+
+        # Normalize by each query's distance extremes over the whole index rather than
+        # over the allowed rows, so that what a range filter keeps doesn't depend on
+        # which other rows are allowed (see _get_dist_extremes)
+        if allowed_inds is None:
+            extremes = [
+                self._exact_dist_extremes(local_flat_index, query, dists, errors)
+                for query, dists, errors in zip(
+                    queries, dists_by_query, errors_by_query
+                )
+            ]
+            self._cache_dist_extremes(model, queries, extremes)
         else:
-            dists = cdist(np.expand_dims(query_vector, axis=0), local_flat_index.index)
-            dists = np.squeeze(dists, axis=0)
+            extremes = self._get_dist_extremes(
+                local_flat_index,
+                model,
+                queries,
+                chunk_size,
+                allowed_inds,
+                dists_by_query,
+                errors_by_query,
+            )
 
-        sorted_results = []
-        lowest_dist = np.min(dists)
-        highest_dist = np.max(dists)
+        results = []
+        for query, dists, errors, (lowest_dist, highest_dist) in zip(
+            queries, dists_by_query, errors_by_query, extremes
+        ):
+            dists -= lowest_dist
+            dists /= highest_dist - lowest_dist
+            np.clip(dists, 0.0, 1.0, out=dists)  # rounding error
 
-        for i, d in enumerate(dists):
-            d = float(d)
-            d = (d - lowest_dist) / (highest_dist - lowest_dist)  # normalize
-            if min_d <= d <= max_d:
-                sorted_results.append(LabeledIndex.QueryResult(i, d))
+            if errors is None:
+                candidates = np.flatnonzero(
+                    (query.min_d <= dists) & (dists <= query.max_d)
+                )
+            else:
+                errors /= highest_dist - lowest_dist
+                errors += 1e-6  # rounding error
+                candidates = self._rerank_candidates(
+                    local_flat_index,
+                    query,
+                    allowed_inds,
+                    dists,
+                    errors,
+                    lowest_dist,
+                    highest_dist,
+                )
 
-        sorted_results.sort(key=operator.attrgetter("dist"), reverse=dot_product)
+            # Order by distance (descending for dot products), only fully sorting the
+            # top num_results candidates
+            keys = -dists[candidates] if query.dot_product else dists[candidates]
+            if query.num_results is not None and query.num_results < len(candidates):
+                top = np.argpartition(keys, query.num_results)[: query.num_results]
+                candidates = candidates[top]
+                keys = keys[top]
+            candidates = candidates[np.argsort(keys, kind="stable")]
+
+            ids = candidates if allowed_inds is None else allowed_inds[candidates]
+            results.append((ids, dists[candidates]))
 
         end = time.perf_counter()
         self.logger.debug(
-            f"Brute force query of size {query_vector.shape} with "
-            f"n_vectors={len(self.labels)} took {end - start:.3f}s, and "
-            f"got {len(sorted_results)} results."
+            f"Brute force query of size {(len(queries), local_flat_index.index.shape[1])} "
+            f"with n_vectors={n_rows} took {end - start:.3f}s, and "
+            f"got {sum(len(ids) for ids, _ in results)} results."
         )
+        return results
 
-        for result in sorted_results:
-            result.label = self.labels[result.id]
-        return sorted_results
+    def _rerank_candidates(
+        self,
+        local_flat_index: LocalFlatIndex,
+        query: BruteForceQuery,
+        rows: Optional[np.ndarray],  # sorted; if None, all rows
+        dists: np.ndarray,  # normalized, from quantized embeddings
+        errors: np.ndarray,  # bounds on the normalized error of dists
+        lowest_dist: float,
+        highest_dist: float,
+    ) -> np.ndarray:  # in-range candidates
+        # Recomputes exact distances, in place, for every row whose error bound
+        # straddles one of the range bounds and then for every candidate that might
+        # be among the top num_results, so that everything returned is exact
+        def rerank(positions: np.ndarray):
+            positions = positions[errors[positions] > 0]  # skip already exact rows
+            exact_dists = self._exact_dists(local_flat_index, query, rows, positions)
+            exact_dists -= lowest_dist
+            exact_dists /= highest_dist - lowest_dist
+            dists[positions] = np.clip(exact_dists, 0.0, 1.0)
+            errors[positions] = 0
+
+        rerank(
+            np.flatnonzero(
+                ((dists - errors < query.min_d) & (query.min_d <= dists + errors))
+                | ((dists - errors <= query.max_d) & (query.max_d < dists + errors))
+            )
+        )
+        candidates = np.flatnonzero((query.min_d <= dists) & (dists <= query.max_d))
+
+        keys = -dists[candidates] if query.dot_product else dists[candidates]
+        candidate_errors = errors[candidates]
+        if query.num_results is not None and query.num_results < len(candidates):
+            # Only rows that could beat the num_results-th best upper bound might be
+            # in the top num_results
+            upper_bounds = keys + candidate_errors
+            threshold = np.partition(upper_bounds, query.num_results - 1)[
+                query.num_results - 1
+            ]
+            rerank(candidates[keys - candidate_errors <= threshold])
+        else:
+            rerank(candidates)
+        return candidates
+
+    def _brute_force_dists(
+        self,
+        local_flat_index: LocalFlatIndex,
+        queries: List[BruteForceQuery],
+        rows: Optional[np.ndarray],  # sorted; if None, all rows
+        chunk_size: int,
+        exact: bool = False,
+    ) -> Tuple[np.ndarray, List[Optional[np.ndarray]]]:
+        # Scans the local flat index once for all of the queries, returning a row of
+        # (unnormalized) distances per query. Unless exact is set, the quantized copy
+        # of the embeddings is read if there is one, and each query also gets a row of
+        # bounds on its distances' quantization error (None if they're exact).
+        n_rows = len(local_flat_index.index) if rows is None else len(rows)
+        query_vectors = np.stack([q.query_vector for q in queries]).astype(np.float32)
+        is_dot_product = np.array([q.dot_product for q in queries])
+
+        # Scan chunk_size rows of the memmap at a time
+        quantized_index = None if exact else local_flat_index.quantized_index
+        source = local_flat_index.index if quantized_index is None else quantized_index
+        dists_by_query = np.empty((len(queries), n_rows), dtype=np.float32)
+        errors_by_query = (
+            None if quantized_index is None else np.empty_like(dists_by_query)
+        )
+        for chunk_start in range(0, n_rows, chunk_size):
+            chunk_end = min(chunk_start + chunk_size, n_rows)
+            if rows is None:
+                vectors = source[chunk_start:chunk_end]
+            else:
+                vectors = source[rows[chunk_start:chunk_end]]
+            if quantized_index is not None:
+                vectors = local_flat_index.dequantize(vectors)
+                errors_by_query[:, chunk_start:chunk_end] = self._dist_error_bounds(
+                    query_vectors,
+                    is_dot_product,
+                    local_flat_index.quantization_error(vectors),
+                    len(vectors),
+                )
+            dists_by_query[:, chunk_start:chunk_end] = self._compute_dists(
+                query_vectors, is_dot_product, vectors
+            )
+
+        if errors_by_query is None:
+            return dists_by_query, [None] * len(queries)
+        return dists_by_query, list(errors_by_query)
+
+    def _exact_dists(
+        self,
+        local_flat_index: LocalFlatIndex,
+        query: BruteForceQuery,
+        rows: Optional[np.ndarray],  # sorted; if None, all rows
+        positions: np.ndarray,  # sorted positions in rows
+    ) -> np.ndarray:
+        vectors = local_flat_index.index[
+            positions if rows is None else rows[positions]
+        ]
+        return self._compute_dists(
+            query.query_vector[None].astype(np.float32),
+            np.array([query.dot_product]),
+            vectors,
+        )[0]
+
+    def _exact_dist_extremes(
+        self,
+        local_flat_index: LocalFlatIndex,
+        query: BruteForceQuery,
+        dists: np.ndarray,  # over rows
+        errors: Optional[np.ndarray],
+        rows: Optional[np.ndarray] = None,  # sorted; if None, all rows
+    ) -> Tuple[float, float]:
+        if errors is None:
+            return dists.min(), dists.max()
+
+        # The lowest distance is among the rows whose error bounds reach below the
+        # lowest upper bound, and likewise for the highest
+        lower_bounds = dists - errors
+        upper_bounds = dists + errors
+        near_extremes = np.flatnonzero(
+            (lower_bounds <= upper_bounds.min()) | (upper_bounds >= lower_bounds.max())
+        )
+        exact_dists = self._exact_dists(local_flat_index, query, rows, near_extremes)
+        return exact_dists.min(), exact_dists.max()
+
+    @staticmethod
+    def _compute_dists(
+        query_vectors: np.ndarray, is_dot_product: np.ndarray, vectors: np.ndarray
+    ) -> np.ndarray:
+        # Scores with one matrix product for the dot product queries and one cdist
+        # call for the rest
+        dists = np.empty((len(query_vectors), len(vectors)), dtype=np.float32)
+        if is_dot_product.any():
+            dists[is_dot_product] = query_vectors[is_dot_product] @ vectors.T
+        if not is_dot_product.all():
+            dists[~is_dot_product] = cdist(query_vectors[~is_dot_product], vectors)
+        return dists
+
+    @staticmethod
+    def _dist_error_bounds(
+        query_vectors: np.ndarray,
+        is_dot_product: np.ndarray,
+        element_errors: np.ndarray,  # broadcastable to the vectors
+        n_vectors: int,
+    ) -> np.ndarray:
+        # Bounds on how far distances to the vectors can be from the distances to the
+        # original vectors they approximate: the error of a dot product is at most
+        # |q| . e, and that of a Euclidean distance is at most ||e||
+        errors = np.empty((len(query_vectors), n_vectors), dtype=np.float32)
+        if np.ndim(element_errors) < 2:
+            # The same bounds for every vector (int8), so one per query is enough
+            if is_dot_product.any():
+                errors[is_dot_product] = (
+                    np.abs(query_vectors[is_dot_product]) @ element_errors
+                )[:, None]
+            if not is_dot_product.all():
+                errors[~is_dot_product] = np.linalg.norm(element_errors)
+            return errors
+
+        element_errors = np.broadcast_to(
+            element_errors, (n_vectors, query_vectors.shape[1])
+        )
+        if is_dot_product.any():
+            errors[is_dot_product] = (
+                np.abs(query_vectors[is_dot_product]) @ element_errors.T
+            )
+        if not is_dot_product.all():
+            errors[~is_dot_product] = np.linalg.norm(element_errors, axis=1)
+        return errors
+
+    @staticmethod
+    def _dist_extremes_key(model: str, query: BruteForceQuery) -> str:
+        vector = np.ascontiguousarray(query.query_vector, dtype=np.float32)
+        return hashlib.sha1(
+            f"{model}:{query.dot_product}:".encode() + vector.tobytes()
+        ).hexdigest()
+
+    def _cache_dist_extremes(
+        self,
+        model: str,
+        queries: List[BruteForceQuery],
+        extremes: List[Tuple[float, float]],
+    ):
+        with self.dist_extremes_lock:
+            for query, query_extremes in zip(queries, extremes):
+                self.dist_extremes[self._dist_extremes_key(model, query)] = (
+                    query_extremes
+                )
+
+    def _get_dist_extremes(
+        self,
+        local_flat_index: LocalFlatIndex,
+        model: str,
+        queries: List[BruteForceQuery],
+        chunk_size: int,
+        rows: np.ndarray,  # sorted
+        dists_by_query: np.ndarray,  # over rows
+        errors_by_query: List[Optional[np.ndarray]],
+    ) -> List[Tuple[float, float]]:  # lowest and highest distance for each query
+        # Extremes of each query's distances over all rows, as an unfiltered query
+        # would compute them; only queries that weren't seen recently need a full scan.
+        # Queries without a range filter only use them to scale the distances they
+        # return, so rather than scanning all rows for them, they fall back to the
+        # extremes over the given rows.
+        with self.dist_extremes_lock:
+            extremes = [
+                self.dist_extremes.get(self._dist_extremes_key(model, query))
+                for query in queries
+            ]
+
+        missing = []
+        for i, query in enumerate(queries):
+            if extremes[i]:
+                continue
+            if query.min_d <= 0.0 and query.max_d >= 1.0:
+                extremes[i] = self._exact_dist_extremes(
+                    local_flat_index, query, dists_by_query[i], errors_by_query[i], rows
+                )
+            else:
+                missing.append(i)
+
+        if missing:
+            missing_queries = [queries[i] for i in missing]
+            dists_by_query, errors_by_query = self._brute_force_dists(
+                local_flat_index, missing_queries, None, chunk_size
+            )
+            missing_extremes = [
+                self._exact_dist_extremes(local_flat_index, query, dists, errors)
+                for query, dists, errors in zip(
+                    missing_queries, dists_by_query, errors_by_query
+                )
+            ]
+            self._cache_dist_extremes(model, missing_queries, missing_extremes)
+            for i, query_extremes in zip(missing, missing_extremes):
+                extremes[i] = query_extremes
+
+        return extremes  # type: ignore
+
+    def to_query_results(self, ids: np.ndarray, dists: np.ndarray) -> List[QueryResult]:
+        return [
+            LabeledIndex.QueryResult(i, d, label=self.labels[i])
+            for i, d in zip(ids.tolist(), dists.tolist())
+        ]
 
     def query(
         self,
@@ -215,33 +597,70 @@ class LabeledIndex:
         svm: bool = False,
         min_d: float = 0.0,
         max_d: float = 1.0,
+        allowed_inds: Optional[np.ndarray] = None,  # sorted; if None, all images
+        adaptive: bool = False,  # spatial only; see _adaptive_spatial_query
     ) -> List[QueryResult]:
+        results_by_vector = self.query_batch(
+            np.atleast_2d(query_vector),
+            num_results,
+            num_probes,
+            use_full_image,
+            svm,
+            min_d,
+            max_d,
+            allowed_inds=allowed_inds,
+            adaptive=adaptive,
+        )
+        assert len(results_by_vector) == 1
+        return results_by_vector[0]
+
+    def query_batch(
+        self,
+        query_vectors: np.ndarray,
+        num_results: Optional[int] = None,  # per vector; if None, all results
+        num_probes: Optional[int] = None,
+        use_full_image: bool = False,
+        svm: bool = False,
+        min_d: float = 0.0,
+        max_d: float = 1.0,
+        deduplicate: bool = False,
+        allowed_inds: Optional[np.ndarray] = None,  # sorted; if None, all images
+        adaptive: bool = False,  # spatial only; see _adaptive_spatial_query
+    ) -> Union[List[List[QueryResult]], List[QueryResult]]:
+        # Submits all query vectors to FAISS in a single search call. Returns one list
+        # of results per query vector, or, if deduplicate is set, a single unordered
+        # list with the closest result for each image across all query vectors.
         assert self.ready.is_set()
 
-        self.logger.info(f"Query: use_full_image={use_full_image}, svm={svm}")
+        allowed_ids = None
+        if allowed_inds is not None:
+            allowed_ids = bitmap_add(np.zeros(0, dtype=np.uint8), allowed_inds)
+
+        self.logger.info(
+            f"Query: n_vectors={len(query_vectors)}, use_full_image={use_full_image}, "
+            f"svm={svm}"
+        )
         start = time.perf_counter()
 
+        n_rounds = None
         if use_full_image:
             index = self.indexes[IndexType.FULL_DOT if svm else IndexType.FULL]
             if num_results is None:
                 num_results = len(self.labels)  # can't use n_vectors - distributed add
                 num_probes = index.n_centroids
 
-            dists, (ids, _) = index.query(
-                query_vector, num_results, n_probes=num_probes
+            dists, (ids, _) = index.query_batch(
+                query_vectors,
+                num_results,
+                n_probes=num_probes,
+                allowed_ids=allowed_ids,
             )
-            assert len(ids) == 1 and len(dists) == 1
-            lowest_dist = np.min(dists)
-            highest_dist = np.max(dists)
-
-            sorted_results = []
-            for i, d in zip(ids[0], dists[0]):
-                i, d = int(i), float(d)  # cast numpy types
-                d = (d - lowest_dist) / (highest_dist - lowest_dist)  # normalize
-                if svm:
-                    d = 1.0 - d  # invert
-                if i >= 0 and min_d <= d <= max_d:
-                    sorted_results.append(LabeledIndex.QueryResult(i, d))
+            assert len(ids) == len(query_vectors) and len(dists) == len(query_vectors)
+
+            results_by_vector = [
+                self._full_image_query_results(ids_row, dists_row, svm, min_d, max_d)
+                for ids_row, dists_row in zip(ids, dists)
+            ]
         else:
             assert (
                 min_d == 0.0 and max_d == 1.0
@@ -252,47 +671,179 @@ class LabeledIndex:
                 # TODO(mihirg): Set num_results properly
                 num_results = config.QUERY_NUM_RESULTS_MULTIPLE * len(self.labels)
                 num_probes = index.n_centroids
+                adaptive = False
 
-            dists, (ids, locs) = index.query(
-                query_vector,
-                config.QUERY_NUM_RESULTS_MULTIPLE * num_results,
-                n_probes=num_probes,
-            )
-            assert len(ids) == 1 and len(locs) == 1 and len(dists) == 1
-
-            # Gather lowest QUERY_PATCHES_PER_IMAGE distances for each image
-            dists_by_id: DefaultDict[int, List[float]] = defaultdict(list)
-            spatial_dists_by_id: DefaultDict[
-                int, List[Tuple[int, float]]
-            ] = defaultdict(list)
-            for i, l, d in zip(ids[0], locs[0], dists[0]):
-                i, l, d = int(i), int(l), float(d)  # cast numpy types
-                if i >= 0 and len(dists_by_id[i]) < config.QUERY_PATCHES_PER_IMAGE:
-                    dists_by_id[i].append(d)
-                    spatial_dists_by_id[i].append((l, d))
-
-            # Average them and resort
-            result_gen = (
-                LabeledIndex.QueryResult(i, sum(ds) / len(ds), spatial_dists_by_id[i])
-                for i, ds in dists_by_id.items()
-                if len(ds) == config.QUERY_PATCHES_PER_IMAGE
-            )
-            sorted_results = heapq.nsmallest(
-                num_results, result_gen, operator.attrgetter("dist")
-            )
+            if adaptive:
+                results_by_vector, n_rounds = self._adaptive_spatial_query(
+                    index, query_vectors, num_results, num_probes, allowed_ids
+                )
+            else:
+                dists, (ids, locs) = index.query_batch(
+                    query_vectors,
+                    config.QUERY_NUM_RESULTS_MULTIPLE * num_results,
+                    n_probes=num_probes,
+                    allowed_ids=allowed_ids,
+                )
+                assert (
+                    len(ids) == len(query_vectors)
+                    and len(locs) == len(query_vectors)
+                    and len(dists) == len(query_vectors)
+                )
+
+                results_by_vector = [
+                    self._spatial_query_results(
+                        ids_row, locs_row, dists_row, num_results
+                    )
+                    for ids_row, locs_row, dists_row in zip(ids, locs, dists)
+                ]
 
         end = time.perf_counter()
         self.logger.debug(
-            f"Query of size {query_vector.shape} with k={num_results}, "
+            f"Query of size {query_vectors.shape} with k={num_results}, "
             f"n_probes={num_probes}, n_centroids={index.n_centroids}, and "
-            f"n_vectors={index.n_vectors} took {end - start:.3f}s, and "
-            f"got {len(sorted_results)} results."
+            f"n_vectors={index.n_vectors} took {end - start:.3f}s"
+            + (f" over {n_rounds} adaptive rounds" if n_rounds else "")
+            + f", and got {sum(map(len, results_by_vector))} results."
         )
 
-        for result in sorted_results:
+        for result in itertools.chain.from_iterable(results_by_vector):
             result.label = self.labels[result.id]
+
+        if not deduplicate:
+            return results_by_vector
+
+        # Remove duplicates; for each image, include closest result
+        closest_results: Dict[int, LabeledIndex.QueryResult] = {}
+        for result in itertools.chain.from_iterable(results_by_vector):
+            if (
+                result.id not in closest_results
+                or closest_results[result.id].dist > result.dist
+            ):
+                closest_results[result.id] = result
+        return list(closest_results.values())
+
+    def _adaptive_spatial_query(
+        self,
+        index: InteractiveIndex,
+        query_vectors: np.ndarray,
+        num_results: int,
+        num_probes: Optional[int],
+        allowed_ids: Optional[np.ndarray],
+    ) -> Tuple[List[List[QueryResult]], int]:  # results by vector, number of rounds
+        # Iterative deepening: start with few patch hits per query vector and search
+        # again, for geometrically more, only for the vectors that don't yet have
+        # num_results images with a full set of patches. Visit more lists only when
+        # a vector has run out of hits in the ones already probed.
+        growth = config.ADAPTIVE_QUERY_GROWTH_FACTOR
+        k = config.ADAPTIVE_QUERY_INITIAL_RESULTS_MULTIPLE * num_results
+        max_k = config.QUERY_NUM_RESULTS_MULTIPLE * num_results
+        n_probes = num_probes or index.n_probes
+
+        results_by_vector: List[List[LabeledIndex.QueryResult]] = [
+            [] for _ in query_vectors
+        ]
+        pending = list(range(len(query_vectors)))
+        n_rounds = 0
+        while True:
+            n_rounds += 1
+            dists, (ids, locs) = index.query_batch(
+                query_vectors[pending],
+                min(k, max_k),
+                n_probes=n_probes,
+                allowed_ids=allowed_ids,
+            )
+
+            still_pending = []
+            ran_out = False
+            for row, vector_ind in enumerate(pending):
+                results = self._spatial_query_results(
+                    ids[row], locs[row], dists[row], num_results
+                )
+                results_by_vector[vector_ind] = results
+                if len(results) < num_results:
+                    still_pending.append(vector_ind)
+                    ran_out |= bool(np.any(ids[row] < 0))
+            pending = still_pending
+
+            can_grow_k = k < max_k
+            can_grow_probes = ran_out and n_probes < index.n_centroids
+            if not pending or not (can_grow_k or can_grow_probes):
+                return results_by_vector, n_rounds
+
+            k *= growth
+            if can_grow_probes:
+                n_probes = min(n_probes * growth, index.n_centroids)
+
+    @staticmethod
+    def _full_image_query_results(
+        ids: np.ndarray,
+        dists: np.ndarray,
+        svm: bool,
+        min_d: float,
+        max_d: float,
+    ) -> List[QueryResult]:
+        # Rows with fewer hits than requested are padded with ID -1 and a huge
+        # distance, which mustn't skew the normalization
+        hit_dists = dists[ids >= 0]
+        if not len(hit_dists):
+            return []
+        lowest_dist = np.min(hit_dists)
+        dist_range = (np.max(hit_dists) - lowest_dist) or 1.0
+
+        sorted_results = []
+        for i, d in zip(ids, dists):
+            i, d = int(i), float(d)  # cast numpy types
+            d = (d - lowest_dist) / dist_range  # normalize
+            if svm:
+                d = 1.0 - d  # invert
+            if i >= 0 and min_d <= d <= max_d:
+                sorted_results.append(LabeledIndex.QueryResult(i, d))
         return sorted_results
 
+    @staticmethod
+    def _spatial_query_results(
+        ids: np.ndarray,
+        locs: np.ndarray,
+        dists: np.ndarray,
+        num_results: int,
+    ) -> List[QueryResult]:
+        # Gather the first QUERY_PATCHES_PER_IMAGE hits (i.e., the lowest distances)
+        # for each image: group hits by image with a stable sort, then keep each
+        # group's leading entries
+        n_patches = config.QUERY_PATCHES_PER_IMAGE
+        hit_inds = np.flatnonzero(ids >= 0)
+        hit_inds = hit_inds[np.argsort(ids[hit_inds], kind="stable")]
+        grouped_ids = ids[hit_inds]
+        is_group_start = np.empty(len(grouped_ids), dtype=bool)
+        is_group_start[:1] = True
+        np.not_equal(grouped_ids[1:], grouped_ids[:-1], out=is_group_start[1:])
+        group_starts = np.flatnonzero(is_group_start)
+        group_sizes = np.diff(np.append(group_starts, len(grouped_ids)))
+
+        # Only images with a full set of patches count
+        full_group_starts = group_starts[group_sizes >= n_patches]
+        patch_inds = hit_inds[full_group_starts[:, None] + np.arange(n_patches)]
+
+        # Average them (summing left to right, as sum() would) and resort, breaking
+        # ties by where each image first appeared in the hits
+        patch_dists = dists[patch_inds].astype(np.float64)
+        mean_dists = patch_dists[:, 0].copy()
+        for j in range(1, n_patches):
+            mean_dists += patch_dists[:, j]
+        mean_dists /= n_patches
+        order = np.lexsort((patch_inds[:, 0], mean_dists))[:num_results]
+
+        result_ids = ids[patch_inds[order, 0]].tolist()
+        result_dists = mean_dists[order].tolist()
+        result_locs = locs[patch_inds[order]].tolist()
+        result_patch_dists = patch_dists[order].tolist()
+        return [
+            LabeledIndex.QueryResult(i, d, list(zip(ls, ds)))
+            for i, d, ls, ds in zip(
+                result_ids, result_dists, result_locs, result_patch_dists
+            )
+        ]
+
     def query_farthest(
         self,
         query_vector: np.ndarray,
@@ -341,6 +892,16 @@ class LabeledIndex:
         assert self.val_identifiers is not None
         return list(self.val_identifiers.keys())
 
+    def get_identifiers_by_ind(self) -> List[str]:
+        assert self.train_identifiers is not None
+        assert self.val_identifiers is not None
+        identifiers = [""] * len(self.labels)
+        for id, i in itertools.chain(
+            self.train_identifiers.items(), self.val_identifiers.items()
+        ):
+            identifiers[i] = id
+        return identifiers
+
     def identifiers_to_inds(self, identifiers: Iterable[str]) -> List[int]:
         assert self.train_identifiers is not None
         assert self.val_identifiers is not None
@@ -352,6 +913,21 @@ class LabeledIndex:
         ]
         return inds
 
+    def decode_allowed_inds(self, allowed_inds: Optional[str]) -> Optional[np.ndarray]:
+        # Clients send the allowed rows as a base64-encoded .npy array of row indices
+        # into the index's identifiers, or nothing if all rows are allowed
+        if allowed_inds is None:
+            return None
+
+        assert self.train_identifiers is not None
+        assert self.val_identifiers is not None
+        n_rows = len(self.train_identifiers) + len(self.val_identifiers)
+        inds = utils.base64_to_numpy(allowed_inds)
+        if inds is None:  # empty encoding
+            return np.empty(0, dtype=np.int64)
+        inds = np.unique(inds.astype(np.int64))
+        return inds[(0 <= inds) & (inds < n_rows)]
+
     def get_embeddings(
         self, identifiers: Iterable[str], model: str = config.DEFAULT_QUERY_MODEL
     ) -> np.ndarray:
@@ -369,9 +945,22 @@ class LabeledIndex:
         self, identifiers: Iterable[str], model: str = config.DEFAULT_QUERY_MODEL
     ) -> List[List[float]]:
         start_time = time.perf_counter()
-        embeddings = self.get_embeddings(identifiers, model)
+        identifiers = list(identifiers)
+        local_flat_index = self.get_local_flat_index(model)
+        if len(identifiers) >= config.APPROX_CLUSTERING_MIN_SIZE:
+            # Exact linkage needs quadratic memory; approximate it instead
+            embeddings = self.get_embeddings(identifiers, model)
+            cluster = self._cluster_approximate
+        elif local_flat_index.distance_matrix is not None:
+            # Read the precomputed pairwise distances rather than the embeddings
+            inds = self.identifiers_to_inds(identifiers)
+            embeddings = local_flat_index.distance_matrix.condensed(inds)
+            cluster = self._cluster
+        else:
+            embeddings = self.get_embeddings(identifiers, model)
+            cluster = self._cluster
         middle_time = time.perf_counter()
-        ret = self._cluster(embeddings)
+        ret = cluster(embeddings)
         end_time = time.perf_counter()
         print(
             f"Clustering took {end_time - start_time} seconds - {middle_time - start_time} to read embeddings + {end_time - middle_time} to perform clustering"
@@ -379,18 +968,117 @@ class LabeledIndex:
         return ret
 
     def _cluster(self, embeddings: np.ndarray) -> List[List[float]]:
-        # Perform hierarchical clustering
-        result = fastcluster.linkage(embeddings, method="ward", preserve_input=False)
-        max_dist = result[-1, 2]
+        # Perform hierarchical clustering; embeddings can also be a condensed distance
+        # matrix (see CondensedDistanceMatrix)
+        return self._normalize_merges(self._ward_merges(embeddings))
+
+    def _cluster_approximate(self, embeddings: np.ndarray) -> List[List[float]]:
+        # PCA-reduce the embeddings, group them into micro-clusters with mini-batch
+        # k-means, then Ward-link each micro-cluster's members and, finally, the
+        # micro-clusters themselves (by centroid, weighted by size). The result is in
+        # the same simplified format as _cluster.
+        reduced = PCA(
+            n_components=min(config.APPROX_CLUSTERING_PCA_DIM, *embeddings.shape),
+            svd_solver="randomized",
+            random_state=0,
+        ).fit_transform(embeddings)
+        labels = MiniBatchKMeans(
+            n_clusters=min(config.APPROX_CLUSTERING_NUM_CLUSTERS, len(reduced)),
+            batch_size=config.APPROX_CLUSTERING_BATCH_SIZE,
+            random_state=0,
+        ).fit_predict(reduced)
+
+        merges: List[List[float]] = []
+        reps, sizes, centroids, heights = [], [], [], []
+        members_by_label = np.split(
+            np.argsort(labels, kind="stable"),
+            np.flatnonzero(np.diff(np.sort(labels))) + 1,
+        )
+        for members in members_by_label:
+            if len(members) > 1:
+                member_merges = self._ward_merges(reduced[members])
+                merges.extend(
+                    [int(members[a]), int(members[b]), h] for a, b, h in member_merges
+                )
+                reps.append(int(members[member_merges[-1][0]]))
+                heights.append(member_merges[-1][2])
+            else:
+                reps.append(int(members[0]))
+                heights.append(0.0)
+            sizes.append(len(members))
+            centroids.append(reduced[members].mean(axis=0))
+
+        merges.extend(self._weighted_ward_merges(centroids, sizes, reps, heights))
+
+        # Every merge is at least as high as the merges it depends on, so a stable
+        # sort keeps them in a valid order
+        merges.sort(key=operator.itemgetter(2))
+        return self._normalize_merges(merges)
+
+    @staticmethod
+    def _ward_merges(embeddings: np.ndarray) -> List[List[float]]:
+        # Ward linkage as [cluster a, cluster b, height] merges, where each cluster is
+        # identified by its first point (that of cluster a after a merge)
+        result = fastcluster.linkage(
+            embeddings.astype(np.float64), method="ward", preserve_input=False
+        )
 
         # Simplify dendogram matrix by using original cluster indexes
-        simplified = []
-        clusters = list(range(len(embeddings)))
+        merges = []
+        clusters = list(range(len(result) + 1))
         for a, b, dist, _ in result:
             a, b = int(a), int(b)
-            simplified.append([clusters[a], clusters[b], dist / max_dist])
+            merges.append([clusters[a], clusters[b], float(dist)])
             clusters.append(clusters[a])
-        return simplified
+        return merges
+
+    @staticmethod
+    def _weighted_ward_merges(
+        centroids: List[np.ndarray],
+        sizes: List[int],
+        reps: List[int],
+        heights: List[float],
+    ) -> List[List[float]]:
+        # Ward linkage of clusters with the given centroids and sizes, using the same
+        # distance as fastcluster: sqrt(2 |A| |B| / (|A| + |B|)) ||c_A - c_B||. Heights
+        # are raised where needed to stay at least those of the merged clusters.
+        centroids_arr = np.array(centroids, dtype=np.float64)
+        sizes_arr = np.array(sizes, dtype=np.float64)
+        heights = list(heights)
+        sq_dists = cdist(centroids_arr, centroids_arr, "sqeuclidean")
+        active = np.ones(len(centroids_arr), dtype=bool)
+
+        merges = []
+        for _ in range(len(centroids_arr) - 1):
+            costs = (
+                2
+                * np.outer(sizes_arr, sizes_arr)
+                / np.add.outer(sizes_arr, sizes_arr)
+                * sq_dists
+            )
+            costs[~active, :] = np.inf
+            costs[:, ~active] = np.inf
+            np.fill_diagonal(costs, np.inf)
+            i, j = np.unravel_index(np.argmin(costs), costs.shape)
+
+            height = max(math.sqrt(costs[i, j]), heights[i], heights[j])
+            merges.append([reps[i], reps[j], height])
+
+            # Merge j into i
+            centroids_arr[i] = (
+                sizes_arr[i] * centroids_arr[i] + sizes_arr[j] * centroids_arr[j]
+            ) / (sizes_arr[i] + sizes_arr[j])
+            sizes_arr[i] += sizes_arr[j]
+            heights[i] = height
+            active[j] = False
+            sq_dists[i, :] = np.sum((centroids_arr - centroids_arr[i]) ** 2, axis=1)
+            sq_dists[:, i] = sq_dists[i, :]
+        return merges
+
+    @staticmethod
+    def _normalize_merges(merges: List[List[float]]) -> List[List[float]]:
+        max_dist = max(dist for _, _, dist in merges)
+        return [[a, b, dist / max_dist] for a, b, dist in merges]
 
     def get_model_scores(
         self, model: str, identifiers: Optional[Iterable[str]] = None
@@ -592,6 +1280,14 @@ class LabeledIndex:
             await utils.run_in_executor(self.local_flat_index.build_distance_matrix)
             self.logger.info("Local flat index: finished building distance matrix")
 
+            if config.LOCAL_INDEX_QUANTIZATION:
+                await utils.run_in_executor(
+                    self.local_flat_index.build_quantized_index,
+                    self.index_dir,
+                    config.LOCAL_INDEX_QUANTIZATION,
+                )
+                self.logger.info("Local flat index: finished quantizing embeddings")
+
     def start_training(
         self,
         mapper_result: MapperReducer.Result,
@@ -685,6 +1381,7 @@ class LabeledIndex:
             n_retries=config.ADDER_NUM_RETRIES,
             chunk_size=chunk_size,
             request_timeout=config.ADDER_REQUEST_TIMEOUT,
+            finalize_mappers=True,  # adders write out their last shards
         )
         await self.adder_job.start(
             self.mapper_job.reducer.output_path_tmpl_gen(),
@@ -744,9 +1441,15 @@ class LabeledIndex:
             futures = []
             for index_type, index in self.indexes.items():
                 index_dir = self.training_jobs[index_type].mounted_index_dir
+                progress = self.merge_progress[index_type] = MergeProgress()
                 future = asyncio.ensure_future(
                     loop.run_in_executor(
-                        pool, self.merge_index, index, shard_patterns, index_dir
+                        pool,
+                        self.merge_index,
+                        index,
+                        shard_patterns,
+                        index_dir,
+                        progress,
                     )
                 )
                 self.logger.info(f"Merge ({index_type.name}): started")
@@ -771,13 +1474,22 @@ class LabeledIndex:
         self.cluster_unlock_fn()
 
     @staticmethod
-    def merge_index(index: InteractiveIndex, shard_patterns: Set[str], index_dir: Path):
+    def merge_index(
+        index: InteractiveIndex,
+        shard_patterns: Set[str],
+        index_dir: Path,
+        progress: Optional[MergeProgress] = None,
+    ):
         shard_paths = [
             str(p.resolve())
             for shard_pattern in shard_patterns
             for p in index_dir.glob(shard_pattern)
         ]
-        index.merge_partial_indexes(shard_paths)
+        index.merge_partial_indexes(
+            shard_paths,
+            n_threads=config.LOCAL_INDEX_MERGING_NUM_THREADS,
+            progress=progress,
+        )
 
     async def upload(self):
         # Dump labels, identifiers, full-image embeddings, and distance matrix
@@ -816,6 +1528,10 @@ class LabeledIndex:
                 for index_type, job in self.training_jobs.items()
             },
             "resize": self.resizer_job.status if self.resizer_job else {},
+            "merge": {
+                index_type.name: progress.to_dict()
+                for index_type, progress in self.merge_progress.items()
+            },
         }
 
     # INDEX LOADING
@@ -884,6 +1600,66 @@ class LabeledIndex:
 app = Sanic(__name__)
 app.update_config({"RESPONSE_TIMEOUT": config.SANIC_RESPONSE_TIMEOUT})
 
+# CPU-heavy request handling runs here so the event loop stays free for I/O (e.g.,
+# training status updates)
+cpu_executor = BoundedExecutor(
+    config.CPU_EXECUTOR_NUM_THREADS, config.CPU_EXECUTOR_MAX_QUEUED, "cpu"
+)
+
+
+@app.exception(ExecutorBusyError)
+async def executor_busy(request, exception):
+    return resp.json({"reason": str(exception)}, status=503)
+
+
+@app.route("/cpu_executor_stats", methods=["GET"])
+async def cpu_executor_stats(request):
+    return resp.json(cpu_executor.get_stats())
+
+
+# COORDINATOR
+# With config.SERVER_NUM_WORKERS > 1, clusters, jobs and the registry of indexes being
+# built or downloaded live only in the coordinator process; other workers forward
+# requests that touch them (see __main__)
+
+
+is_coordinator = True
+coordinator_url = f"http://127.0.0.1:{config.COORDINATOR_PORT}"
+coordinator_session: Optional[aiohttp.ClientSession] = None
+
+
+def get_coordinator_session() -> aiohttp.ClientSession:
+    global coordinator_session
+    if coordinator_session is None:
+        coordinator_session = aiohttp.ClientSession(
+            timeout=aiohttp.ClientTimeout(total=config.SANIC_RESPONSE_TIMEOUT)
+        )
+    return coordinator_session
+
+
+def coordinator_only(handler):
+    @functools.wraps(handler)
+    async def wrapper(request, *args, **kwargs):
+        if is_coordinator:
+            return await handler(request, *args, **kwargs)
+
+        url = coordinator_url + request.path
+        if request.query_string:
+            url += f"?{request.query_string}"
+        async with get_coordinator_session().request(
+            request.method,
+            url,
+            data=request.body,
+            headers={"Content-Type": request.content_type},
+        ) as response:
+            return resp.raw(
+                await response.read(),
+                status=response.status,
+                content_type=response.content_type,
+            )
+
+    return wrapper
+
 
 # CLUSTER
 
@@ -938,6 +1714,7 @@ current_clusters: CleanupDict[str, TerraformModule] = CleanupDict(
 
 
 @app.route("/start_cluster", methods=["POST"])
+@coordinator_only
 async def start_cluster(request):
     cluster = TerraformModule(
         config.CLUSTER_TERRAFORM_MODULE_PATH, copy=not config.CLUSTER_REUSE_EXISTING
@@ -949,6 +1726,7 @@ async def start_cluster(request):
 
 
 @app.route("/cluster_status", methods=["GET"])
+@coordinator_only
 async def cluster_status(request):
     cluster_id = request.args["cluster_id"][0]
     cluster = current_clusters.get(cluster_id)
@@ -962,6 +1740,7 @@ async def cluster_status(request):
 
 
 @app.route("/stop_cluster", methods=["POST"])
+@coordinator_only
 async def stop_cluster(request):
     cluster_id = request.json["cluster_id"]
     app.add_task(current_clusters.cleanup_key(cluster_id))
@@ -980,6 +1759,7 @@ current_indexes: CleanupDict[str, LabeledIndex] = CleanupDict(
 
 
 @app.route("/start_job", methods=["POST"])
+@coordinator_only
 async def start_job(request):
     cluster_id = request.json["cluster_id"]
     bucket = request.json["bucket"]
@@ -999,6 +1779,7 @@ async def start_job(request):
 
 
 @app.route(config.TRAINER_STATUS_ENDPOINT, methods=["PUT"])
+@coordinator_only
 async def training_status(request):
     index_id = request.json["index_id"]
     if index_id in current_indexes:
@@ -1007,6 +1788,7 @@ async def training_status(request):
 
 
 @app.route("/job_status", methods=["GET"])
+@coordinator_only
 async def job_status(request):
     index_id = request.args["index_id"][0]
     if index_id in current_indexes:
@@ -1020,6 +1802,7 @@ async def job_status(request):
 
 # TODO(mihirg): Do we even need this function? It's not exposed on the frontend.
 @app.route("/stop_job", methods=["POST"])
+@coordinator_only
 async def stop_job(request):
     index_id = request.json["index_id"]
     app.add_task(current_indexes.cleanup_key(index_id))
@@ -1034,6 +1817,7 @@ current_models: CleanupDict[str, BGSplitTrainingJob] = CleanupDict(
 
 
 @app.route("/start_bgsplit_job", methods=["POST"])
+@coordinator_only
 async def start_bgsplit_job(request):
     logger.info(f"Train request received")
     # HACK(mihirg): sometimes we get empty identifiers (i.e., "") from the server that
@@ -1165,6 +1949,7 @@ async def start_bgsplit_job(request):
 
 
 @app.route(config.BGSPLIT_TRAINER_STATUS_ENDPOINT, methods=["PUT"])
+@coordinator_only
 async def bgsplit_training_status(request):
     model_id = request.json["model_id"]
     if model_id in current_models:
@@ -1173,6 +1958,7 @@ async def bgsplit_training_status(request):
 
 
 @app.route("/bgsplit_job_status", methods=["GET"])
+@coordinator_only
 async def bgsplit_job_status(request):
     model_id = request.args["model_id"][0]
     if model_id in current_models:
@@ -1191,6 +1977,7 @@ current_model_inference_jobs: CleanupDict[str, BGSplitInferenceJob] = CleanupDic
 
 
 @app.route("/start_bgsplit_inference_job", methods=["POST"])
+@coordinator_only
 async def start_bgsplit_inference_job(request):
     # HACK(mihirg): sometimes we get empty identifiers (i.e., "") from the server that
     # would otherwise cause a crash here; we should probably figure out why this is, but
@@ -1234,6 +2021,7 @@ async def start_bgsplit_inference_job(request):
 
 
 @app.route("/bgsplit_inference_job_status", methods=["GET"])
+@coordinator_only
 async def bgsplit_inference_job_status(request):
     job_id = request.args["job_id"][0]
     if job_id in current_model_inference_jobs:
@@ -1246,6 +2034,7 @@ async def bgsplit_inference_job_status(request):
 
 
 @app.route("/stop_bgsplit_inference_job", methods=["POST"])
+@coordinator_only
 async def bgsplit_inference_job_status(request):
     job_id = request.args["job_id"][0]
     if job_id in current_model_inference_jobs:
@@ -1270,6 +2059,7 @@ async def _download_index(index_id):
 
 
 @app.route("/download_index", methods=["POST"])
+@coordinator_only
 async def download_index(request):
     index_id = request.json["index_id"]
     app.add_task(_download_index(index_id))
@@ -1278,6 +2068,7 @@ async def download_index(request):
 
 # TODO(mihirg): Do we even need this function?
 @app.route("/delete_index", methods=["POST"])
+@coordinator_only
 async def delete_index(request):
     index_id = request.json["index_id"]
     await current_indexes.pop(index_id).delete()
@@ -1291,14 +2082,203 @@ async def delete_index(request):
 
 async def get_index(index_id) -> LabeledIndex:
     if index_id not in current_indexes:
+        if not is_coordinator:
+            # Have the coordinator load (and finish downloading) the index first so
+            # that all of its files are on disk
+            async with get_coordinator_session().post(
+                f"{coordinator_url}/load_index", json={"index_id": index_id}
+            ) as response:
+                response.raise_for_status()
         current_indexes[index_id] = await LabeledIndex.load(index_id)
     return current_indexes[index_id]
 
 
+@app.route("/load_index", methods=["POST"])
+@coordinator_only
+async def load_index(request):
+    index = await get_index(request.json["index_id"])
+    await index.ready.wait()
+    return resp.text("", status=204)
+
+
+class BruteForceQueryBatcher:
+    # Collects concurrent brute-force queries over all rows of the same index and model
+    # for up to max_wait seconds (or until max_size have arrived) and runs them as one
+    # batch, so the local flat index is only scanned once
+
+    @dataclass_json
+    @dataclass
+    class Stats:
+        n_batches: int = 0
+        n_queries: int = 0
+        max_batch_size: int = 0
+        total_wait_time: float = 0.0  # seconds, summed over queries
+        max_wait_time: float = 0.0
+
+    BatchKey = Tuple[str, str]  # index id, model
+    PendingQuery = Tuple[LabeledIndex.BruteForceQuery, asyncio.Future, float]
+
+    def __init__(self, max_size: int, max_wait: float):
+        self.max_size = max_size
+        self.max_wait = max_wait
+        self.pending: Dict[BruteForceQueryBatcher.BatchKey, List] = {}
+        self.stats = BruteForceQueryBatcher.Stats()
+
+    async def query(
+        self,
+        index_id: str,
+        index: LabeledIndex,
+        model: str,
+        query: LabeledIndex.BruteForceQuery,
+    ) -> Tuple[np.ndarray, np.ndarray]:  # ids, dists
+        key = (index_id, model)
+        future = asyncio.get_running_loop().create_future()
+        batch = self.pending.setdefault(key, [])
+        batch.append((query, future, time.perf_counter()))
+
+        if len(batch) >= self.max_size:
+            self._run(key, index, model)
+        elif len(batch) == 1:
+            asyncio.create_task(self._run_after_wait(key, index, model, batch))
+        return await future
+
+    async def _run_after_wait(
+        self, key: BatchKey, index: LabeledIndex, model: str, batch: List
+    ):
+        await asyncio.sleep(self.max_wait)
+        if self.pending.get(key) is batch:  # not already run because it filled up
+            self._run(key, index, model)
+
+    def _run(self, key: BatchKey, index: LabeledIndex, model: str):
+        batch: List[BruteForceQueryBatcher.PendingQuery] = self.pending.pop(key)
+
+        now = time.perf_counter()
+        wait_times = [now - enqueue_time for _, _, enqueue_time in batch]
+        self.stats.n_batches += 1
+        self.stats.n_queries += len(batch)
+        self.stats.max_batch_size = max(self.stats.max_batch_size, len(batch))
+        self.stats.total_wait_time += sum(wait_times)
+        self.stats.max_wait_time = max(self.stats.max_wait_time, max(wait_times))
+
+        asyncio.create_task(self._compute(index, model, batch))
+
+    async def _compute(self, index: LabeledIndex, model: str, batch: List):
+        try:
+            results = await cpu_executor.run(
+                index.query_brute_force_batch_columnar,
+                [query for query, _, _ in batch],
+                model,
+            )
+        except Exception as e:
+            for _, future, _ in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for (_, future, _), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+
+
+brute_force_batcher = BruteForceQueryBatcher(
+    config.BRUTE_FORCE_BATCH_MAX_SIZE, config.BRUTE_FORCE_BATCH_MAX_WAIT
+)
+
+
+async def query_brute_force_columnar(
+    index_id: str,
+    index: LabeledIndex,
+    model: str,
+    query: LabeledIndex.BruteForceQuery,
+    allowed_inds: Optional[np.ndarray],
+) -> Tuple[np.ndarray, np.ndarray]:  # ids, dists
+    # Unfiltered queries scan the same rows, so they can share a batch
+    if allowed_inds is None:
+        return await brute_force_batcher.query(index_id, index, model, query)
+    results = await cpu_executor.run(
+        index.query_brute_force_batch_columnar, [query], model, allowed_inds
+    )
+    return results[0]
+
+
+def wants_columnar_results(request) -> bool:
+    return request.json.get("result_format") == "columnar"
+
+
+def columnar_results_response(ids: np.ndarray, dists: np.ndarray):
+    # Parallel id and distance arrays instead of one JSON object (with a label) per
+    # result; ids are row indices into the index's identifiers
+    return resp.json(
+        {
+            "format": "columnar",
+            "ids": utils.numpy_to_base64(ids.astype("<i4")),
+            "dists": utils.numpy_to_base64(dists.astype("<f4")),
+        }
+    )
+
+
 def extract_embedding_from_mapper_output(output: str) -> np.ndarray:
     return np.squeeze(utils.base64_to_numpy(output), axis=0)
 
 
+embedding_cache = EmbeddingCache(
+    config.EMBEDDING_CACHE_DIR,
+    config.EMBEDDING_CACHE_MAX_MEMORY,
+    config.EMBEDDING_CACHE_MAX_DISK,
+)
+
+
+class CachingEmbeddingReducer(Reducer):
+    def __init__(self):
+        self.embeddings: Dict[str, np.ndarray] = {}
+
+    def handle_result(self, input: JSONType, output: str):
+        embedding = extract_embedding_from_mapper_output(output)
+        embedding_cache.put(input["cache_key"], embedding)
+        self.embeddings[input["cache_key"]] = embedding
+
+    @property
+    def result(self) -> Dict[str, np.ndarray]:  # cache key -> embedding
+        return self.embeddings
+
+
+async def compute_embeddings(
+    mapper: MapperSpec,
+    mapper_args: JSONType,
+    inputs: List[JSONType],
+    log_id_string: str = "",
+) -> List[Optional[np.ndarray]]:
+    # Embeddings for the given mapper inputs, in order (None if the mapper failed on
+    # one); only those not already in the embedding cache are computed
+    mapper_id = {
+        "mapper": mapper.url or mapper.container,
+        "model": config.MAPPER_MODEL_VERSION,
+    }
+    keys = [EmbeddingCache.key(mapper_id, mapper_args, input) for input in inputs]
+    embeddings = {key: embedding_cache.get(key) for key in keys}
+    uncached_inputs = {
+        key: {**input, "cache_key": key}
+        for key, input in zip(keys, inputs)
+        if embeddings[key] is None
+    }
+
+    if uncached_inputs:
+        job = MapReduceJob(
+            mapper,
+            CachingEmbeddingReducer(),
+            mapper_args,
+            n_retries=config.CLOUD_RUN_N_RETRIES,
+            chunk_size=1,
+        )
+        embeddings.update(await job.run_until_complete(list(uncached_inputs.values())))
+        logger.info(
+            f"{log_id_string} - Computed {len(uncached_inputs)} embeddings "
+            f"({len(keys) - len(uncached_inputs)} cached) in {job.elapsed_time:.3f}s"
+        )
+        logger.debug(f"{log_id_string} - Embedding performance: {job.performance}")
+    return [embeddings[key] for key in keys]
+
+
 class BestMapper:
     def __init__(self, cluster_id: str):
         self.cluster_id = cluster_id
@@ -1324,7 +2304,14 @@ class BestMapper:
             current_clusters.unlock(self.cluster_id, self.lock_id)
 
 
+@app.route("/embedding_cache_stats", methods=["GET"])
+@coordinator_only  # the only process that computes embeddings with the mapper
+async def embedding_cache_stats(request):
+    return resp.json(embedding_cache.stats.to_dict())
+
+
 @app.route("/query_index", methods=["POST"])
+@coordinator_only
 async def query_index(request):
     image_paths = request.json["paths"]
     identifiers = request.json["identifiers"]
@@ -1343,22 +2330,15 @@ async def query_index(request):
         augmentation_dict[augmentations[2 * i]] = float(augmentations[2 * i + 1])
 
     use_full_image = bool(request.json.get("use_full_image", False))
+    adaptive = bool(request.json.get("adaptive", config.ADAPTIVE_SPATIAL_QUERIES))
 
     index = await get_index(index_id)
 
     # Generate query vector as average of patch embeddings
     async with BestMapper(cluster_id) as mapper:
-        job = MapReduceJob(
+        embeddings = await compute_embeddings(
             mapper,
-            VectorReducer(
-                VectorReducer.PoolingType.AVG,
-                extract_func=extract_embedding_from_mapper_output,
-            ),
             {"input_bucket": bucket, "reduction": "average"},
-            n_retries=config.CLOUD_RUN_N_RETRIES,
-            chunk_size=1,
-        )
-        query_vector = await job.run_until_complete(
             [
                 {
                     "image": image_path,
@@ -1366,15 +2346,30 @@ async def query_index(request):
                     "augmentations": augmentation_dict,
                 }
                 for image_path, patch in zip(image_paths, patches)
-            ]
+            ],
         )
+    query_vector = np.mean([e for e in embeddings if e is not None], axis=0)
 
     # Run query and return results
-    query_results = index.query(query_vector, num_results, None, use_full_image, False)
+    query_results = await cpu_executor.run(
+        index.query,
+        query_vector,
+        num_results,
+        None,
+        use_full_image,
+        False,
+        adaptive=adaptive,
+    )
+    if wants_columnar_results(request):
+        return columnar_results_response(
+            np.array([r.id for r in query_results], dtype=np.int64),
+            np.array([r.dist for r in query_results], dtype=np.float32),
+        )
     return resp.json({"results": [r.to_dict() for r in query_results]})
 
 
 @app.route("/active_batch", methods=["POST"])
+@coordinator_only
 async def active_batch(request):
     image_paths = request.json["paths"]  # Paths of seed images (at first from google)
     bucket = request.json["bucket"]
@@ -1393,63 +2388,36 @@ async def active_batch(request):
 
     # Generate query vector as average of patch embeddings
     async with BestMapper(cluster_id) as mapper:
-        job = MapReduceJob(
+        embeddings = await compute_embeddings(
             mapper,
-            VectorReducer(extract_func=extract_embedding_from_mapper_output),
             {"input_bucket": bucket, "reduction": "average"},
-            n_retries=config.CLOUD_RUN_N_RETRIES,
-            chunk_size=1,
-        )
-        query_vectors = await job.run_until_complete(
             [
                 {"image": image_path, "augmentations": augmentation_dict}
                 for image_path in image_paths
-            ]
+            ],
         )
+    query_vectors = np.stack([e for e in embeddings if e is not None])
 
-    all_results = {}
     # Results per vector
     perVector = (int)(num_results / len(query_vectors)) + 2
-    for vec in query_vectors:
-        # Return nearby images
-        query_results = index.query(
-            np.float32(vec),
-            perVector,
-            None,
-            use_full_image,
-            False,  # False bc just standard nearest neighbor
-        )
-
-        # Remove duplicates; for each image, include closest result
-        for result in query_results:
-            label = result.label
-            if label not in all_results or all_results[label].dist > result.dist:
-                all_results[label] = result
+    # Return nearby images; for each image, include closest result
+    query_results = await cpu_executor.run(
+        index.query_batch,
+        np.float32(query_vectors),
+        perVector,
+        None,
+        use_full_image,
+        False,  # False bc just standard nearest neighbor
+        deduplicate=True,
+    )
 
     return resp.json(
-        {"results": [r.to_dict() for r in all_results.values()]}
+        {"results": [r.to_dict() for r in query_results]}
     )  # unordered by distance for now
 
 
-# TODO(mihirg): Reuse these instances (maybe in an ExpiringDict, storing embeddings in
-# a Chest internally?) to cache embeddings and speed up repeatedly iterating on training
-# an SVM on a particular dataset
-class SVMExampleReducer(Reducer):
-    def __init__(self):
-        self.labels: List[int] = []
-        self.embeddings: List[np.ndarray] = []
-
-    def handle_result(self, input: JSONType, output: str):
-        label = int(bool(input["label"]))
-        self.labels.append(label)
-        self.embeddings.append(extract_embedding_from_mapper_output(output))
-
-    @property
-    def result(self) -> Tuple[np.ndarray, np.ndarray]:  # features, labels
-        return np.stack(self.embeddings), np.array(self.labels)
-
-
 @app.route("/query_svm", methods=["POST"])
+@coordinator_only
 async def query_svm(request):
     index_id = request.json["index_id"]
     cluster_id = request.json["cluster_id"]
@@ -1481,7 +2449,8 @@ async def query_svm(request):
         already_labeled_image_paths = set(
             itertools.chain(pos_image_paths, neg_image_paths)
         )
-        autolabel_results = index.query_farthest(
+        autolabel_results = await cpu_executor.run(
+            index.query_farthest,
             prev_svm_vector,
             autolabel_percent / 100,  # percentage to fraction!
             autolabel_max_vectors,
@@ -1495,15 +2464,8 @@ async def query_svm(request):
     else:
         autolabel_image_paths = []
 
-    # Generate training vectors
+    # Generate training vectors (reusing cached ones from previous iterations)
     async with BestMapper(cluster_id) as mapper:
-        job = MapReduceJob(
-            mapper,
-            SVMExampleReducer(),
-            {"input_bucket": bucket, "reduction": "average"},
-            n_retries=config.CLOUD_RUN_N_RETRIES,
-            chunk_size=1,
-        )
         pos_inputs = [
             {"image": image_path, "patch": patch, "label": 1}
             for image_path, patch in zip(pos_image_paths, pos_patches)
@@ -1519,14 +2481,20 @@ async def query_svm(request):
             f"{log_id_string} - Starting SVM training vector computation: {len(pos_inputs)} positives, "
             f"{len(neg_inputs)} negatives, {len(auto_inputs)} auto-negatives"
         )
-        training_features, training_labels = await job.run_until_complete(
-            itertools.chain(pos_inputs, neg_inputs, auto_inputs)
-        )
-        logger.info(
-            f"{log_id_string} - Finished SVM vector computation in {job.elapsed_time:.3f}s"
+        inputs = pos_inputs + neg_inputs + auto_inputs
+        embeddings = await compute_embeddings(
+            mapper,
+            {"input_bucket": bucket, "reduction": "average"},
+            inputs,
+            log_id_string,
         )
-        logger.debug(
-            f"{log_id_string} - Vector computation performance: {job.performance}"
+        training_features = np.stack([e for e in embeddings if e is not None])
+        training_labels = np.array(
+            [
+                int(bool(input["label"]))
+                for input, e in zip(inputs, embeddings)
+                if e is not None
+            ]
         )
 
     # Train SVM
@@ -1534,7 +2502,7 @@ async def query_svm(request):
     start_time = time.perf_counter()
 
     model = svm.SVC(kernel="linear")
-    model.fit(training_features, training_labels)
+    await cpu_executor.run(model.fit, training_features, training_labels)
     predicted = model.predict(training_features)
 
     end_time = time.perf_counter()
@@ -1559,7 +2527,9 @@ async def query_svm(request):
             augmentation_dict[augmentations[2 * i]] = float(augmentations[2 * i + 1])
 
         # Run query and return results
-        query_results = index.query(w, num_results, None, use_full_image, True)
+        query_results = await cpu_executor.run(
+            index.query, w, num_results, None, use_full_image, True
+        )
         return resp.json(
             {
                 "results": [r.to_dict() for r in query_results],
@@ -1571,28 +2541,22 @@ async def query_svm(request):
         # For now, looks like most vectors end up being support vectors since
         # underparamtrized system
         sv = model.support_vectors_
-        all_results = {}
         # Results per vector
         perVector = (int)(num_results / len(sv)) + 2
-        for vec in sv:
-            # Return nearby images
-            query_results = index.query(
-                np.float32(vec),
-                perVector,
-                None,
-                use_full_image,
-                False,  # False bc just standard nearest neighbor
-            )
-
-            # Remove duplicates; for each image, include closest result
-            for result in query_results:
-                label = result.label
-                if label not in all_results or all_results[label].dist > result.dist:
-                    all_results[label] = result
+        # Return nearby images; for each image, include closest result
+        query_results = await cpu_executor.run(
+            index.query_batch,
+            np.float32(sv),
+            perVector,
+            None,
+            use_full_image,
+            False,  # False bc just standard nearest neighbor
+            deduplicate=True,
+        )
 
         return resp.json(
             {
-                "results": [r.to_dict() for r in all_results.values()],
+                "results": [r.to_dict() for r in query_results],
                 "svm_vector": utils.numpy_to_base64(w),
             }
         )  # unordered by distance for now
@@ -1603,15 +2567,61 @@ async def query_svm(request):
 # NEW FRONTEND
 
 
+ClusteringKey = Tuple[str, str, str]  # index id, model, hash of identifiers
+
+# Size is the total number of clustered images
+clustering_cache: LRUCache[ClusteringKey, List[List[float]]] = LRUCache(
+    config.CLUSTERING_CACHE_MAX_SIZE, lambda clustering: len(clustering) + 1
+)
+clustering_tasks: Dict[ClusteringKey, asyncio.Task] = {}
+
+
+async def get_clustering(
+    index_id: str, identifiers: List[str], model: str
+) -> List[List[float]]:
+    identifiers_hash = hashlib.sha1("\n".join(identifiers).encode()).hexdigest()
+    key = (index_id, model, identifiers_hash)
+    if key in clustering_cache:
+        return clustering_cache[key]
+
+    # Share a clustering that's already in progress (e.g., a prefetch)
+    task = clustering_tasks.get(key)
+    if task is None:
+        task = asyncio.create_task(_cluster(key, identifiers))
+        clustering_tasks[key] = task
+        task.add_done_callback(lambda _: clustering_tasks.pop(key, None))
+    return await asyncio.shield(task)
+
+
+async def _cluster(key: ClusteringKey, identifiers: List[str]) -> List[List[float]]:
+    index_id, model, _ = key
+    index = await get_index(index_id)
+    clustering = await cpu_executor.run(index.cluster_identifiers, identifiers, model)
+    clustering_cache[key] = clustering
+    return clustering
+
+
+def _log_prefetch_error(task: asyncio.Task):
+    if not task.cancelled() and task.exception():
+        logger.warning(f"Clustering prefetch failed: {task.exception()}")
+
+
 @app.route("/perform_clustering", methods=["POST"])
+@coordinator_only  # so every worker shares clustering_cache (and prefetches)
 async def perform_clustering(request):
     identifiers = request.json["identifiers"]
     index_id = request.json["index_id"]
-    args = dict(identifiers=identifiers)
-    if "model" in request.json:
-        args["model"] = request.json["model"]
-    index = await get_index(index_id)
-    clustering = index.cluster_identifiers(**args)
+    model = request.json.get("model", config.DEFAULT_QUERY_MODEL)
+
+    # Cluster the next page (if given) in the background while this one is displayed
+    prefetch_identifiers = request.json.get("prefetch_identifiers")
+    if prefetch_identifiers:
+        prefetch_task = asyncio.create_task(
+            get_clustering(index_id, prefetch_identifiers, model)
+        )
+        prefetch_task.add_done_callback(_log_prefetch_error)
+
+    clustering = await get_clustering(index_id, identifiers, model)
     return resp.json({"clustering": clustering})
 
 
@@ -1683,16 +2693,41 @@ async def query_knn_v2(request):
     use_full_image = request.json["use_full_image"]
     assert use_full_image
 
+    allowed_inds = request.json.get("allowed_inds")  # None if all
+    num_results = request.json.get("num_results")  # None if all
+
     index = await get_index(index_id)
 
     # Get query vector from local flat index
     query_vector = np.mean([utils.base64_to_numpy(e) for e in embeddings], axis=0)
 
     # Run query and return results
-    query_results = index.query_brute_force(
-        query_vector, dot_product=use_dot_product, model=model
+    ids, dists = await query_brute_force_columnar(
+        index_id,
+        index,
+        model,
+        LabeledIndex.BruteForceQuery(
+            query_vector, dot_product=use_dot_product, num_results=num_results
+        ),
+        index.decode_allowed_inds(allowed_inds),
     )
-    return resp.json({"results": [r.to_dict() for r in query_results]})
+    if wants_columnar_results(request):
+        return columnar_results_response(ids, dists)
+    return resp.json(
+        {"results": [r.to_dict() for r in index.to_query_results(ids, dists)]}
+    )
+
+
+@app.route("/brute_force_batching_stats", methods=["GET"])
+async def brute_force_batching_stats(request):
+    return resp.json(brute_force_batcher.stats.to_dict())
+
+
+SVMSessionKey = Tuple[str, str, str]  # index id, model, session id
+
+svm_sessions: LRUCache[SVMSessionKey, IncrementalLinearSVC] = LRUCache(
+    config.SVM_SESSION_CACHE_SIZE
+)
 
 
 @app.route("/train_svm_v2", methods=["POST"])
@@ -1705,21 +2740,45 @@ async def train_svm_v2(request):
     index_id = request.json["index_id"]
     embedding_model = request.json["model"]
 
-    index = await get_index(index_id)
+    session_id = request.json.get("session_id")  # e.g., the tags being trained on
 
-    # Get positive and negative image embeddings from local flat index
-    pos_vectors = index.get_embeddings(pos_identifiers, embedding_model)
-    neg_vectors = index.get_embeddings(neg_identifiers, embedding_model)
-    assert len(pos_vectors) > 0 and len(neg_vectors) > 0
-
-    # Train SVM and return serialized vector
-    training_features = np.concatenate((pos_vectors, neg_vectors))
-    training_labels = np.array([1] * len(pos_vectors) + [0] * len(neg_vectors))
-    model = svm.LinearSVC(C=0.1)
-    model.fit(training_features, training_labels)
+    index = await get_index(index_id)
+    local_flat_index = index.get_local_flat_index(embedding_model)
+
+    # Train on rows of the local flat index
+    pos_inds = index.identifiers_to_inds(pos_identifiers)
+    neg_inds = index.identifiers_to_inds(neg_identifiers)
+    assert len(pos_inds) > 0 and len(neg_inds) > 0
+    training_inds = pos_inds + neg_inds
+    training_labels = np.array([1] * len(pos_inds) + [0] * len(neg_inds))
+
+    # Within a session, only embeddings for newly labeled rows are fetched and
+    # training starts from the previous round's solution
+    if session_id:
+        key = (index_id, embedding_model, session_id)
+        model = svm_sessions.get(key) or IncrementalLinearSVC(C=0.1)
+        svm_sessions[key] = model
+    else:
+        model = IncrementalLinearSVC(C=0.1)
+
+    def train() -> Tuple[np.ndarray, np.ndarray]:
+        with model.lock:
+            start_time = time.perf_counter()
+            model.fit(
+                training_inds,
+                training_labels,
+                lambda inds: local_flat_index.index[inds],
+            )
+            logger.debug(
+                f"Trained SVM on {len(training_inds)} examples "
+                f"({model.n_fetched} new) in {model.n_iter_} passes, "
+                f"{time.perf_counter() - start_time:.3f}s"
+            )
+            return model.coef_[0], model.predict(model.training_features())
 
-    w = np.array(model.coef_[0] * 1000, dtype=np.float32)
-    predicted = model.predict(training_features)
+    # Return serialized vector
+    coef, predicted = await cpu_executor.run(train)
+    w = np.array(coef * 1000, dtype=np.float32)
     precision = precision_score(training_labels, predicted)
     recall = recall_score(training_labels, predicted)
 
@@ -1729,8 +2788,8 @@ async def train_svm_v2(request):
             "precision": precision,
             "recall": recall,
             "f1": 2 * precision * recall / (precision + recall),
-            "num_positives": len(pos_vectors),
-            "num_negatives": len(neg_vectors),
+            "num_positives": len(pos_inds),
+            "num_negatives": len(neg_inds),
         }
     )
 
@@ -1742,14 +2801,30 @@ async def query_svm_v2(request):
     svm_vector = utils.base64_to_numpy(request.json["svm_vector"])
     index_id = request.json["index_id"]
     model = request.json["model"]
+    allowed_inds = request.json.get("allowed_inds")  # None if all
+    num_results = request.json.get("num_results")  # None if all
 
     index = await get_index(index_id)
 
     # Run query and return results
-    query_results = index.query_brute_force(
-        svm_vector, dot_product=True, min_d=score_min, max_d=score_max, model=model
+    ids, dists = await query_brute_force_columnar(
+        index_id,
+        index,
+        model,
+        LabeledIndex.BruteForceQuery(
+            svm_vector,
+            dot_product=True,
+            min_d=score_min,
+            max_d=score_max,
+            num_results=num_results,
+        ),
+        index.decode_allowed_inds(allowed_inds),
+    )
+    if wants_columnar_results(request):
+        return columnar_results_response(ids, dists)
+    return resp.json(
+        {"results": [r.to_dict() for r in index.to_query_results(ids, dists)]}
     )
-    return resp.json({"results": [r.to_dict() for r in query_results]})
 
 
 @app.route("/query_ranking_v2", methods=["POST"])
@@ -1758,12 +2833,32 @@ async def query_ranking_v2(request):
     model = request.json["model"]
     score_min = float(request.json["score_min"])
     score_max = float(request.json["score_max"])
+    offset = int(request.json.get("offset", 0))
+    num_results = request.json.get("num_results")  # None if all
 
     index = await get_index(index_id)
 
     # Run query and return results
-    query_results = index.rank_brute_force(model, score_min, score_max)
-    return resp.json({"results": [r.to_dict() for r in query_results]})
+    ids, scores = await cpu_executor.run(
+        index.rank_brute_force_columnar,
+        model,
+        score_min,
+        score_max,
+        offset,
+        num_results,
+    )
+    if wants_columnar_results(request):
+        return columnar_results_response(ids, scores)
+    return resp.json(
+        {"results": [r.to_dict() for r in index.to_query_results(ids, scores)]}
+    )
+
+
+@app.route("/get_identifiers_by_ind", methods=["POST"])
+async def get_identifiers_by_ind(request):
+    index_id = request.json["index_id"]
+    index = await get_index(index_id)
+    return resp.json({"identifiers": index.get_identifiers_by_ind()})
 
 
 @app.route("/query_metrics", methods=["POST"])
@@ -1785,10 +2880,14 @@ async def query_metrics(request):
     rows = np.arange(num_labeled)
     weights = np.array(weights)
 
-    precision, precision_std, _ = ais.get_fscore(y_pred, y_test, rows, weights * y_pred)
-    recall, recall_std, _ = ais.get_fscore(y_pred, y_test, rows, weights * y_test)
-    f1, f1_std, _ = ais.get_fscore(
-        y_pred, y_test, rows, weights * (0.5 * y_pred + 0.5 * y_test)
+    precision, precision_std, _ = await cpu_executor.run(
+        ais.get_fscore, y_pred, y_test, rows, weights * y_pred
+    )
+    recall, recall_std, _ = await cpu_executor.run(
+        ais.get_fscore, y_pred, y_test, rows, weights * y_test
+    )
+    f1, f1_std, _ = await cpu_executor.run(
+        ais.get_fscore, y_pred, y_test, rows, weights * (0.5 * y_pred + 0.5 * y_test)
     )
 
     false_positives = []
@@ -1867,7 +2966,8 @@ async def query_active_validation(request):
         filter_rows = np.arange(len(y_pred))
 
     # Use AIS algorithm to sample rows to label
-    rows, weights = ais.ais_singleiter(
+    rows, weights = await cpu_executor.run(
+        ais.ais_singleiter,
         y_pred=y_pred,
         y_test=y_test[known_rows],
         prob_pos=prob_pos,
@@ -1918,6 +3018,7 @@ async def _keep_alive():
 
 
 @app.route("/keep_alive", methods=["POST"])
+@coordinator_only
 async def keep_alive(request):
     app.add_task(_keep_alive())
     return resp.text("", status=204)
@@ -1931,6 +3032,9 @@ async def cleanup(app, loop):
     print("Terminating:")
     await _cleanup_indexes()
     await _cleanup_clusters()
+    cpu_executor.shutdown()
+    if coordinator_session:
+        await coordinator_session.close()
 
 
 @utils.log_exception_from_coro_but_return_none
@@ -1947,5 +3051,22 @@ async def _cleanup_clusters():
     print(f"- killed {n} clusters")
 
 
+def _run_coordinator():
+    app.run(host="127.0.0.1", port=config.COORDINATOR_PORT)
+
+
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=5000)
+    if config.SERVER_NUM_WORKERS > 1:
+        # The coordinator is forked first; the workers Sanic forks afterwards see
+        # is_coordinator = False
+        fork_context = multiprocessing.get_context("fork")
+        coordinator = fork_context.Process(target=_run_coordinator)
+        coordinator.start()
+        is_coordinator = False
+        try:
+            app.run(host="0.0.0.0", port=5000, workers=config.SERVER_NUM_WORKERS)
+        finally:
+            coordinator.terminate()
+            coordinator.join()
+    else:
+        app.run(host="0.0.0.0", port=5000)
@@ -0,0 +1,25 @@
+import sys
+import urllib.request
+from pathlib import Path
+
+# The index server's modules import each other as top-level modules
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+# config looks up the instance IP from the GCE metadata server on import, which
+# isn't reachable outside of GCE
+_urlopen = urllib.request.urlopen
+
+
+class _MetadataResponse:
+    def read(self):
+        return b"127.0.0.1"
+
+
+def _urlopen_outside_gce(url, *args, **kwargs):
+    full_url = getattr(url, "full_url", url)
+    if full_url.startswith("http://metadata/"):
+        return _MetadataResponse()
+    return _urlopen(url, *args, **kwargs)
+
+
+urllib.request.urlopen = _urlopen_outside_gce
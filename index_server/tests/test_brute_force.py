@@ -0,0 +1,200 @@
+import asyncio
+
+import numpy as np
+import pytest
+
+from knn import utils
+
+from index_jobs import LocalFlatIndex
+from run import BruteForceQueryBatcher, LabeledIndex
+
+N = 1000
+D = 16
+MODEL = "test"
+
+
+def make_labeled_index(tmp_path, embeddings, quantization=None):
+    tmp_path.mkdir(parents=True, exist_ok=True)
+    embeddings.astype(np.float32).tofile(tmp_path / LocalFlatIndex.INDEX_FILENAME)
+    local_flat_index = LocalFlatIndex.load(tmp_path, *embeddings.shape)
+    if quantization:
+        local_flat_index.build_quantized_index(tmp_path, quantization)
+
+    index = LabeledIndex("test")
+    index.labels = [str(i) for i in range(len(embeddings))]
+    index.train_identifiers = {label: i for i, label in enumerate(index.labels)}
+    index.val_identifiers = {}
+    index.local_flat_indexes[MODEL] = local_flat_index
+    return index
+
+
+@pytest.fixture
+def embeddings():
+    return np.random.default_rng(0).standard_normal((N, D)).astype(np.float32)
+
+
+@pytest.fixture
+def queries():
+    rng = np.random.default_rng(1)
+    return [
+        LabeledIndex.BruteForceQuery(rng.standard_normal(D), dot_product=True),
+        LabeledIndex.BruteForceQuery(rng.standard_normal(D), min_d=0.1, max_d=0.6),
+        LabeledIndex.BruteForceQuery(rng.standard_normal(D), num_results=20),
+    ]
+
+
+def test_filtered_dists_normalized_over_whole_index(tmp_path, embeddings, queries):
+    index = make_labeled_index(tmp_path, embeddings)
+    allowed_inds = np.sort(np.random.default_rng(2).choice(N, 50, replace=False))
+
+    unfiltered = index.query_brute_force_batch_columnar(
+        [LabeledIndex.BruteForceQuery(q.query_vector, q.dot_product) for q in queries],
+        MODEL,
+    )
+    # A fresh index, so the filtered queries can't reuse cached extremes
+    fresh_index = make_labeled_index(tmp_path, embeddings)
+    filtered = fresh_index.query_brute_force_batch_columnar(
+        queries, MODEL, allowed_inds
+    )
+    for query, (all_ids, all_dists), (ids, dists) in zip(
+        queries, unfiltered, filtered
+    ):
+        dists_by_id = dict(zip(all_ids.tolist(), all_dists.tolist()))
+        if query.min_d <= 0.0 and query.max_d >= 1.0:
+            # Without a range filter, the allowed rows' extremes are used instead
+            allowed_dists = np.array([dists_by_id[id] for id in allowed_inds])
+            lowest, highest = allowed_dists.min(), allowed_dists.max()
+            dists_by_id = {
+                id: (dists_by_id[id] - lowest) / (highest - lowest)
+                for id in allowed_inds.tolist()
+            }
+        expected = [
+            (id, dists_by_id[id])
+            for id in allowed_inds.tolist()
+            if query.min_d <= dists_by_id[id] <= query.max_d
+        ]
+        expected.sort(key=lambda r: -r[1] if query.dot_product else r[1])
+        expected = expected[: query.num_results]
+
+        assert set(ids.tolist()) == {id for id, _ in expected}
+        np.testing.assert_allclose(
+            dists, [dist for _, dist in expected], rtol=1e-5, atol=1e-6
+        )
+
+
+def test_filtered_queries_reuse_cached_extremes(tmp_path, embeddings, queries):
+    index = make_labeled_index(tmp_path, embeddings)
+    n_full_scans = 0
+    brute_force_dists = index._brute_force_dists
+
+    def counting_brute_force_dists(local_flat_index, queries, rows, *args):
+        nonlocal n_full_scans
+        n_full_scans += rows is None
+        return brute_force_dists(local_flat_index, queries, rows, *args)
+
+    index._brute_force_dists = counting_brute_force_dists
+    allowed_inds = np.arange(0, N, 7)
+
+    index.query_brute_force_batch_columnar(queries, MODEL, allowed_inds)
+    assert n_full_scans == 1
+    index.query_brute_force_batch_columnar(queries[:1], MODEL, allowed_inds[:10])
+    assert n_full_scans == 1
+
+    new_query = LabeledIndex.BruteForceQuery(embeddings[0])
+    index.query_brute_force_batch_columnar([new_query], MODEL)
+    assert n_full_scans == 2
+    index.query_brute_force_batch_columnar([new_query], MODEL, allowed_inds)
+    assert n_full_scans == 2
+
+    # Queries without a range filter don't need the extremes over all rows
+    unranged_query = LabeledIndex.BruteForceQuery(embeddings[1], num_results=5)
+    index.query_brute_force_batch_columnar([unranged_query], MODEL, allowed_inds)
+    assert n_full_scans == 2
+
+
+def test_decode_allowed_inds(tmp_path, embeddings):
+    index = make_labeled_index(tmp_path, embeddings)
+    encoded = utils.numpy_to_base64(np.array([5, 3, 3, N, -1, 0], dtype="<i4"))
+
+    assert index.decode_allowed_inds(None) is None
+    np.testing.assert_array_equal(index.decode_allowed_inds(encoded), [0, 3, 5])
+    empty = utils.numpy_to_base64(np.empty(0, dtype="<i4"))
+    assert len(index.decode_allowed_inds(empty)) == 0
+
+
+@pytest.mark.parametrize("quantization", ["int8", "float16"])
+def test_quantization_error_bounds(tmp_path, embeddings, quantization):
+    local_flat_index = make_labeled_index(
+        tmp_path, embeddings, quantization
+    ).local_flat_indexes[MODEL]
+    vectors = local_flat_index.dequantize(local_flat_index.quantized_index[:])
+    errors = np.abs(vectors - embeddings)
+    assert np.all(errors <= local_flat_index.quantization_error(vectors))
+
+
+def test_per_dimension_error_bounds_match_per_element_ones(queries):
+    # int8's bounds are the same for every vector, so they're computed per query
+    query_vectors = np.stack([q.query_vector for q in queries]).astype(np.float32)
+    is_dot_product = np.array([q.dot_product for q in queries])
+    element_errors = np.random.default_rng(3).random(D).astype(np.float32)
+    errors = LabeledIndex._dist_error_bounds(
+        query_vectors, is_dot_product, element_errors, 5
+    )
+    per_element_errors = LabeledIndex._dist_error_bounds(
+        query_vectors, is_dot_product, np.tile(element_errors, (5, 1)), 5
+    )
+    np.testing.assert_allclose(errors, per_element_errors, rtol=1e-6)
+
+
+@pytest.mark.parametrize("quantization", ["int8", "float16"])
+@pytest.mark.parametrize("num_results", [1, 10, 200, None])
+@pytest.mark.parametrize("filtered", [False, True])
+def test_quantized_results_are_exact(
+    tmp_path, embeddings, queries, quantization, num_results, filtered
+):
+    queries = [
+        LabeledIndex.BruteForceQuery(
+            q.query_vector, q.dot_product, q.min_d, q.max_d, num_results
+        )
+        for q in queries
+    ]
+    allowed_inds = np.arange(3, N, 4) if filtered else None
+    exact_index = make_labeled_index(tmp_path / "exact", embeddings)
+    quantized_index = make_labeled_index(
+        tmp_path / "quantized", embeddings, quantization
+    )
+
+    expected = exact_index.query_brute_force_batch_columnar(
+        queries, MODEL, allowed_inds
+    )
+    results = quantized_index.query_brute_force_batch_columnar(
+        queries, MODEL, allowed_inds
+    )
+    for (ids, dists), (expected_ids, expected_dists) in zip(results, expected):
+        np.testing.assert_array_equal(ids, expected_ids)
+        np.testing.assert_allclose(dists, expected_dists, rtol=1e-5, atol=1e-6)
+        assert np.all((0 <= dists) & (dists <= 1))
+
+
+def test_batcher_runs_concurrent_queries_together(tmp_path, embeddings, queries):
+    index = make_labeled_index(tmp_path, embeddings)
+    batcher = BruteForceQueryBatcher(max_size=2, max_wait=0.05)
+    expected = [
+        index.query_brute_force_batch_columnar([query], MODEL)[0] for query in queries
+    ]
+
+    async def main():
+        return await asyncio.gather(
+            *[batcher.query("test", index, MODEL, query) for query in queries]
+        )
+
+    for (ids, dists), (expected_ids, expected_dists) in zip(
+        asyncio.run(main()), expected
+    ):
+        np.testing.assert_array_equal(ids, expected_ids)
+        np.testing.assert_allclose(dists, expected_dists, rtol=1e-5, atol=1e-6)
+
+    # One full batch of two, and one of the remaining query after max_wait
+    assert batcher.stats.n_batches == 2
+    assert batcher.stats.n_queries == 3
+    assert batcher.stats.max_batch_size == 2
@@ -0,0 +1,69 @@
+import numpy as np
+import pytest
+
+import config
+from run import LabeledIndex
+
+
+def assert_valid_merges(merges, n):
+    # Each merge joins two distinct current clusters, identified by their first
+    # point (that of cluster a after a merge), in nondecreasing order of height
+    assert len(merges) == n - 1
+    roots = set(range(n))
+    for a, b, _ in merges:
+        assert a in roots and b in roots and a != b
+        roots.remove(b)
+    assert len(roots) == 1
+
+    heights = [dist for _, _, dist in merges]
+    assert heights == sorted(heights)
+    assert min(heights) >= 0
+    assert max(heights) == pytest.approx(1.0)
+
+
+@pytest.fixture
+def index():
+    return LabeledIndex("test")
+
+
+def blobs(rng, n_blobs, n_per_blob, d):
+    centers = rng.standard_normal((n_blobs, d)) * 20
+    points = centers.repeat(n_per_blob, axis=0) + rng.standard_normal(
+        (n_blobs * n_per_blob, d)
+    )
+    return points.astype(np.float32)
+
+
+def test_exact_clustering_is_valid(index):
+    embeddings = blobs(np.random.default_rng(0), 4, 25, 8)
+    assert_valid_merges(index._cluster(embeddings), len(embeddings))
+
+
+def test_approximate_clustering_is_valid(index, monkeypatch):
+    monkeypatch.setattr(config, "APPROX_CLUSTERING_PCA_DIM", 4)
+    monkeypatch.setattr(config, "APPROX_CLUSTERING_NUM_CLUSTERS", 16)
+    embeddings = blobs(np.random.default_rng(0), 4, 100, 8)
+    assert_valid_merges(index._cluster_approximate(embeddings), len(embeddings))
+
+
+def test_approximate_clustering_with_more_clusters_than_points(index):
+    embeddings = np.random.default_rng(0).standard_normal((20, 8)).astype(np.float32)
+    assert_valid_merges(index._cluster_approximate(embeddings), len(embeddings))
+
+
+def test_approximate_clustering_separates_blobs(index, monkeypatch):
+    # The last merges join well-separated blobs, so cutting the dendrogram before
+    # them recovers the blobs
+    monkeypatch.setattr(config, "APPROX_CLUSTERING_PCA_DIM", 4)
+    monkeypatch.setattr(config, "APPROX_CLUSTERING_NUM_CLUSTERS", 16)
+    n_blobs, n_per_blob = 4, 100
+    embeddings = blobs(np.random.default_rng(0), n_blobs, n_per_blob, 8)
+    merges = index._cluster_approximate(embeddings)
+
+    clusters = {i: {i} for i in range(len(embeddings))}
+    for a, b, _ in merges[: -(n_blobs - 1)]:
+        clusters[a] |= clusters.pop(b)
+    expected = {
+        frozenset(range(i * n_per_blob, (i + 1) * n_per_blob)) for i in range(n_blobs)
+    }
+    assert {frozenset(members) for members in clusters.values()} == expected
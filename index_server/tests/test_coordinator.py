@@ -0,0 +1,80 @@
+import asyncio
+import json
+from types import SimpleNamespace
+
+import pytest
+
+import run
+
+
+class FakeResponse:
+    status = 200
+    content_type = "application/json"
+
+    def __init__(self, body):
+        self.body = body
+
+    async def read(self):
+        return self.body
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+
+class FakeCoordinatorSession:
+    # Records forwarded requests and answers them with a fixed body
+    def __init__(self, body):
+        self.body = body
+        self.requests = []
+
+    def request(self, method, url, data=None, headers=None):
+        self.requests.append((method, url, data))
+        return FakeResponse(self.body)
+
+
+@pytest.fixture
+def worker(monkeypatch):
+    # Makes this process a non-coordinator worker
+    session = FakeCoordinatorSession(json.dumps({"clustering": [[0, 1, 0.5, 2]]}))
+    monkeypatch.setattr(run, "is_coordinator", False)
+    monkeypatch.setattr(run, "get_coordinator_session", lambda: session)
+    return session
+
+
+def make_request(path, body):
+    body = json.dumps(body).encode()
+    return SimpleNamespace(
+        method="POST",
+        path=path,
+        query_string="",
+        body=body,
+        json=json.loads(body),
+        content_type="application/json",
+    )
+
+
+def test_workers_forward_clustering_to_the_coordinator(worker, monkeypatch):
+    async def get_clustering(*args):
+        raise AssertionError("Workers must not cluster locally")
+
+    monkeypatch.setattr(run, "get_clustering", get_clustering)
+    request = make_request(
+        "/perform_clustering",
+        {
+            "identifiers": ["a", "b"],
+            "index_id": "index",
+            "prefetch_identifiers": ["c", "d"],
+        },
+    )
+    response = asyncio.run(run.perform_clustering(request))
+
+    # The prefetch is forwarded along with the request, so the coordinator's cache
+    # gets the next page
+    assert worker.requests == [
+        ("POST", run.coordinator_url + "/perform_clustering", request.body)
+    ]
+    assert response.status == 200
+    assert json.loads(response.body) == {"clustering": [[0, 1, 0.5, 2]]}
@@ -0,0 +1,61 @@
+import numpy as np
+import pytest
+from scipy.spatial.distance import pdist, squareform
+
+from distance_matrix import CondensedDistanceMatrix
+from index_jobs import LocalFlatIndex
+
+N = 300
+D = 8
+
+
+@pytest.fixture
+def embeddings():
+    return np.random.default_rng(0).standard_normal((N, D)).astype(np.float32)
+
+
+@pytest.mark.parametrize("n_threads", [1, 4])
+def test_build_matches_pdist(tmp_path, embeddings, n_threads):
+    distances = CondensedDistanceMatrix.create(tmp_path / "d.npy", N)
+    # Small blocks and chunks so that rows span several of each
+    distances.build(embeddings, block_bytes=16 * N, chunk_size=64, n_threads=n_threads)
+    np.testing.assert_allclose(distances.data, pdist(embeddings), rtol=1e-4, atol=1e-4)
+
+
+def test_lookups(tmp_path, embeddings):
+    distances = CondensedDistanceMatrix.create(tmp_path / "d.npy", N)
+    distances.build(embeddings)
+    square = squareform(pdist(embeddings))
+    inds = np.array([5, 0, 299, 17, 5])
+
+    np.testing.assert_allclose(
+        distances.block(inds, inds[:3]), square[np.ix_(inds, inds[:3])], atol=1e-4
+    )
+    np.testing.assert_allclose(
+        distances.condensed(inds), pdist(embeddings[inds]), atol=1e-4
+    )
+    assert distances.pairwise(7, 7) == 0
+
+
+@pytest.mark.parametrize("dtype", ["float32", "float16"])
+def test_load_infers_dtype(tmp_path, embeddings, dtype):
+    distances = CondensedDistanceMatrix.create(tmp_path / "d.npy", N, dtype)
+    distances.build(embeddings)
+    distances.flush()
+
+    loaded = CondensedDistanceMatrix.load(tmp_path / "d.npy", N)
+    assert loaded.data.dtype == np.dtype(dtype)
+    np.testing.assert_array_equal(loaded.data, distances.data)
+
+
+def test_local_flat_index_without_condensed_matrix(tmp_path, embeddings):
+    # Indexes built before distance matrices were condensed only have a square
+    # distances.npy, which is ignored; clustering reads the embeddings instead
+    embeddings.tofile(tmp_path / LocalFlatIndex.INDEX_FILENAME)
+    squareform(pdist(embeddings)).astype(np.float32).tofile(
+        tmp_path / "distances.npy"
+    )
+
+    local_flat_index = LocalFlatIndex.load(tmp_path, N, D)
+    assert local_flat_index.distance_matrix is None
+    np.testing.assert_array_equal(local_flat_index.index, embeddings)
@@ -0,0 +1,118 @@
+import gc
+
+import numpy as np
+import pytest
+
+from embedding_cache import EmbeddingCache
+
+MAPPER_ID = {"mapper": "http://mapper", "model": "resnet50-res5"}
+JOB_ARGS = {"input_bucket": "bucket", "reduction": "average"}
+INPUT = {"image": "a.jpg", "patch": [0, 0, 1, 1], "augmentations": {}}
+
+
+def embedding(value, dim=256):
+    return np.full(dim, value, dtype=np.float32)  # 1 KiB
+
+
+@pytest.fixture
+def cache(tmp_path):
+    # Two embeddings in memory, and two (plus .npy headers) on disk
+    return EmbeddingCache(tmp_path / "cache", 2 * 1024, 5 * 512)
+
+
+def test_key_depends_on_what_determines_the_embedding():
+    key = EmbeddingCache.key(MAPPER_ID, JOB_ARGS, INPUT)
+    assert key != EmbeddingCache.key(
+        {**MAPPER_ID, "mapper": "http://other-mapper"}, JOB_ARGS, INPUT
+    )
+    assert key != EmbeddingCache.key({**MAPPER_ID, "model": "clip"}, JOB_ARGS, INPUT)
+    assert key != EmbeddingCache.key(
+        MAPPER_ID, {**JOB_ARGS, "reduction": None}, INPUT
+    )
+    assert key != EmbeddingCache.key(MAPPER_ID, JOB_ARGS, {**INPUT, "image": "b.jpg"})
+    assert key != EmbeddingCache.key(
+        MAPPER_ID, JOB_ARGS, {**INPUT, "patch": [0, 0, 0.5, 0.5]}
+    )
+    assert key != EmbeddingCache.key(
+        MAPPER_ID, JOB_ARGS, {**INPUT, "augmentations": {"flip": 1.0}}
+    )
+
+
+def test_key_ignores_other_fields_and_defaults():
+    key = EmbeddingCache.key(MAPPER_ID, JOB_ARGS, INPUT)
+    assert key == EmbeddingCache.key(MAPPER_ID, JOB_ARGS, {"image": "a.jpg"})
+    assert key == EmbeddingCache.key(MAPPER_ID, JOB_ARGS, {**INPUT, "label": 1})
+    assert key == EmbeddingCache.key(
+        MAPPER_ID, JOB_ARGS, {**INPUT, "patch": [0.0, 0.0, 1.0, 1.0]}
+    )
+
+
+def test_spills_to_disk_and_back(cache):
+    for i in range(3):
+        cache.put(str(i), embedding(i))
+    assert "0" not in cache.memory and "0" in cache.disk
+
+    np.testing.assert_array_equal(cache.get("0"), embedding(0))
+    assert "0" in cache.memory and "0" not in cache.disk
+    np.testing.assert_array_equal(cache.get("2"), embedding(2))
+    assert cache.get("missing") is None
+    assert cache.stats == EmbeddingCache.Stats(
+        n_memory_hits=1, n_disk_hits=1, n_misses=1
+    )
+
+
+def test_evicts_from_disk(cache):
+    for i in range(5):
+        cache.put(str(i), embedding(i))
+    # Two in memory, the two most recently spilled on disk, the first one gone
+    assert set(cache.memory) == {"3", "4"}
+    assert set(cache.disk) == {"1", "2"}
+    assert cache.get("0") is None
+    assert len(list(cache.dir.iterdir())) == 2
+
+
+def test_put_replaces_disk_copy(cache):
+    for i in range(3):
+        cache.put(str(i), embedding(i))
+    cache.put("0", embedding(10))
+    assert "0" not in cache.disk
+    np.testing.assert_array_equal(cache.get("0"), embedding(10))
+
+
+def test_caches_sharing_a_dir_keep_their_files(tmp_path):
+    other_file = tmp_path / "cache" / "other.npy"
+    other_file.parent.mkdir()
+    other_file.touch()
+    first = EmbeddingCache(tmp_path / "cache", 1024, 5 * 512)
+    first.put("0", embedding(0))
+    first.put("1", embedding(1))  # spills "0"
+
+    second = EmbeddingCache(tmp_path / "cache", 1024, 5 * 512)
+    assert second.dir != first.dir
+    assert other_file.exists()
+    np.testing.assert_array_equal(first.get("0"), embedding(0))
+
+    # Removing a cache only removes its own files
+    first_dir = first.dir
+    del first
+    gc.collect()  # the cache refers to itself through its eviction callback
+    assert not first_dir.exists()
+    assert second.dir.exists() and other_file.exists()
+
+
+def test_unreadable_disk_copy_is_a_miss(cache):
+    for i in range(4):
+        cache.put(str(i), embedding(i))
+    cache.disk["0"].unlink()
+    cache.disk["1"].write_bytes(b"not an array")
+
+    assert cache.get("0") is None
+    assert cache.get("1") is None
+    assert "1" not in cache.disk and not list(cache.dir.iterdir())
+    assert cache.stats == EmbeddingCache.Stats(n_misses=2)
+
+    # Evicting or replacing an entry whose file is gone doesn't fail either
+    cache.put("4", embedding(4))
+    cache.disk["2"].unlink()
+    cache.put("2", embedding(2))
+    np.testing.assert_array_equal(cache.get("2"), embedding(2))
@@ -0,0 +1,67 @@
+import numpy as np
+import pytest
+from sklearn.svm import LinearSVC
+
+from incremental_svm import IncrementalLinearSVC
+
+N = 200
+D = 10
+
+
+@pytest.fixture
+def data():
+    rng = np.random.default_rng(0)
+    features = rng.standard_normal((N, D)).astype(np.float32)
+    w = rng.standard_normal(D)
+    labels = (features @ w + 0.5 * rng.standard_normal(N) > 0.3).astype(int)
+    return features, labels
+
+
+def fit_reference(features, labels):
+    return LinearSVC(C=1.0, tol=1e-8, max_iter=100_000, dual=True).fit(
+        features, labels
+    )
+
+
+def get_features_from(features, fetched):
+    def get_features(keys):
+        fetched.extend(keys)
+        return features[keys]
+
+    return get_features
+
+
+def assert_matches_reference(svm, features, labels):
+    reference = fit_reference(features, labels)
+    np.testing.assert_allclose(svm.coef_, reference.coef_, rtol=1e-2, atol=1e-3)
+    np.testing.assert_allclose(
+        svm.intercept_, reference.intercept_, rtol=1e-2, atol=1e-3
+    )
+    np.testing.assert_array_equal(svm.predict(features), reference.predict(features))
+
+
+def test_matches_linear_svc(data):
+    features, labels = data
+    svm = IncrementalLinearSVC(tol=1e-6, random_state=0)
+    svm.fit(range(N), labels, get_features_from(features, []))
+    assert_matches_reference(svm, features, labels)
+    np.testing.assert_array_equal(svm.training_features(), features)
+
+
+def test_refit_only_fetches_new_examples(data):
+    features, labels = data
+    fetched = []
+    svm = IncrementalLinearSVC(tol=1e-6, random_state=0)
+    svm.fit(range(150), labels[:150], get_features_from(features, fetched))
+    assert svm.n_fetched == 150
+
+    # Flip some labels, drop some examples and add new ones
+    labels = labels.copy()
+    labels[:10] = 1 - labels[:10]
+    keys = list(range(20, N)) + list(range(10))
+    fetched.clear()
+    svm.fit(keys, labels[keys], get_features_from(features, fetched))
+    assert sorted(fetched) == list(range(150, N))
+    assert svm.n_fetched == N - 150
+
+    assert_matches_reference(svm, features[keys], labels[keys])
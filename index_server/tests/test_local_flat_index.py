@@ -0,0 +1,46 @@
+import os
+
+import numpy as np
+
+from index_jobs import LocalFlatIndex
+
+N = 100
+D = 4
+
+
+def make_local_flat_index(tmp_path, scores):
+    np.zeros((N, D), dtype=np.float32).tofile(tmp_path / LocalFlatIndex.INDEX_FILENAME)
+    np.save(tmp_path / LocalFlatIndex.SCORES_FILENAME, scores)
+    return LocalFlatIndex.load(tmp_path, N, D)
+
+
+def test_score_range(tmp_path):
+    scores = np.random.default_rng(0).random(N).astype(np.float32)
+    scores[:5] = 0.5  # ties
+    local_flat_index = make_local_flat_index(tmp_path, scores)
+
+    ids, range_scores = local_flat_index.score_range(0.25, 0.5)
+    expected = np.flatnonzero((0.25 <= scores) & (scores <= 0.5))
+    assert sorted(ids.tolist()) == expected.tolist()
+    np.testing.assert_array_equal(range_scores, scores[ids])
+    assert (np.diff(range_scores) <= 0).all()  # highest first
+
+    ids, _ = local_flat_index.score_range(2.0, 3.0)
+    assert len(ids) == 0
+
+
+def test_refresh_scores_reloads_rewritten_scores(tmp_path):
+    scores = np.zeros(N, dtype=np.float32)
+    local_flat_index = make_local_flat_index(tmp_path, scores)
+    local_flat_index.refresh_scores()
+    assert len(local_flat_index.score_range(0.5, 1.0)[0]) == 0
+
+    scores[:10] = 1.0
+    scores_path = tmp_path / LocalFlatIndex.SCORES_FILENAME
+    np.save(scores_path, scores)
+    stat = os.stat(scores_path)
+    os.utime(scores_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1))
+
+    local_flat_index.refresh_scores()
+    ids, _ = local_flat_index.score_range(0.5, 1.0)
+    assert sorted(ids.tolist()) == list(range(10))
@@ -0,0 +1,237 @@
+import numpy as np
+import pytest
+
+from interactive_index import InteractiveIndex
+
+import config
+from index_jobs import IndexType
+from run import LabeledIndex
+
+N_IMAGES = 40
+D = 8
+N_CENTROIDS = 4
+N_TIGHT_IMAGES = 4
+TIGHT_PATCHES_CENTER = np.full(D, 10.0, dtype=np.float32)
+
+
+def make_interactive_index(path, vectors, ids, ids_extra, metric="L2"):
+    index = InteractiveIndex(
+        d=D,
+        n_centroids=N_CENTROIDS,
+        n_probes=N_CENTROIDS,
+        vectors_per_index=len(vectors),
+        tempdir=str(path),
+        multi_id=True,
+        metric=metric,
+    )
+    index.train(vectors)
+    index.add(vectors, ids, ids_extra)
+    index.merge_partial_indexes()
+    return index
+
+
+@pytest.fixture
+def labeled_index(tmp_path):
+    # Each image has exactly QUERY_PATCHES_PER_IMAGE patches; its full-image
+    # embedding is their mean
+    rng = np.random.default_rng(0)
+    n_patches = config.QUERY_PATCHES_PER_IMAGE
+    patches = rng.standard_normal((N_IMAGES * n_patches, D)).astype(np.float32)
+    # The first images' patches are all close to TIGHT_PATCHES_CENTER
+    patches[: N_TIGHT_IMAGES * n_patches] *= 0.01
+    patches[: N_TIGHT_IMAGES * n_patches] += TIGHT_PATCHES_CENTER
+    full = patches.reshape(N_IMAGES, n_patches, D).mean(axis=1)
+    image_ids = np.arange(N_IMAGES)
+    patch_image_ids, patch_locs = np.divmod(np.arange(len(patches)), n_patches)
+
+    index = LabeledIndex("test")
+    index.labels = [f"image{i}" for i in range(N_IMAGES)]
+    for index_type, vectors, ids, ids_extra, metric in (
+        (IndexType.FULL, full, image_ids, 0, "L2"),
+        (IndexType.FULL_DOT, full, image_ids, 0, "inner product"),
+        (IndexType.SPATIAL, patches, patch_image_ids, patch_locs, "L2"),
+    ):
+        index.indexes[index_type] = make_interactive_index(
+            tmp_path / index_type.name, vectors, ids, ids_extra, metric
+        )
+    index.ready.set()
+    return index
+
+
+@pytest.fixture
+def query_vectors():
+    return np.random.default_rng(1).standard_normal((6, D)).astype(np.float32)
+
+
+def test_interactive_index_query_batch_matches_single_queries(
+    labeled_index, query_vectors
+):
+    index = labeled_index.indexes[IndexType.SPATIAL]
+    dists, (ids, extras) = index.query_batch(query_vectors, 20)
+    assert dists.shape == ids.shape == extras.shape == (len(query_vectors), 20)
+    for i, query_vector in enumerate(query_vectors):
+        single_dists, (single_ids, single_extras) = index.query(query_vector[None], 20)
+        np.testing.assert_array_equal(ids[i], single_ids[0])
+        np.testing.assert_array_equal(extras[i], single_extras[0])
+        np.testing.assert_allclose(dists[i], single_dists[0], rtol=1e-5)
+
+
+@pytest.mark.parametrize("use_full_image", [True, False])
+def test_query_batch_matches_single_queries(
+    labeled_index, query_vectors, use_full_image
+):
+    results_by_vector = labeled_index.query_batch(
+        query_vectors, 10, use_full_image=use_full_image
+    )
+    assert len(results_by_vector) == len(query_vectors)
+    for results, query_vector in zip(results_by_vector, query_vectors):
+        single_results = labeled_index.query(
+            query_vector, 10, use_full_image=use_full_image
+        )
+        assert [r.id for r in results] == [r.id for r in single_results]
+        assert [r.dist for r in results] == pytest.approx(
+            [r.dist for r in single_results]
+        )
+        assert all(r.label == f"image{r.id}" for r in results)
+
+
+@pytest.mark.parametrize("use_full_image", [True, False])
+def test_query_batch_deduplicates_to_closest_result_per_image(
+    labeled_index, query_vectors, use_full_image
+):
+    results_by_vector = labeled_index.query_batch(
+        query_vectors, 10, use_full_image=use_full_image
+    )
+    expected = {}
+    for result in (r for results in results_by_vector for r in results):
+        if result.id not in expected or result.dist < expected[result.id].dist:
+            expected[result.id] = result
+
+    deduplicated = labeled_index.query_batch(
+        query_vectors, 10, use_full_image=use_full_image, deduplicate=True
+    )
+    assert len(deduplicated) == len({r.id for r in deduplicated})
+    assert {r.id: r.dist for r in deduplicated} == {
+        i: r.dist for i, r in expected.items()
+    }
+    # Several query vectors share results, so there are fewer than their total
+    assert len(deduplicated) < sum(map(len, results_by_vector))
+
+
+def test_svm_query_batch_uses_dot_product_index(labeled_index, query_vectors):
+    results_by_vector = labeled_index.query_batch(
+        query_vectors, 5, use_full_image=True, svm=True
+    )
+    full = labeled_index.indexes[IndexType.FULL_DOT]
+    for results, query_vector in zip(results_by_vector, query_vectors):
+        _, (ids, _) = full.query(query_vector[None], 5)
+        assert [r.id for r in results] == ids[0].tolist()
+        # The best match has the highest dot product, which is inverted to 0
+        assert results[0].dist == pytest.approx(0.0)
+
+
+def test_full_image_query_with_narrow_filter_ignores_padding(
+    labeled_index, query_vectors
+):
+    # Fewer allowed images than requested results pads each row, which mustn't
+    # affect the normalized distances
+    allowed_inds = np.array([3, 7, 11])
+    results = labeled_index.query(
+        query_vectors[0], 10, use_full_image=True, allowed_inds=allowed_inds
+    )
+    assert sorted(r.id for r in results) == allowed_inds.tolist()
+    dists = [r.dist for r in results]
+    assert dists == sorted(dists)
+    assert dists[0] == pytest.approx(0.0)
+    assert dists[-1] == pytest.approx(1.0)
+
+    # A single hit is the closest one
+    results = labeled_index.query(
+        query_vectors[0], 10, use_full_image=True, allowed_inds=allowed_inds[:1]
+    )
+    assert [(r.id, r.dist) for r in results] == [(3, 0.0)]
+
+
+# Enough results per vector that the largest adaptive search returns every patch,
+# so each vector ends up with a full set of results
+NUM_RESULTS = 4
+
+
+@pytest.fixture
+def spatial_query_calls(labeled_index, monkeypatch):
+    # Records the query vectors, k and n_probes of each spatial index search
+    index = labeled_index.indexes[IndexType.SPATIAL]
+    calls = []
+    query_batch = index.query_batch
+
+    def recording_query_batch(xq, k, n_probes=None, allowed_ids=None):
+        calls.append((xq.copy(), k, n_probes))
+        return query_batch(xq, k, n_probes=n_probes, allowed_ids=allowed_ids)
+
+    monkeypatch.setattr(index, "query_batch", recording_query_batch)
+    return calls
+
+
+def test_adaptive_query_starting_at_max_k_takes_one_round(
+    labeled_index, query_vectors, spatial_query_calls, monkeypatch
+):
+    monkeypatch.setattr(
+        config,
+        "ADAPTIVE_QUERY_INITIAL_RESULTS_MULTIPLE",
+        config.QUERY_NUM_RESULTS_MULTIPLE,
+    )
+    results_by_vector = labeled_index.query_batch(
+        query_vectors, NUM_RESULTS, adaptive=True
+    )
+    assert len(spatial_query_calls) == 1
+    xq, k, _ = spatial_query_calls[0]
+    assert len(xq) == len(query_vectors)
+    assert k == config.QUERY_NUM_RESULTS_MULTIPLE * NUM_RESULTS
+    assert all(len(results) == NUM_RESULTS for results in results_by_vector)
+
+
+def test_adaptive_query_grows_k_for_pending_vectors_only(
+    labeled_index, query_vectors, spatial_query_calls, monkeypatch
+):
+    monkeypatch.setattr(config, "ADAPTIVE_QUERY_INITIAL_RESULTS_MULTIPLE", 1)
+    # The last vector finds full sets of patches for N_TIGHT_IMAGES images early
+    query_vectors = np.vstack([query_vectors, TIGHT_PATCHES_CENTER])
+    results_by_vector = labeled_index.query_batch(
+        query_vectors, NUM_RESULTS, adaptive=True
+    )
+    assert all(len(results) == NUM_RESULTS for results in results_by_vector)
+    assert {r.id for r in results_by_vector[-1]} == set(range(N_TIGHT_IMAGES))
+
+    # Too few patch hits for any vector to have enough full images at first
+    assert len(spatial_query_calls) > 1
+    growth = config.ADAPTIVE_QUERY_GROWTH_FACTOR
+    first_xq, first_k, _ = spatial_query_calls[0]
+    assert len(first_xq) == len(query_vectors) and first_k == NUM_RESULTS
+    for (xq, k, _), (next_xq, next_k, _) in zip(
+        spatial_query_calls, spatial_query_calls[1:]
+    ):
+        assert next_k == min(
+            k * growth, config.QUERY_NUM_RESULTS_MULTIPLE * NUM_RESULTS
+        )
+        # Each round only searches again for vectors that were still pending
+        assert {v.tobytes() for v in next_xq} <= {v.tobytes() for v in xq}
+    last_xq, _, _ = spatial_query_calls[-1]
+    assert TIGHT_PATCHES_CENTER.tobytes() not in {v.tobytes() for v in last_xq}
+
+
+def test_adaptive_query_probes_more_lists_when_out_of_hits(
+    labeled_index, query_vectors, spatial_query_calls
+):
+    allowed_inds = np.arange(6)
+    results_by_vector = labeled_index.query_batch(
+        query_vectors, 5, num_probes=1, allowed_inds=allowed_inds, adaptive=True
+    )
+
+    # One probed list holds too few patches of the allowed images, so the search
+    # widens until they're all found
+    n_probes = [n_probes for _, _, n_probes in spatial_query_calls]
+    assert n_probes[0] == 1
+    assert n_probes == sorted(n_probes) and n_probes[-1] > 1
+    for results in results_by_vector:
+        assert len(results) == 5
+        assert {r.id for r in results} <= set(allowed_inds.tolist())
@@ -0,0 +1,66 @@
+from collections import defaultdict
+import heapq
+import operator
+
+import numpy as np
+import pytest
+
+import config
+from run import LabeledIndex
+
+
+def reference_spatial_query_results(ids, locs, dists, num_results):
+    # The original per-hit loop that _spatial_query_results replaced
+    dists_by_id = defaultdict(list)
+    spatial_dists_by_id = defaultdict(list)
+    for i, l, d in zip(ids, locs, dists):
+        i, l, d = int(i), int(l), float(d)
+        if i >= 0 and len(dists_by_id[i]) < config.QUERY_PATCHES_PER_IMAGE:
+            dists_by_id[i].append(d)
+            spatial_dists_by_id[i].append((l, d))
+
+    result_gen = (
+        LabeledIndex.QueryResult(i, sum(ds) / len(ds), spatial_dists_by_id[i])
+        for i, ds in dists_by_id.items()
+        if len(ds) == config.QUERY_PATCHES_PER_IMAGE
+    )
+    return heapq.nsmallest(num_results, result_gen, operator.attrgetter("dist"))
+
+
+def random_hits(rng, n_hits, n_images, n_dist_levels, sort):
+    # Few distinct images and distances, so images repeat and distances tie;
+    # unfilled hits are -1, as FAISS returns them
+    ids = rng.integers(-1, n_images, n_hits)
+    locs = rng.integers(0, 50, n_hits)
+    dists = (rng.integers(0, n_dist_levels, n_hits) / n_dist_levels).astype(
+        np.float32
+    )
+    if sort:
+        order = np.argsort(dists, kind="stable")
+        ids, locs, dists = ids[order], locs[order], dists[order]
+    return ids, locs, dists
+
+
+@pytest.mark.parametrize("seed", range(50))
+@pytest.mark.parametrize("sort", [True, False])
+def test_matches_reference(seed, sort):
+    rng = np.random.default_rng(seed)
+    n_hits = int(rng.integers(0, 2000))
+    n_images = int(rng.integers(1, 200))
+    n_dist_levels = int(rng.choice([2, 5, 1000]))
+    num_results = int(rng.integers(1, 100))
+    ids, locs, dists = random_hits(rng, n_hits, n_images, n_dist_levels, sort)
+
+    results = LabeledIndex._spatial_query_results(ids, locs, dists, num_results)
+    expected = reference_spatial_query_results(ids, locs, dists, num_results)
+
+    assert [(r.id, r.dist, r.spatial_dists) for r in results] == [
+        (r.id, r.dist, r.spatial_dists) for r in expected
+    ]
+
+
+def test_no_full_images():
+    ids = np.array([3, 3, -1, 5], dtype=np.int64)
+    locs = np.arange(4)
+    dists = np.zeros(4, dtype=np.float32)
+    assert LabeledIndex._spatial_query_results(ids, locs, dists, 10) == []
@@ -0,0 +1,87 @@
+import asyncio
+import threading
+
+import pytest
+
+from utils import BoundedExecutor, ExecutorBusyError, LRUCache
+
+
+def test_lru_cache_evicts_least_recently_used():
+    evicted = []
+    cache = LRUCache(3, evict_func=lambda key, value: evicted.append((key, value)))
+    for key in "abc":
+        cache[key] = key.upper()
+
+    cache["a"]  # now most recently used
+    cache["d"] = "D"
+    assert evicted == [("b", "B")]
+    assert list(cache) == ["c", "a", "d"]
+
+
+def test_lru_cache_evicts_by_size():
+    cache = LRUCache(10, size_func=len)
+    cache["a"] = "x" * 4
+    cache["b"] = "x" * 4
+    assert cache.size == 8
+
+    cache["a"] = "x" * 6  # replacing an entry updates its size
+    assert cache.size == 10 and set(cache) == {"a", "b"}
+
+    # "a" was used more recently than "b" by being replaced
+    cache["c"] = "x" * 3
+    assert list(cache) == ["a", "c"]
+    assert cache.size == 9
+
+
+def test_lru_cache_keeps_oversized_entry():
+    cache = LRUCache(10, size_func=len)
+    cache["a"] = "x" * 3
+    cache["b"] = "x" * 20
+    assert list(cache) == ["b"]
+    assert cache.size == 20
+
+    del cache["b"]
+    assert len(cache) == 0 and cache.size == 0
+
+
+def test_bounded_executor_rejects_past_max_queued():
+    executor = BoundedExecutor(1, 1)
+    started = threading.Event()
+    release = threading.Event()
+
+    def block():
+        started.set()
+        release.wait(5)
+        return "first"
+
+    async def main():
+        first = asyncio.ensure_future(executor.run(block))
+        await asyncio.sleep(0)  # submit it
+        await asyncio.get_running_loop().run_in_executor(None, started.wait, 5)
+
+        second = asyncio.ensure_future(executor.run(lambda: "second"))
+        await asyncio.sleep(0)
+        with pytest.raises(ExecutorBusyError):
+            await executor.run(lambda: "third")
+
+        release.set()
+        return await asyncio.gather(first, second)
+
+    assert asyncio.run(main()) == ["first", "second"]
+    assert executor.stats.n_completed == 2
+    assert executor.stats.n_rejected == 1
+    assert executor.stats.max_n_queued == 1
+    assert executor.stats.n_queued == executor.stats.n_running == 0
+    executor.shutdown()
+
+
+def test_bounded_executor_propagates_exceptions():
+    executor = BoundedExecutor(2, 2)
+
+    def fail():
+        raise KeyError("missing")
+
+    with pytest.raises(KeyError):
+        asyncio.run(executor.run(fail))
+    assert executor.stats.n_completed == 1 and executor.stats.n_running == 0
+    executor.shutdown()
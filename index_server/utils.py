@@ -1,8 +1,13 @@
 import asyncio
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
+import concurrent.futures
+from dataclasses import dataclass
+import threading
 import time
 import uuid
 
+from dataclasses_json import dataclass_json
+
 from typing import (
     Any,
     Awaitable,
@@ -100,3 +105,126 @@ class CleanupDict(MutableMapping[KT, VT]):
         await asyncio.gather(*map(self.cleanup_key, keys_to_delete))
 
         self.schedule_func(self.sleep_and_cleanup())
+
+
+class LRUCache(MutableMapping[KT, VT]):
+    # Evicts least recently used entries once the total size of the values (as given
+    # by size_func; by default, each value counts as 1) exceeds max_size, passing
+    # each evicted entry to evict_func if given
+    def __init__(
+        self,
+        max_size: int,
+        size_func: Callable[[VT], int] = lambda value: 1,
+        evict_func: Optional[Callable[[KT, VT], None]] = None,
+    ) -> None:
+        self.max_size = max_size
+        self.size_func = size_func
+        self.evict_func = evict_func
+        self.size = 0
+
+        self.store: "OrderedDict[KT, VT]" = OrderedDict()
+        self.sizes: Dict[KT, int] = {}
+
+    def __getitem__(self, key: KT) -> VT:
+        value = self.store[key]
+        self.store.move_to_end(key)
+        return value
+
+    def __setitem__(self, key: KT, value: VT) -> None:
+        if key in self.store:
+            del self[key]
+        self.store[key] = value
+        self.sizes[key] = self.size_func(value)
+        self.size += self.sizes[key]
+
+        # Never evict the entry that was just added
+        while self.size > self.max_size and len(self.store) > 1:
+            evicted_key, evicted_value = next(iter(self.store.items()))
+            del self[evicted_key]
+            if self.evict_func:
+                self.evict_func(evicted_key, evicted_value)
+
+    def __delitem__(self, key: KT) -> None:
+        del self.store[key]
+        self.size -= self.sizes.pop(key)
+
+    def __iter__(self):
+        return iter(self.store)
+
+    def __len__(self) -> int:
+        return len(self.store)
+
+
+class ExecutorBusyError(Exception):
+    pass
+
+
+class BoundedExecutor:
+    # Runs blocking (CPU-heavy) functions on a fixed number of worker threads so they
+    # don't stall the event loop. At most max_queued calls may wait for a worker;
+    # beyond that, run() raises ExecutorBusyError instead of letting latency grow
+    # without bound. NumPy, FAISS and scikit-learn release the GIL in their inner
+    # loops, so threads give real parallelism without pickling indexes to processes.
+
+    @dataclass_json
+    @dataclass
+    class Stats:
+        n_workers: int
+        max_queued: int
+        n_running: int = 0
+        n_queued: int = 0
+        max_n_queued: int = 0
+        n_completed: int = 0
+        n_rejected: int = 0
+        total_wait_time: float = 0.0  # seconds, summed over calls
+        max_wait_time: float = 0.0
+
+    def __init__(self, n_workers: int, max_queued: int, name: str = "") -> None:
+        self.pool = concurrent.futures.ThreadPoolExecutor(
+            n_workers, thread_name_prefix=name
+        )
+        self.lock = threading.Lock()
+        self.stats = BoundedExecutor.Stats(n_workers, max_queued)
+
+    async def run(self, f: Callable[..., VT], *args, **kwargs) -> VT:
+        with self.lock:
+            if self.stats.n_queued >= self.stats.max_queued:
+                self.stats.n_rejected += 1
+                raise ExecutorBusyError(
+                    f"{self.stats.n_queued} calls already waiting for a worker"
+                )
+            self.stats.n_queued += 1
+            self.stats.max_n_queued = max(self.stats.max_n_queued, self.stats.n_queued)
+
+        submit_time = time.perf_counter()
+
+        def run_and_track():
+            wait_time = time.perf_counter() - submit_time
+            with self.lock:
+                self.stats.n_queued -= 1
+                self.stats.n_running += 1
+                self.stats.total_wait_time += wait_time
+                self.stats.max_wait_time = max(self.stats.max_wait_time, wait_time)
+            try:
+                return f(*args, **kwargs)
+            finally:
+                with self.lock:
+                    self.stats.n_running -= 1
+                    self.stats.n_completed += 1
+
+        def untrack_if_cancelled(future: concurrent.futures.Future):
+            # Cancelled (e.g., because the request went away) before it started
+            if future.cancelled():
+                with self.lock:
+                    self.stats.n_queued -= 1
+
+        future = self.pool.submit(run_and_track)
+        future.add_done_callback(untrack_if_cancelled)
+        return await asyncio.wrap_future(future)
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self.lock:
+            return self.stats.to_dict()
+
+    def shutdown(self) -> None:
+        self.pool.shutdown(wait=False)
@@ -41,7 +41,15 @@ CONFIG_DEFAULTS = {
 
     # Misc
     'multi_id': False,
+    'id_encoding': 'bitpack', # {'bitpack', 'cantor'}; only used with multi_id
+    'id_extra_bits': 16, # only used with bitpack id_encoding
     'direct_map': 'NoMap', # {'NoMap', 'Array', 'Hashtable'}
+
+    # Merging
+    'compaction_threshold': 0.5, # fraction of appended vectors that triggers
+                                 # a rewrite of the merged index data
+    'tombstone_threshold': 0.1, # fraction of removed vectors above which
+                                # maybe_compact() rewrites the merged index data
 }
 
 
@@ -5,17 +5,28 @@ TODO: docstring
 
 import gc
 import json
+import os
 from pathlib import Path
+import threading
 from typing import List, Optional, Tuple, Union, Sequence
 import warnings
 
 import faiss
-from faiss import ParameterSpace
 import numpy as np
 
 from interactive_index.config import read_config, CONFIG_DEFAULTS
-from interactive_index.utils import (merge_on_disk,
+from interactive_index.utils import (MergeProgress,
+                                     append_on_disk,
+                                     bitmap_add,
+                                     bitmap_contains,
+                                     bitmap_remove,
+                                     copy_invlists_on_disk,
+                                     get_list_ids,
+                                     merge_invlists_on_disk,
+                                     merge_on_disk,
                                      to_all_gpus,
+                                     bitpack_pairing,
+                                     invert_bitpack_pairing,
                                      cantor_pairing,
                                      invert_cantor_pairing)
 
@@ -49,6 +60,7 @@ class InteractiveIndex:
     MERGED_INDEX_DATA_NAME = 'merged.ivfdata'
     MERGED_INDEX_NAME = 'merged.index'
     META_FILE_NAME = 'meta.json'
+    TOMBSTONES_NAME = 'tombstones.npy'
 
     SUPPORTED_DIM_PER_SUBQ = [1, 2, 3, 4, 6, 8, 10, 12, 16, 20, 24, 28, 32]
 
@@ -118,7 +130,29 @@ class InteractiveIndex:
             self.co = None
 
         self.multi_id = self.cfg['multi_id']
+        self.id_encoding = self.cfg['id_encoding']
+        self.id_extra_bits = self.cfg['id_extra_bits']
         self.direct_map = self.cfg['direct_map']
+        self.compaction_threshold = self.cfg['compaction_threshold']
+        self.tombstone_threshold = self.cfg['tombstone_threshold']
+
+        # Handle to the merged index, opened lazily and reused across calls
+        self._merged_index = None
+        self._merged_index_mtime = None
+        self._merged_index_lock = threading.RLock()
+
+        # Serializes operations that rewrite the merged index, so that queries
+        # only need to wait while the new files are swapped in
+        self._write_lock = threading.RLock()
+
+        # Bitmap of removed IDs (or, if multi_id, of removed primary IDs)
+        self._tombstones = np.zeros(0, dtype=np.uint8)
+
+        # If multi_id, the largest ID extra in the merged index and a selector
+        # of the stored IDs of removed vectors, both computed lazily for the
+        # current handle (and tombstones)
+        self._max_id_extra: Optional[int] = None
+        self._removed_selector = None
 
         if not exists:
             self.create(self.index_str)
@@ -128,6 +162,13 @@ class InteractiveIndex:
             self.is_trained = extra['is_trained']
             self.n_indexes = extra['n_indexes']
             self.n_vectors = extra['n_vectors']
+            self.n_merged_indexes = extra.get('n_merged_indexes', 0)
+            self.n_appended = extra.get('n_appended', 0)
+            self.n_removed = extra.get('n_removed', 0)
+
+            tombstones_path = self.tempdir/self.TOMBSTONES_NAME
+            if tombstones_path.exists():
+                self._tombstones = np.load(tombstones_path)
 
     def create(self, index_str: str) -> None:
         """
@@ -155,7 +196,7 @@ class InteractiveIndex:
         ), 'Refusing to create direct mapped index because merging is unsupported'
 
         index = faiss.index_factory(self.d, index_str, metric)
-        index.set_direct_map(direct_map)
+        faiss.extract_index_ivf(index).set_direct_map_type(direct_map)
         faiss.write_index(index, str(self.tempdir/self.TRAINED_INDEX_NAME))
 
         # TODO: get from index_str
@@ -163,6 +204,9 @@ class InteractiveIndex:
         self.is_trained = False
         self.n_indexes = 0
         self.n_vectors = 0
+        self.n_merged_indexes = 0
+        self.n_appended = 0
+        self.n_removed = 0
 
     def train(self, xt_src: Union[str, np.ndarray, List[float]]) -> None:
         """
@@ -229,111 +273,373 @@ class InteractiveIndex:
                 contains.
         """
 
+        with self.writer(update_metadata) as writer:
+            writer.add(xb_src, ids, ids_extra)
+
+    def writer(self, update_metadata: bool = True) -> 'ShardWriter':
+        """
+        Opens a writer session that keeps the current partial shard in memory
+        across calls to `ShardWriter.add()`, so that shards are only written
+        to disk when they fill up or when the session is flushed or closed.
+
+        Usage:
+            with index.writer() as writer:
+                for xb, ids in chunks:
+                    writer.add(xb, ids)
+
+        Args:
+            update_metadata: Whether to update the metadata JSON file whenever
+                a shard is written with the new number of vectors and shards
+                this index contains.
+
+        Returns:
+            The writer session, which is also a context manager.
+
+        """
+
         if not self.is_trained:
             raise RuntimeError('Cannot add to untrained index.')
 
-        xb = self._convert_src_to_numpy(xb_src)
-        if ids is None:
-            ids = np.arange(self.n_vectors, self.n_vectors + len(xb))
-        else:
-            ids = np.array(ids)
+        return ShardWriter(self, update_metadata)
 
-        if self.multi_id:
-            if isinstance(ids_extra, int):
-                ids_extra = np.full(len(ids), ids_extra)
-            else:
-                ids_extra = np.array(ids_extra)
+    def merge_partial_indexes(
+        self,
+        shard_index_names: Optional[List[str]] = None,
+        n_threads: int = 1,
+        progress: Optional[MergeProgress] = None
+    ) -> None:
+        """
+        Merges the partial indexes into a single on-disk index.
 
-            ids = np.array([
-                cantor_pairing(ids[i], ids_extra[i]) for i in range(len(ids))
-            ])
+        Args:
+            shard_index_names: The partial index filenames to merge. Defaults
+                to all of this index's shards.
+            n_threads: The number of threads to merge inverted lists with.
+            progress: If given, updated with the progress of the merge.
 
-        idx = 0
-        while idx < len(xb):
-            # gc.collect()  # TODO: does this improve memory performance?
+        """
 
-            if self.n_vectors % self.vectors_per_index == 0:
-                # Need to create a new index
-                index = faiss.read_index(
-                    str(self.tempdir/self.TRAINED_INDEX_NAME)
-                )
-                shard_num = self.n_indexes
-                self.n_indexes += 1
-            else:
-                # Read existing partial index
-                shard_num = self.n_indexes - 1
-                index = faiss.read_index(str(
-                    self.tempdir/self.SHARD_INDEX_NAME_TMPL.format(shard_num)
-                ))
+        merged_data_path = self.tempdir/self.MERGED_INDEX_DATA_NAME
+        new_data_path = merged_data_path.with_suffix('.merging')
 
-            end_idx = idx + min(
-                self.vectors_per_index - (self.n_vectors % self.vectors_per_index),
-                xb.shape[0]
-            )
+        index = faiss.read_index(str(self.tempdir/self.TRAINED_INDEX_NAME))
 
-            index.add_with_ids(xb[idx:end_idx], ids[idx:end_idx])
-            self.n_vectors += (end_idx - idx)
+        shard_index_names = shard_index_names or [
+            str(self.tempdir/self.SHARD_INDEX_NAME_TMPL.format(shard_num))
+            for shard_num in range(self.n_indexes)
+        ]
 
-            faiss.write_index(
+        # Queries keep being served from the previous merge (if any) until the
+        # new files are swapped in
+        with self._write_lock:
+            merge_on_disk(
                 index,
-                str(self.tempdir/self.SHARD_INDEX_NAME_TMPL.format(shard_num))
+                shard_index_names,
+                str(new_data_path),
+                n_threads=n_threads,
+                progress=progress
             )
 
-            index.reset()
-            # del index  # TODO: does this improve memory performance?
+            invlists = faiss.downcast_InvertedLists(
+                faiss.extract_index_ivf(index).invlists
+            )
+            invlists.filename = str(merged_data_path)
 
-            if update_metadata:
-                self._save_metadata()
+            with self._merged_index_lock:
+                self._invalidate_merged_index()
 
-            idx = end_idx
+                os.replace(new_data_path, merged_data_path)
+                faiss.write_index(
+                    index, str(self.tempdir/self.MERGED_INDEX_NAME)
+                )
 
-    def merge_partial_indexes(
+                self.n_merged_indexes = self.n_indexes
+                self.n_appended = 0
+                self._save_metadata()
+
+    def append_partial_indexes(
         self,
-        shard_index_names: Optional[List[str]] = None
+        shard_index_names: Optional[List[str]] = None,
+        n_threads: int = 1
     ) -> None:
         """
-        TODO: docstring
+        Appends partial indexes to the already merged index. The existing data
+        is copied to a new file as is rather than merged list by list again,
+        and queries keep being served from the old file until the new one is
+        swapped in. Once the appended vectors exceed `compaction_threshold` of
+        the total, the merged index is compacted.
+
+        Args:
+            shard_index_names: The partial index filenames to append. Defaults
+                to this index's shards that were added after the last merge.
+            n_threads: The number of threads to compact with, if necessary.
 
         """
 
-        index = faiss.read_index(str(self.tempdir/self.TRAINED_INDEX_NAME))
+        merged_index_path = self.tempdir/self.MERGED_INDEX_NAME
+        if not merged_index_path.exists():
+            raise RuntimeError('Cannot append to an index that was never merged.')
 
         shard_index_names = shard_index_names or [
             str(self.tempdir/self.SHARD_INDEX_NAME_TMPL.format(shard_num))
-            for shard_num in range(self.n_indexes)
+            for shard_num in range(self.n_merged_indexes, self.n_indexes)
         ]
 
-        merge_on_disk(
-            index,
-            shard_index_names,
-            str(self.tempdir/self.MERGED_INDEX_DATA_NAME)
+        merged_data_path = self.tempdir/self.MERGED_INDEX_DATA_NAME
+        appended_data_path = merged_data_path.with_suffix('.appending')
+
+        with self._write_lock:
+            # Append to a copy of the data file: queries may still be reading
+            # the current one through their handle, and lists that outgrow
+            # their slots would be moved into space those queries still use
+            index = faiss.read_index(
+                str(merged_index_path), faiss.IO_FLAG_READ_ONLY
+            )
+            index_ivf = faiss.extract_index_ivf(index)
+            invlists = copy_invlists_on_disk(
+                index_ivf.invlists, str(appended_data_path)
+            )
+            index_ivf.replace_invlists(invlists, False)
+
+            n_appended = append_on_disk(index, shard_index_names)
+            n_total = index.ntotal
+
+            # Point the lists at the final data file name before moving the
+            # data into place
+            invlists.filename = str(merged_data_path)
+
+            with self._merged_index_lock:
+                self._invalidate_merged_index()
+
+                os.replace(appended_data_path, merged_data_path)
+                faiss.write_index(index, str(merged_index_path))
+                del index, invlists
+
+                self.n_appended += n_appended
+                self.n_merged_indexes = self.n_indexes
+                self._save_metadata()
+
+            if self.n_appended > self.compaction_threshold * n_total:
+                self.compact(n_threads)
+
+    def compact(self, n_threads: int = 1) -> None:
+        """
+        Rewrites the merged index data so that every inverted list is stored
+        contiguously, reclaiming the space left behind by appends and dropping
+        the entries of removed IDs.
+
+        Queries keep being served from the old files while the new ones are
+        written, so this can be run from a background thread.
+
+        Args:
+            n_threads: The number of threads to copy inverted lists with.
+
+        """
+
+        merged_index_path = self.tempdir/self.MERGED_INDEX_NAME
+        merged_data_path = self.tempdir/self.MERGED_INDEX_DATA_NAME
+        compacted_data_path = merged_data_path.with_suffix('.compacting')
+
+        with self._write_lock:
+            # IDs removed while compacting stay tombstoned afterwards
+            tombstones = self._tombstones.copy()
+            id_filter = None
+            if tombstones.any():
+                id_filter = lambda ids: ~self._is_removed(ids, tombstones)
+
+            merged_index = faiss.read_index(
+                str(merged_index_path), faiss.IO_FLAG_READ_ONLY
+            )
+            index = faiss.read_index(str(self.tempdir/self.TRAINED_INDEX_NAME))
+
+            merge_invlists_on_disk(
+                index,
+                [faiss.extract_index_ivf(merged_index).invlists],
+                str(compacted_data_path),
+                n_threads=n_threads,
+                id_filter=id_filter
+            )
+            del merged_index
+
+            # Point the compacted lists at the final data file name before
+            # moving the data into place
+            invlists = faiss.downcast_InvertedLists(
+                faiss.extract_index_ivf(index).invlists
+            )
+            invlists.filename = str(merged_data_path)
+
+            with self._merged_index_lock:
+                self._invalidate_merged_index()
+
+                os.replace(compacted_data_path, merged_data_path)
+                faiss.write_index(index, str(merged_index_path))
+
+                self._tombstones = bitmap_remove(self._tombstones, tombstones)
+                self.n_removed = int(np.unpackbits(self._tombstones).sum())
+                self.n_appended = 0
+                self._save_tombstones()
+                self._save_metadata()
+
+    def remove_ids(self, ids: Sequence[int]) -> None:
+        """
+        Removes vectors from the index by recording tombstones for their IDs.
+        Removed vectors are no longer returned by `query()` or
+        `get_cluster_ids()`, and are dropped from disk by `compact()`.
+
+        Args:
+            ids: The IDs to remove. If multi_id is True, these are the primary
+                IDs, and all vectors with any ID extra are removed.
+
+        """
+
+        with self._merged_index_lock:
+            self._tombstones = bitmap_add(self._tombstones, ids)
+            self.n_removed = int(np.unpackbits(self._tombstones).sum())
+            self._save_tombstones()
+            self._save_metadata()
+
+    def get_tombstone_ratio(self) -> float:
+        """
+        Returns the fraction of vectors in the merged index that have been
+        removed but not yet compacted away. This reads the IDs of every
+        inverted list, so it is much cheaper than `compact()` but not free.
+
+        """
+
+        if self.n_removed == 0:
+            return 0.0
+
+        index = self._get_merged_index()
+        invlists = faiss.extract_index_ivf(index).invlists
+        tombstones = self._tombstones
+
+        n_removed_vectors = sum(
+            np.count_nonzero(
+                self._is_removed(get_list_ids(invlists, i), tombstones)
+            )
+            for i in range(invlists.nlist)
         )
+        return n_removed_vectors / max(index.ntotal, 1)
 
-        faiss.write_index(index, str(self.tempdir/self.MERGED_INDEX_NAME))
+    def maybe_compact(self, n_threads: int = 1) -> bool:
+        """
+        Compacts the index if the fraction of removed vectors exceeds
+        `tombstone_threshold`. Meant to be called periodically from a
+        background thread.
+
+        Args:
+            n_threads: The number of threads to copy inverted lists with.
+
+        Returns:
+            Whether the index was compacted.
+
+        """
+
+        if self.get_tombstone_ratio() <= self.tombstone_threshold:
+            return False
+
+        self.compact(n_threads)
+        return True
 
     def query(
         self,
         xq_src: Union[str, np.ndarray, List[float]],
         k: int = 1,
-        n_probes: Optional[int] = None
+        n_probes: Optional[int] = None,
+        allowed_ids: Optional[np.ndarray] = None
     ) -> Tuple[np.ndarray, np.ndarray]:
         """
         TODO: docstring
 
         """
 
+        return self.query_batch(xq_src, k, n_probes, allowed_ids)
+
+    def query_batch(
+        self,
+        xq_src: Union[str, np.ndarray, List[float]],
+        k: int = 1,
+        n_probes: Optional[int] = None,
+        allowed_ids: Optional[np.ndarray] = None
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Searches for the k nearest neighbors of every query vector in a single
+        FAISS search call.
+
+        Args:
+            xq_src: The query vectors, one per row. Can be the name of a file
+                output by np.ndarray.tofile(), a numpy array, or a list of
+                floats.
+            k: The number of neighbors to return for each query vector.
+            n_probes: The number of IVF lists to visit. Defaults to the
+                configured `n_probes`.
+            allowed_ids: An optional bitmap (see `bitmap_add`) of the IDs that
+                may be returned. If multi_id is True, these are the primary
+                IDs (not the ID extras). Like removed IDs, disallowed IDs are
+                skipped while scanning the inverted lists, so rows only come
+                back with fewer than k results if the probed lists run out.
+
+        Returns:
+            The distances and IDs, each with one row per query vector. If
+            multi_id is True, the IDs are returned as a tuple of the ID and
+            ID extra arrays.
+
+        """
+
         xq = self._convert_src_to_numpy(xq_src)
-        index = faiss.read_index(str(self.tempdir/self.MERGED_INDEX_NAME))
-#         if self.use_gpu:
-#             # TODO: perhaps add memory check for training on GPU?
-#             index = to_all_gpus(index, self.co)
-        ParameterSpace().set_index_parameter(
-            index, 'nprobe', n_probes if n_probes else self.n_probes
-        )
-        dists, inds = index.search(xq, k)
+        n_probes = n_probes if n_probes else self.n_probes
+
+        # Only fetching the cached handle needs the lock; searching it doesn't
+        with self._merged_index_lock:
+            tombstones = self._tombstones if self.n_removed else None
+            index = self._get_merged_index()
+#             if self.use_gpu:
+#                 # TODO: perhaps add memory check for training on GPU?
+#                 index = to_all_gpus(index, self.co)
+
+        # Skip removed and disallowed IDs while scanning the inverted lists. The
+        # bitmaps and selectors are kept in local variables because FAISS doesn't
+        # take ownership of them.
+        sel = None
+        if not self.multi_id:
+            if tombstones is not None:
+                removed = faiss.IDSelectorBitmap(
+                    len(tombstones), faiss.swig_ptr(tombstones)
+                )
+                not_removed = faiss.IDSelectorNot(removed)
+                sel = not_removed
+            if allowed_ids is not None:
+                allowed_ids = np.ascontiguousarray(allowed_ids, dtype=np.uint8)
+                allowed = faiss.IDSelectorBitmap(
+                    len(allowed_ids), faiss.swig_ptr(allowed_ids)
+                )
+                sel = allowed if sel is None else faiss.IDSelectorAnd(allowed, sel)
+        else:
+            # The bitmaps are of primary IDs, not of the stored (encoded) IDs
+            # the scan sees, so select the stored IDs they stand for instead
+            if tombstones is not None:
+                removed = self._get_removed_selector(index, tombstones)
+                not_removed = faiss.IDSelectorNot(removed)
+                sel = not_removed
+            if allowed_ids is not None:
+                allowed_stored_ids = self._get_allowed_stored_ids(
+                    index, xq, n_probes, allowed_ids
+                )
+                allowed = faiss.IDSelectorBatch(
+                    len(allowed_stored_ids), faiss.swig_ptr(allowed_stored_ids)
+                )
+                sel = allowed if sel is None else faiss.IDSelectorAnd(allowed, sel)
+
+        # nprobe is passed per call rather than set on the shared index, so
+        # concurrent queries can search the cached handle in parallel
+        if sel is None:
+            params = faiss.SearchParametersIVF(nprobe=n_probes)
+        else:
+            params = faiss.SearchParametersIVF(sel=sel, nprobe=n_probes)
+        dists, inds = index.search(xq, k, params=params)
 
         if self.multi_id:
-            inds = self._invert_cantor_pairing_vec(inds)
+            inds = self._decode_multi_ids(inds)
 
         return dists, inds
 
@@ -344,7 +650,7 @@ class InteractiveIndex:
         """
 
         x = self._convert_src_to_numpy(x)
-        index = faiss.read_index(str(self.tempdir/self.MERGED_INDEX_NAME))
+        index = self._get_merged_index()
         for i in range(index.chain.size()):
             x = index.chain.at(i).apply_py(x)
 
@@ -362,20 +668,17 @@ class InteractiveIndex:
         # This fixes problem with SWIG and numpy int
         list_num = int(list_num)
 
-        index = faiss.read_index(str(self.tempdir/self.MERGED_INDEX_NAME))
+        index = self._get_merged_index()
 
         # Get the IVF from potentially opaque index
         invlists = faiss.extract_index_ivf(index).invlists
-        list_size = invlists.list_size(list_num)
-        list_ids = np.zeros(list_size, dtype=np.int64)
-        temp_ids = invlists.get_ids(list_num)
+        list_ids = get_list_ids(invlists, list_num)
 
-        # Need to copy since memory will be deallocated along with the invlist.
-        faiss.memcpy(faiss.swig_ptr(list_ids), temp_ids, list_ids.nbytes)
-        invlists.release_ids(list_num, temp_ids)
+        if self.n_removed:
+            list_ids = list_ids[~self._is_removed(list_ids, self._tombstones)]
 
         if self.multi_id:
-            list_ids = self._invert_cantor_pairing_vec(list_ids)
+            list_ids = self._decode_multi_ids(list_ids)
 
         return list_ids
 
@@ -385,7 +688,7 @@ class InteractiveIndex:
         # TODO: assert IVF
         assert self.is_trained
 
-        index = faiss.read_index(str(self.tempdir/self.MERGED_INDEX_NAME))
+        index = self._get_merged_index()
 
         # Get the IVF from potentially opaque index
         index_ivf = faiss.extract_index_ivf(index)
@@ -399,7 +702,7 @@ class InteractiveIndex:
         # TODO: assert IVF
         assert self.is_trained
 
-        index = faiss.read_index(str(self.tempdir/self.MERGED_INDEX_NAME))
+        index = self._get_merged_index()
 
         # Get the IVF from potentially opaque index
         invlists = faiss.extract_index_ivf(index).invlists
@@ -409,10 +712,14 @@ class InteractiveIndex:
     def cleanup(self) -> None:
         """Deletes all persistent files associated with this index."""
 
+        with self._merged_index_lock:
+            self._invalidate_merged_index()
+
         _unlink(self.tempdir/self.TRAINED_INDEX_NAME)
         _unlink(self.tempdir/self.MERGED_INDEX_NAME)
         _unlink(self.tempdir/self.MERGED_INDEX_DATA_NAME)
         _unlink(self.tempdir/self.META_FILE_NAME)
+        _unlink(self.tempdir/self.TOMBSTONES_NAME)
         self.delete_shards()
 
     def delete_shards(self) -> None:
@@ -452,6 +759,229 @@ class InteractiveIndex:
 
         return x
 
+    def _prepare_ids(
+        self,
+        n: int,
+        ids: Optional[Sequence[int]],
+        ids_extra: Optional[Union[Sequence[int], int]]
+    ) -> np.ndarray:
+        """
+        Returns the IDs to store for the next n vectors added to the index.
+
+        """
+
+        if ids is None:
+            ids = np.arange(self.n_vectors, self.n_vectors + n)
+        else:
+            ids = np.array(ids)
+
+        if self.multi_id:
+            if isinstance(ids_extra, int):
+                ids_extra = np.full(len(ids), ids_extra)
+            else:
+                ids_extra = np.array(ids_extra)
+
+            ids = self._encode_multi_ids(ids, ids_extra)
+
+        return ids
+
+    def _encode_multi_ids(
+        self,
+        ids: np.ndarray,
+        ids_extra: np.ndarray
+    ) -> np.ndarray:
+        """Combines IDs and extra IDs into single IDs per `id_encoding`."""
+
+        if self.id_encoding == 'bitpack':
+            return bitpack_pairing(ids, ids_extra, self.id_extra_bits)
+        elif self.id_encoding == 'cantor':
+            return cantor_pairing(
+                ids.astype(np.int64), ids_extra.astype(np.int64)
+            )
+        else:
+            raise ValueError(f"Unknown id_encoding '{self.id_encoding}'")
+
+    def _decode_multi_ids(self, inds: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Splits combined IDs back into IDs and extra IDs."""
+
+        if self.id_encoding == 'bitpack':
+            return invert_bitpack_pairing(inds, self.id_extra_bits)
+        elif self.id_encoding == 'cantor':
+            return self._invert_cantor_pairing_vec(inds)
+        else:
+            raise ValueError(f"Unknown id_encoding '{self.id_encoding}'")
+
+    def _is_removed(self, ids: np.ndarray, tombstones: np.ndarray) -> np.ndarray:
+        """
+        Returns a boolean mask of which stored (i.e., encoded, if multi_id)
+        IDs are tombstoned in the given bitmap.
+
+        """
+
+        if self.multi_id:
+            ids, _ = self._decode_multi_ids(ids)
+
+        return bitmap_contains(tombstones, ids)
+
+    def _get_removed_selector(
+        self,
+        index: faiss.Index,
+        tombstones: np.ndarray
+    ) -> faiss.IDSelector:
+        """
+        Returns a selector of the stored IDs of every removed vector in the
+        given multi_id merged index. It is built once per handle and set of
+        tombstones, rather than once per query.
+
+        """
+
+        with self._merged_index_lock:
+            if (
+                self._removed_selector is None
+                or self._removed_selector[0] is not tombstones
+            ):
+                removed_ids = np.flatnonzero(
+                    np.unpackbits(tombstones, bitorder='little')
+                )
+                removed_stored_ids = self._get_stored_ids(index, removed_ids)
+                self._removed_selector = (tombstones, faiss.IDSelectorBatch(
+                    len(removed_stored_ids), faiss.swig_ptr(removed_stored_ids)
+                ))
+
+            return self._removed_selector[1]
+
+    def _get_allowed_stored_ids(
+        self,
+        index: faiss.Index,
+        xq: np.ndarray,
+        n_probes: int,
+        allowed_ids: np.ndarray
+    ) -> np.ndarray:
+        """
+        Returns the stored IDs that an allowed_ids bitmap of primary IDs
+        stands for in the given multi_id merged index: every combination of
+        an allowed ID with an ID extra, unless there would be more of those
+        than entries in the lists that searching for xq probes, in which case
+        the allowed ones among those entries.
+
+        """
+
+        allowed_primary_ids = np.flatnonzero(
+            np.unpackbits(allowed_ids, bitorder='little')
+        )
+        n_combinations = (
+            len(allowed_primary_ids) * (self._get_max_id_extra(index) + 1)
+        )
+
+        index_ivf = faiss.extract_index_ivf(index)
+        list_nos = self._get_probed_lists(index, xq, n_probes)
+        n_probed = sum(index_ivf.invlists.list_size(int(i)) for i in list_nos)
+
+        if n_combinations <= n_probed:
+            return self._get_stored_ids(index, allowed_primary_ids)
+
+        probed_ids = np.concatenate(
+            [np.zeros(0, dtype=np.int64)] + [
+                get_list_ids(index_ivf.invlists, int(list_no))
+                for list_no in list_nos
+            ]
+        )
+        probed_primary_ids, _ = self._decode_multi_ids(probed_ids)
+        return probed_ids[bitmap_contains(allowed_ids, probed_primary_ids)]
+
+    def _get_stored_ids(self, index: faiss.Index, ids: np.ndarray) -> np.ndarray:
+        """
+        Returns every stored ID that the given primary IDs can have in the
+        given multi_id merged index, i.e., combined with each ID extra up to
+        the largest one in the index.
+
+        """
+
+        ids_extra = np.arange(self._get_max_id_extra(index) + 1)
+        return np.ascontiguousarray(self._encode_multi_ids(
+            np.repeat(ids, len(ids_extra)), np.tile(ids_extra, len(ids))
+        ), dtype=np.int64)
+
+    def _get_max_id_extra(self, index: faiss.Index) -> int:
+        """
+        Returns the largest ID extra in the given multi_id merged index, or -1
+        if it is empty. Reads the IDs of every inverted list once per handle.
+
+        """
+
+        with self._merged_index_lock:
+            if self._max_id_extra is None:
+                invlists = faiss.extract_index_ivf(index).invlists
+                max_id_extra = -1
+                for list_no in range(invlists.nlist):
+                    list_ids = get_list_ids(invlists, list_no)
+                    if len(list_ids):
+                        _, ids_extra = self._decode_multi_ids(list_ids)
+                        max_id_extra = max(max_id_extra, int(ids_extra.max()))
+                self._max_id_extra = max_id_extra
+
+            return self._max_id_extra
+
+    def _get_probed_lists(
+        self,
+        index: faiss.Index,
+        xq: np.ndarray,
+        n_probes: int
+    ) -> np.ndarray:
+        """
+        Returns the numbers of the inverted lists that searching the given
+        index for the query vectors visits.
+
+        """
+
+        index_ivf = faiss.extract_index_ivf(index)
+        if n_probes >= index_ivf.nlist:
+            return np.arange(index_ivf.nlist)
+
+        if isinstance(index, faiss.IndexPreTransform):
+            for i in range(index.chain.size()):
+                xq = index.chain.at(i).apply_py(xq)
+        _, list_nos = index_ivf.quantizer.search(xq, n_probes)
+        return np.unique(list_nos[list_nos >= 0])
+
+    def _save_tombstones(self) -> None:
+        """Writes the tombstone bitmap next to the metadata JSON file."""
+
+        np.save(self.tempdir/self.TOMBSTONES_NAME, self._tombstones)
+
+    def _get_merged_index(self) -> faiss.Index:
+        """
+        Returns a cached handle to the merged index, (re)opening it if it has
+        not been opened yet or if the file on disk has been rewritten since.
+
+        The inverted lists stay memory-mapped from the ".ivfdata" file rather
+        than being read into memory.
+
+        """
+
+        merged_index_path = self.tempdir/self.MERGED_INDEX_NAME
+
+        with self._merged_index_lock:
+            mtime = os.stat(merged_index_path).st_mtime_ns
+            if self._merged_index is None or self._merged_index_mtime != mtime:
+                self._merged_index = faiss.read_index(
+                    str(merged_index_path), faiss.IO_FLAG_READ_ONLY
+                )
+                self._merged_index_mtime = mtime
+                self._max_id_extra = None
+                self._removed_selector = None
+
+            return self._merged_index
+
+    def _invalidate_merged_index(self) -> None:
+        """Drops the cached merged index handle so the next use reopens it."""
+
+        with self._merged_index_lock:
+            self._merged_index = None
+            self._merged_index_mtime = None
+            self._max_id_extra = None
+            self._removed_selector = None
+
     def _create_co(
         self,
         use_float16,
@@ -521,7 +1051,10 @@ class InteractiveIndex:
                 if encoding_args[0] == 'rotate':
                     encoding_str += 'r'
 
-        return ','.join([transform_str, search_str, encoding_str])
+        # Newer FAISS versions reject empty components (e.g., no transform)
+        return ','.join(
+            part for part in [transform_str, search_str, encoding_str] if part
+        )
 
     def _save_metadata(self) -> None:
         """
@@ -535,7 +1068,10 @@ class InteractiveIndex:
                 'requires_training': self.requires_training,
                 'is_trained': self.is_trained,
                 'n_indexes': self.n_indexes,
-                'n_vectors': self.n_vectors
+                'n_vectors': self.n_vectors,
+                'n_merged_indexes': self.n_merged_indexes,
+                'n_appended': self.n_appended,
+                'n_removed': self.n_removed
             }
         }
 
@@ -550,7 +1086,120 @@ class InteractiveIndex:
 
         payload = json.load((Path(tempdir)/cls.META_FILE_NAME).open())
         payload['cfg']['tempdir'] = tempdir  # override tempdir in case index was copied
+        # Indexes written before id_encoding was introduced use Cantor pairing
+        payload['cfg'].setdefault('id_encoding', 'cantor')
         index = InteractiveIndex(
             **payload['cfg'], _extra=payload['extra'], _exists=True
         )
         return index
+
+
+class ShardWriter:
+    """
+    A writer session for adding vectors to the partial (shard) indexes of an
+    InteractiveIndex. Create with `InteractiveIndex.writer()`.
+
+    The shard currently being filled is kept open in memory instead of being
+    re-read and rewritten for every batch of vectors. It is written to disk
+    when it reaches `vectors_per_index` vectors (after which a new shard is
+    started), on `flush()`, and on `close()`.
+
+    """
+
+    def __init__(self, index: InteractiveIndex, update_metadata: bool = True):
+        self.index = index
+        self.update_metadata = update_metadata
+
+        self._shard: Optional[faiss.Index] = None
+        self._shard_num: Optional[int] = None
+        self._dirty = False
+
+    def __enter__(self) -> 'ShardWriter':
+        return self
+
+    def __exit__(self, type, value, traceback) -> None:
+        self.close()
+
+    def add(
+        self,
+        xb_src: Union[str, np.ndarray, List[float]],
+        ids: Optional[Sequence[int]] = None,
+        ids_extra: Optional[Union[Sequence[int], int]] = 0
+    ) -> None:
+        """
+        Adds the given vectors to the index. See `InteractiveIndex.add()` for
+        a description of the arguments.
+
+        """
+
+        index = self.index
+        xb = index._convert_src_to_numpy(xb_src)
+        ids = index._prepare_ids(len(xb), ids, ids_extra)
+
+        idx = 0
+        while idx < len(xb):
+            if self._shard is None:
+                self._open_shard()
+
+            end_idx = idx + min(
+                index.vectors_per_index - self._shard.ntotal,
+                len(xb) - idx
+            )
+
+            self._shard.add_with_ids(xb[idx:end_idx], ids[idx:end_idx])
+            index.n_vectors += (end_idx - idx)
+            self._dirty = True
+
+            # Write out the shard as soon as it is full
+            if self._shard.ntotal >= index.vectors_per_index:
+                self._write_shard()
+
+            idx = end_idx
+
+    def flush(self) -> None:
+        """Writes the open shard (if modified) to disk, keeping it open."""
+
+        if self._shard is None or not self._dirty:
+            return
+
+        faiss.write_index(self._shard, str(self._shard_path()))
+        self._dirty = False
+
+        if self.update_metadata:
+            self.index._save_metadata()
+
+    def close(self) -> None:
+        """Writes the open shard to disk and releases it."""
+
+        self._write_shard()
+
+    def _open_shard(self) -> None:
+        index = self.index
+
+        if index.n_indexes > index.n_merged_indexes:
+            # Resume filling the last partial shard, unless it is already full
+            self._shard_num = index.n_indexes - 1
+            self._shard = faiss.read_index(str(self._shard_path()))
+            if self._shard.ntotal < index.vectors_per_index:
+                return
+
+        # Need to create a new shard (shards that were already merged are
+        # never added to, so that they can be appended to the merged index)
+        self._shard = faiss.read_index(
+            str(index.tempdir/index.TRAINED_INDEX_NAME)
+        )
+        self._shard_num = index.n_indexes
+        index.n_indexes += 1
+
+    def _write_shard(self) -> None:
+        self.flush()
+
+        if self._shard is not None:
+            self._shard.reset()
+            self._shard = None
+            self._shard_num = None
+
+    def _shard_path(self) -> Path:
+        return self.index.tempdir/self.index.SHARD_INDEX_NAME_TMPL.format(
+            self._shard_num
+        )
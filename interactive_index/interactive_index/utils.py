@@ -6,8 +6,11 @@ functions should likely not be called manually.
 
 """
 
+import concurrent.futures
+from dataclasses import dataclass
 import math
-from typing import List, Optional, Tuple
+import threading
+from typing import Callable, List, Optional, Tuple
 
 import faiss
 import numpy as np
@@ -44,23 +47,81 @@ def round_up_to_mult(x: int, m: int) -> int:
     return (x + m - 1) // m * m
 
 
+@dataclass
+class MergeProgress:
+    """
+    Progress of a `merge_on_disk()` call. Updated in place by the merge, so it
+    can be polled from another thread.
+
+    """
+
+    n_lists: int = 0
+    n_lists_done: int = 0
+    n_bytes: int = 0
+    n_bytes_written: int = 0
+    finished: bool = False
+
+    def __post_init__(self):
+        self._lock = threading.Lock()
+
+    def update(self, n_lists_done: int, n_bytes_written: int) -> None:
+        with self._lock:
+            self.n_lists_done += n_lists_done
+            self.n_bytes_written += n_bytes_written
+
+    def to_dict(self) -> dict:
+        return {
+            'n_lists': self.n_lists,
+            'n_lists_done': self.n_lists_done,
+            'n_bytes': self.n_bytes,
+            'n_bytes_written': self.n_bytes_written,
+            'finished': self.finished,
+        }
+
+
 def merge_on_disk(
-	trained_index: faiss.Index,
+    trained_index: faiss.Index,
     shard_fnames: List[str],
-    ivfdata_fname: str
+    ivfdata_fname: str,
+    n_threads: int = 1,
+    progress: Optional[MergeProgress] = None
 ) -> None:
     """
-	Adds the contents of the indexes stored in shard_fnames into the index
+    Adds the contents of the indexes stored in shard_fnames into the index
     trained_index. The on-disk data is stored in ivfdata_fname.
 
     Args:
         trained_index: The trained index to add the data to.
         shard_fnames: A list of the partial index filenames.
         ivfdata_fname: The filename for the on-disk extracted data.
+        n_threads: The number of threads to copy inverted lists with.
+        progress: If given, updated with the number of lists and bytes
+            merged so far.
+
+    """
 
-	"""
+    merge_invlists_on_disk(
+        trained_index,
+        load_shard_invlists(shard_fnames),
+        ivfdata_fname,
+        n_threads,
+        progress
+    )
+
+
+def load_shard_invlists(shard_fnames: List[str]) -> List['faiss.InvertedLists']:
+    """
+    Loads the inverted lists of the partial indexes stored in shard_fnames
+    without reading their data into memory.
+
+    Args:
+        shard_fnames: A list of the partial index filenames.
+
+    Returns:
+        The inverted lists, which are not owned by any index.
+
+    """
 
-    # Load the inverted lists
     ivfs = []
     for fname in shard_fnames:
         # The IO_FLAG_MMAP is to avoid actually loading the data, and thus the
@@ -72,6 +133,38 @@ def merge_on_disk(
         # Avoid deallocating the invlists with the index
         index_ivf.own_invlists = False
 
+    return ivfs
+
+
+def merge_invlists_on_disk(
+    trained_index: faiss.Index,
+    ivfs: List['faiss.InvertedLists'],
+    ivfdata_fname: str,
+    n_threads: int = 1,
+    progress: Optional[MergeProgress] = None,
+    id_filter: Optional[Callable[[np.ndarray], np.ndarray]] = None
+) -> None:
+    """
+    Merges the inverted lists ivfs into the empty index trained_index. The
+    on-disk data is stored in ivfdata_fname.
+
+    The space for every inverted list is reserved up front, so the lists
+    occupy disjoint regions of ivfdata_fname and can be copied in by
+    n_threads threads, each handling a contiguous range of lists. FAISS
+    releases the GIL while copying.
+
+    Args:
+        trained_index: The trained index to add the data to.
+        ivfs: The inverted lists to merge.
+        ivfdata_fname: The filename for the on-disk extracted data.
+        n_threads: The number of threads to copy inverted lists with.
+        progress: If given, updated with the number of lists and bytes
+            merged so far.
+        id_filter: If given, called with the IDs of each inverted list and
+            returns a boolean mask of the entries to keep.
+
+    """
+
     # Construct the output index
     index = trained_index
     index_ivf = faiss.extract_index_ivf(index)
@@ -79,21 +172,229 @@ def merge_on_disk(
     assert index.ntotal == 0, 'The trained index should be empty'
 
     # Prepare the output inverted lists, which are written to ivfdata_fname.
-    invlists = faiss.OnDiskInvertedLists(index_ivf.nlist, index_ivf.code_size,
+    nlist = index_ivf.nlist
+    code_size = index_ivf.code_size
+    entry_size = np.dtype('int64').itemsize + code_size
+    invlists = faiss.OnDiskInvertedLists(nlist, index_ivf.code_size,
                                          ivfdata_fname)
 
-    # Merge all the inverted lists
-    ivf_vector = faiss.InvertedListsPtrVector()
+    # Reserve space for each merged list; the file is grown once up front so
+    # that it is not remapped while lists are being written, and each list
+    # gets its own disjoint region
+    list_sizes = np.zeros(nlist, dtype=np.int64)
     for ivf in ivfs:
-        ivf_vector.push_back(ivf)
-
-    n_total = invlists.merge_from(ivf_vector.data(), ivf_vector.size())
+        if id_filter is None:
+            list_sizes += [ivf.list_size(i) for i in range(nlist)]
+        else:
+            list_sizes += [
+                np.count_nonzero(id_filter(get_list_ids(ivf, i)))
+                for i in range(nlist)
+            ]
+    n_total = int(list_sizes.sum())
+
+    if n_total > 0:
+        invlists.update_totsize(n_total * entry_size)
+
+        # Mark the whole file as used so later appends never reuse this space
+        offset = invlists.allocate_slot(n_total * entry_size)
+        if offset != 0:
+            raise RuntimeError(
+                f'Expected to reserve {ivfdata_fname} from offset 0, got {offset}'
+            )
+
+    # Lay the lists out back to back. The list vector is copied out by value
+    # from Python, so build a new one and swap it in.
+    offsets = np.concatenate([[0], np.cumsum(list_sizes)[:-1]]) * entry_size
+    lists = faiss.OnDiskOneListVector()
+    for offset, list_size in zip(offsets.tolist(), list_sizes.tolist()):
+        l = faiss.OnDiskOneList()
+        l.offset, l.capacity, l.size = offset, list_size, list_size
+        lists.push_back(l)
+    invlists.lists.swap(lists)
+
+    if progress is not None:
+        progress.n_lists = nlist
+        progress.n_bytes = n_total * entry_size
+
+    def merge_lists(list_range: range) -> None:
+        for list_no in list_range:
+            offset = 0
+            for ivf in ivfs:
+                n_entries = ivf.list_size(list_no)
+                if n_entries == 0:
+                    continue
+
+                if id_filter is not None:
+                    ids = get_list_ids(ivf, list_no)
+                    keep = id_filter(ids)
+                    if not keep.all():
+                        ids = np.ascontiguousarray(ids[keep])
+                        codes = np.ascontiguousarray(
+                            get_list_codes(ivf, list_no, code_size)[keep]
+                        )
+                        invlists.update_entries(
+                            list_no, offset, len(ids),
+                            faiss.swig_ptr(ids), faiss.swig_ptr(codes)
+                        )
+                        offset += len(ids)
+                        continue
+
+                ids = ivf.get_ids(list_no)
+                codes = ivf.get_codes(list_no)
+                invlists.update_entries(list_no, offset, n_entries, ids, codes)
+                ivf.release_codes(list_no, codes)
+                ivf.release_ids(list_no, ids)
+                offset += n_entries
+
+            if progress is not None:
+                progress.update(1, offset * entry_size)
+
+    # Use several ranges per thread so that uneven list sizes balance out
+    n_ranges = max(1, min(nlist, 4 * n_threads))
+    bounds = np.linspace(0, nlist, n_ranges + 1, dtype=np.int64)
+    list_ranges = [range(int(a), int(b)) for a, b in zip(bounds, bounds[1:])]
+
+    if n_threads > 1:
+        with concurrent.futures.ThreadPoolExecutor(n_threads) as pool:
+            for future in [pool.submit(merge_lists, r) for r in list_ranges]:
+                future.result()
+    else:
+        for r in list_ranges:
+            merge_lists(r)
 
     # Replace the inverted lists in the output index
     index.ntotal = index_ivf.ntotal = n_total
     index_ivf.replace_invlists(invlists, True)
     invlists.this.disown()
 
+    if progress is not None:
+        progress.finished = True
+
+
+def get_list_ids(ivf: 'faiss.InvertedLists', list_no: int) -> np.ndarray:
+    """Returns a copy of the IDs stored in one inverted list."""
+
+    list_size = ivf.list_size(list_no)
+    list_ids = np.zeros(list_size, dtype=np.int64)
+    if list_size == 0:
+        return list_ids
+
+    # Need to copy since memory will be deallocated along with the invlist.
+    temp_ids = ivf.get_ids(list_no)
+    faiss.memcpy(faiss.swig_ptr(list_ids), temp_ids, list_ids.nbytes)
+    ivf.release_ids(list_no, temp_ids)
+    return list_ids
+
+
+def get_list_codes(
+    ivf: 'faiss.InvertedLists',
+    list_no: int,
+    code_size: int
+) -> np.ndarray:
+    """Returns a copy of the codes stored in one inverted list, one per row."""
+
+    list_size = ivf.list_size(list_no)
+    list_codes = np.zeros((list_size, code_size), dtype=np.uint8)
+    if list_size == 0:
+        return list_codes
+
+    temp_codes = ivf.get_codes(list_no)
+    faiss.memcpy(faiss.swig_ptr(list_codes), temp_codes, list_codes.nbytes)
+    ivf.release_codes(list_no, temp_codes)
+    return list_codes
+
+
+def copy_invlists_on_disk(
+    invlists: 'faiss.InvertedLists',
+    ivfdata_fname: str
+) -> 'faiss.OnDiskInvertedLists':
+    """
+    Copies on-disk inverted lists, including any space left between them, to
+    a new ".ivfdata" file. The copy has no free slots, so lists that outgrow
+    theirs later are moved to the end of the file rather than into a hole.
+
+    Args:
+        invlists: The on-disk inverted lists to copy.
+        ivfdata_fname: The filename for the copied data.
+
+    Returns:
+        The copied inverted lists, which are not owned by any index.
+
+    """
+
+    src = faiss.downcast_InvertedLists(invlists)
+    assert isinstance(src, faiss.OnDiskInvertedLists), \
+        'Can only copy on-disk inverted lists'
+
+    dst = faiss.OnDiskInvertedLists(src.nlist, src.code_size, ivfdata_fname)
+    if src.totsize > 0:
+        dst.update_totsize(src.totsize)
+        offset = dst.allocate_slot(src.totsize)
+        if offset != 0:
+            raise RuntimeError(
+                f'Expected to reserve {ivfdata_fname} from offset 0, got {offset}'
+            )
+        faiss.memcpy(dst.ptr, src.ptr, src.totsize)
+
+    # The list vector is copied out by value from Python, so build a new one
+    # and swap it in
+    lists = faiss.OnDiskOneListVector()
+    for list_no in range(src.nlist):
+        src_list = src.lists.at(list_no)
+        l = faiss.OnDiskOneList()
+        l.offset, l.capacity, l.size = (
+            src_list.offset, src_list.capacity, src_list.size
+        )
+        lists.push_back(l)
+    dst.lists.swap(lists)
+
+    return dst
+
+
+def append_on_disk(
+    merged_index: faiss.Index,
+    shard_fnames: List[str]
+) -> int:
+    """
+    Appends the contents of the indexes stored in shard_fnames to the on-disk
+    inverted lists of the already merged index merged_index, in place.
+
+    Lists that outgrow their reserved space are moved to a larger slot of the
+    ".ivfdata" file, which leaves holes behind; rewrite the index with
+    `merge_invlists_on_disk()` occasionally to reclaim them.
+
+    Args:
+        merged_index: The merged index, which must not be opened read-only.
+        shard_fnames: A list of the partial index filenames.
+
+    Returns:
+        The number of vectors appended.
+
+    """
+
+    index_ivf = faiss.extract_index_ivf(merged_index)
+    invlists = faiss.downcast_InvertedLists(index_ivf.invlists)
+    assert isinstance(invlists, faiss.OnDiskInvertedLists), \
+        'Can only append to an index with on-disk inverted lists'
+
+    n_appended = 0
+    for ivf in load_shard_invlists(shard_fnames):
+        for list_no in range(index_ivf.nlist):
+            n_entries = ivf.list_size(list_no)
+            if n_entries == 0:
+                continue
+
+            ids = ivf.get_ids(list_no)
+            codes = ivf.get_codes(list_no)
+            invlists.add_entries(list_no, n_entries, ids, codes)
+            ivf.release_codes(list_no, codes)
+            ivf.release_ids(list_no, ids)
+            n_appended += n_entries
+
+    merged_index.ntotal = index_ivf.ntotal = index_ivf.ntotal + n_appended
+
+    return n_appended
+
 
 def to_all_gpus(
     cpu_index: faiss.Index,
@@ -137,6 +438,117 @@ def invert_cantor_pairing(z: int) -> Tuple[int, int]:
     return x, y
 
 
+def bitpack_pairing(a: np.ndarray, b: np.ndarray, n_bits: int) -> np.ndarray:
+    """
+    Packs two arrays of non-negative integers into a single int64 array, with
+    `a` in the high bits and `b` in the low `n_bits` bits.
+
+    Args:
+        a: The IDs to store in the high bits.
+        b: The extra IDs to store in the low bits.
+        n_bits: The number of bits reserved for `b`.
+
+    Returns:
+        The packed IDs.
+
+    Raises:
+        ValueError: If any ID is negative or does not fit in its bit field.
+
+    """
+
+    a = np.asarray(a, dtype=np.int64)
+    b = np.asarray(b, dtype=np.int64)
+
+    if a.size and (a.min() < 0 or a.max() >= 1 << (63 - n_bits)):
+        raise ValueError(f'IDs must be in [0, 2**{63 - n_bits}) to be packed')
+    if b.size and (b.min() < 0 or b.max() >= 1 << n_bits):
+        raise ValueError(f'Extra IDs must be in [0, 2**{n_bits}) to be packed')
+
+    return (a << n_bits) | b
+
+
+def invert_bitpack_pairing(
+    z: np.ndarray,
+    n_bits: int
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Inverts `bitpack_pairing()`. Negative IDs (e.g., the -1 FAISS returns for
+    missing results) are passed through unchanged in both outputs.
+
+    Args:
+        z: The packed IDs.
+        n_bits: The number of bits reserved for the extra IDs.
+
+    Returns:
+        The IDs and the extra IDs.
+
+    """
+
+    z = np.asarray(z, dtype=np.int64)
+    missing = z < 0
+
+    a = np.where(missing, z, z >> n_bits)
+    b = np.where(missing, z, z & ((1 << n_bits) - 1))
+    return a, b
+
+
+def bitmap_add(bitmap: np.ndarray, ids: np.ndarray) -> np.ndarray:
+    """
+    Returns a copy of the bitmap with the bits for the given IDs set, growing
+    it if necessary. Bit i is stored in byte i // 8 at position i % 8.
+
+    Args:
+        bitmap: The bitmap, as a uint8 array.
+        ids: The non-negative IDs to set.
+
+    Returns:
+        The updated bitmap.
+
+    """
+
+    ids = np.asarray(ids, dtype=np.int64).ravel()
+    bitmap = bitmap.copy()
+    if ids.size == 0:
+        return bitmap
+
+    if ids.min() < 0:
+        raise ValueError('Only non-negative IDs can be stored in a bitmap')
+
+    n_bytes = int(ids.max()) // 8 + 1
+    if n_bytes > len(bitmap):
+        bitmap = np.concatenate(
+            [bitmap, np.zeros(n_bytes - len(bitmap), dtype=np.uint8)]
+        )
+
+    np.bitwise_or.at(bitmap, ids >> 3, (1 << (ids & 7)).astype(np.uint8))
+    return bitmap
+
+
+def bitmap_contains(bitmap: np.ndarray, ids: np.ndarray) -> np.ndarray:
+    """
+    Returns a boolean mask of which IDs are set in the bitmap. Negative IDs
+    and IDs past the end of the bitmap are never set.
+
+    """
+
+    ids = np.asarray(ids, dtype=np.int64)
+    in_range = (ids >= 0) & ((ids >> 3) < len(bitmap))
+
+    mask = np.zeros(ids.shape, dtype=bool)
+    ids = ids[in_range]
+    mask[in_range] = (bitmap[ids >> 3] >> (ids & 7)) & 1 == 1
+    return mask
+
+
+def bitmap_remove(bitmap: np.ndarray, other: np.ndarray) -> np.ndarray:
+    """Returns a copy of the bitmap with every bit set in other cleared."""
+
+    bitmap = bitmap.copy()
+    n_bytes = min(len(bitmap), len(other))
+    bitmap[:n_bytes] &= ~other[:n_bytes]
+    return bitmap
+
+
 def sample_farthest_vectors(
     index: 'InteractiveIndex',
     xq: np.ndarray,
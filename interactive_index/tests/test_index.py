@@ -0,0 +1,398 @@
+import concurrent.futures
+import json
+
+import faiss
+import numpy as np
+import pytest
+
+from interactive_index import InteractiveIndex
+from interactive_index import index as index_module
+from interactive_index.utils import MergeProgress, bitmap_add
+
+
+D = 16
+N_CENTROIDS = 8
+
+
+def make_index(tmp_path, **kwargs) -> InteractiveIndex:
+    cfg = dict(
+        d=D,
+        n_centroids=N_CENTROIDS,
+        n_probes=N_CENTROIDS,
+        vectors_per_index=100,
+        tempdir=str(tmp_path),
+    )
+    cfg.update(kwargs)
+    return InteractiveIndex(**cfg)
+
+
+@pytest.fixture
+def vectors():
+    return np.random.default_rng(0).random((500, D), dtype=np.float32)
+
+
+@pytest.fixture
+def merged_index(tmp_path, vectors):
+    index = make_index(tmp_path)
+    index.train(vectors)
+    index.add(vectors)
+    index.merge_partial_indexes()
+    return index
+
+
+def exact_neighbors(vectors, queries, k, ids=None):
+    dists = ((queries[:, None, :] - vectors[None, :, :]) ** 2).sum(axis=2)
+    inds = np.argsort(dists, axis=1, kind="stable")[:, :k]
+    return inds if ids is None else np.asarray(ids)[inds]
+
+
+def test_merged_index_handle_is_cached_until_rewritten(merged_index, vectors):
+    handle = merged_index._get_merged_index()
+    merged_index.query(vectors[:3], k=5)
+    assert merged_index._get_merged_index() is handle
+
+    merged_index.merge_partial_indexes()
+    assert merged_index._get_merged_index() is not handle
+
+
+def test_n_probes_is_per_query(merged_index, vectors):
+    queries = vectors[:20]
+    expected = {
+        n_probes: merged_index.query(queries, k=10, n_probes=n_probes)
+        for n_probes in (1, N_CENTROIDS)
+    }
+    np.testing.assert_array_equal(
+        expected[N_CENTROIDS][1], exact_neighbors(vectors, queries, 10)
+    )
+
+    # Queries with different n_probes running at the same time must not see
+    # each other's settings
+    with concurrent.futures.ThreadPoolExecutor(8) as pool:
+        futures = [
+            (n_probes, pool.submit(merged_index.query, queries, 10, n_probes))
+            for _ in range(20)
+            for n_probes in (1, N_CENTROIDS)
+        ]
+        for n_probes, future in futures:
+            dists, inds = future.result()
+            np.testing.assert_array_equal(inds, expected[n_probes][1])
+            np.testing.assert_array_equal(dists, expected[n_probes][0])
+
+    # The configured n_probes is untouched
+    assert merged_index.n_probes == N_CENTROIDS
+
+
+def test_queries_are_served_while_merging(merged_index, vectors, monkeypatch):
+    queries = vectors[:20]
+    expected = merged_index.query(queries, k=10)
+    merge_on_disk = index_module.merge_on_disk
+
+    def merge_while_querying(*args, **kwargs):
+        merge_on_disk(*args, **kwargs)
+        with concurrent.futures.ThreadPoolExecutor(1) as pool:
+            # Served from the previous merge without waiting for this one
+            dists, inds = pool.submit(merged_index.query, queries, 10).result(
+                timeout=10
+            )
+        np.testing.assert_array_equal(inds, expected[1])
+        np.testing.assert_array_equal(dists, expected[0])
+
+    monkeypatch.setattr(index_module, "merge_on_disk", merge_while_querying)
+    merged_index.merge_partial_indexes()
+
+    _, inds = merged_index.query(queries, k=10)
+    np.testing.assert_array_equal(inds, expected[1])
+    assert not (merged_index.tempdir / "merged.merging").exists()
+
+
+def test_parallel_merge_reports_progress(tmp_path, vectors):
+    index = make_index(tmp_path)
+    index.train(vectors)
+    index.add(vectors)
+
+    progress = MergeProgress()
+    index.merge_partial_indexes(n_threads=4, progress=progress)
+    assert progress.finished
+    assert progress.n_lists_done == progress.n_lists == N_CENTROIDS
+    assert progress.n_bytes_written == progress.n_bytes > 0
+
+    assert sum(index.get_cluster_sizes()) == len(vectors)
+    queries = vectors[:20]
+    _, inds = index.query(queries, k=10)
+    np.testing.assert_array_equal(inds, exact_neighbors(vectors, queries, 10))
+
+
+def test_append_partial_indexes(tmp_path, vectors):
+    index = make_index(tmp_path, compaction_threshold=0.3)
+    index.train(vectors)
+    index.add(vectors[:300])
+    index.merge_partial_indexes()
+    queries = vectors[:20]
+
+    index.add(vectors[300:400], np.arange(300, 400))
+    index.append_partial_indexes()
+    assert index.n_appended == 100
+    _, inds = index.query(queries, k=10)
+    np.testing.assert_array_equal(
+        inds, exact_neighbors(vectors[:400], queries, 10)
+    )
+
+    # Past compaction_threshold of the index, appends trigger a compaction
+    index.add(vectors[400:], np.arange(400, 500))
+    index.append_partial_indexes()
+    assert index.n_appended == 0
+    _, inds = index.query(queries, k=10)
+    np.testing.assert_array_equal(inds, exact_neighbors(vectors, queries, 10))
+
+    reloaded = InteractiveIndex.load(str(tmp_path))
+    _, inds = reloaded.query(queries, k=10)
+    np.testing.assert_array_equal(inds, exact_neighbors(vectors, queries, 10))
+
+
+def test_append_leaves_open_handles_intact(merged_index, vectors):
+    # A query that is still using the handle from before the append, and the
+    # data file it maps
+    handle = merged_index._get_merged_index()
+    params = faiss.SearchParametersIVF(nprobe=N_CENTROIDS)
+    expected = handle.search(vectors, 10, params=params)
+    with open(merged_index.tempdir / "merged.ivfdata", "rb") as f:
+        data = f.read()
+
+        merged_index.add(vectors[:100], np.arange(500, 600))
+        merged_index.append_partial_indexes()
+
+        # Lists that outgrew their slots were moved, but not within this file
+        f.seek(0)
+        assert f.read() == data
+
+    dists, inds = handle.search(vectors, 10, params=params)
+    np.testing.assert_array_equal(inds, expected[1])
+    np.testing.assert_array_equal(dists, expected[0])
+    assert sum(merged_index.get_cluster_sizes()) == 600
+
+
+def test_append_requires_merged_index(tmp_path, vectors):
+    index = make_index(tmp_path)
+    index.train(vectors)
+    index.add(vectors)
+    with pytest.raises(RuntimeError):
+        index.append_partial_indexes()
+
+
+def count_shard_writes(monkeypatch):
+    writes = []
+    write_index = faiss.write_index
+
+    def counting_write_index(index, path):
+        if "shard_" in path:
+            writes.append((path, index.ntotal))
+        write_index(index, path)
+
+    monkeypatch.setattr(faiss, "write_index", counting_write_index)
+    return writes
+
+
+def test_writer_only_writes_full_shards_and_on_close(tmp_path, vectors, monkeypatch):
+    index = make_index(tmp_path)
+    index.train(vectors)
+    writes = count_shard_writes(monkeypatch)
+
+    with index.writer() as writer:
+        for start in range(0, 250, 25):
+            writer.add(vectors[start : start + 25], np.arange(start, start + 25))
+        assert [ntotal for _, ntotal in writes] == [100, 100]
+
+    assert [ntotal for _, ntotal in writes] == [100, 100, 50]
+    assert index.n_indexes == 3
+    assert index.n_vectors == 250
+
+    index.merge_partial_indexes()
+    queries = vectors[:10]
+    _, inds = index.query(queries, k=5)
+    np.testing.assert_array_equal(inds, exact_neighbors(vectors[:250], queries, 5))
+
+
+def test_writer_flush_keeps_shard_open(tmp_path, vectors, monkeypatch):
+    index = make_index(tmp_path)
+    index.train(vectors)
+    writes = count_shard_writes(monkeypatch)
+
+    with index.writer() as writer:
+        writer.add(vectors[:30])
+        writer.flush()
+        writer.flush()  # nothing new to write
+        writer.add(vectors[30:60])
+
+    assert [ntotal for _, ntotal in writes] == [30, 60]
+    assert index.n_indexes == 1
+
+
+def test_writer_resumes_partial_shard(tmp_path, vectors):
+    index = make_index(tmp_path)
+    index.train(vectors)
+
+    index.add(vectors[:50])
+    with index.writer() as writer:
+        writer.add(vectors[50:130])
+
+    assert index.n_indexes == 2
+    shard_sizes = [
+        faiss.read_index(
+            str(tmp_path / index.SHARD_INDEX_NAME_TMPL.format(shard_num))
+        ).ntotal
+        for shard_num in range(index.n_indexes)
+    ]
+    assert shard_sizes == [100, 30]
+
+
+@pytest.fixture
+def multi_id_index(tmp_path, vectors):
+    # 100 images with 5 vectors each
+    index = make_index(tmp_path, multi_id=True)
+    index.train(vectors)
+    index.add(vectors, np.arange(500) // 5, ids_extra=np.arange(500) % 5)
+    index.merge_partial_indexes()
+    return index
+
+
+def allowed_bitmap(ids):
+    return bitmap_add(np.zeros(0, dtype=np.uint8), ids)
+
+
+def test_removed_ids_are_skipped_during_search(merged_index, vectors):
+    removed = np.arange(0, 500, 3)
+    merged_index.remove_ids(removed)
+    kept = np.setdiff1d(np.arange(500), removed)
+
+    queries = vectors[:20]
+    _, inds = merged_index.query(queries, k=10)
+    np.testing.assert_array_equal(
+        inds, exact_neighbors(vectors[kept], queries, 10, kept)
+    )
+
+    # Also combined with an allowed set
+    allowed = np.arange(250)
+    _, inds = merged_index.query(queries, k=10, allowed_ids=allowed_bitmap(allowed))
+    expected_ids = np.intersect1d(kept, allowed)
+    np.testing.assert_array_equal(
+        inds, exact_neighbors(vectors[expected_ids], queries, 10, expected_ids)
+    )
+
+
+def test_removed_multi_ids_are_skipped_during_search(multi_id_index, vectors):
+    removed_images = np.arange(0, 100, 3)
+    multi_id_index.remove_ids(removed_images)
+    image_ids = np.arange(500) // 5
+    kept = np.flatnonzero(~np.isin(image_ids, removed_images))
+
+    queries = vectors[:20]
+    _, (ids, ids_extra) = multi_id_index.query(queries, k=50)
+    expected = exact_neighbors(vectors[kept], queries, 50, kept)
+    np.testing.assert_array_equal(ids, image_ids[expected])
+    np.testing.assert_array_equal(ids_extra, expected % 5)
+
+    # Rows stay full when only some lists are probed
+    _, (ids, _) = multi_id_index.query(queries, k=20, n_probes=2)
+    assert (ids >= 0).all()
+    assert not np.isin(ids, removed_images).any()
+
+    # Also combined with an allowed set
+    allowed_images = np.arange(50)
+    _, (ids, ids_extra) = multi_id_index.query(
+        queries, k=50, allowed_ids=allowed_bitmap(allowed_images)
+    )
+    expected_rows = kept[np.isin(image_ids[kept], allowed_images)]
+    expected = exact_neighbors(vectors[expected_rows], queries, 50, expected_rows)
+    np.testing.assert_array_equal(ids, image_ids[expected])
+    np.testing.assert_array_equal(ids_extra, expected % 5)
+
+
+def test_multi_id_filters_dont_scan_probed_lists(
+    multi_id_index, vectors, monkeypatch
+):
+    multi_id_index.remove_ids([0, 1])
+    queries = vectors[:20]
+    multi_id_index.query(queries, k=10)
+
+    # The stored IDs of removed vectors are looked up once, not per query
+    list_reads = []
+    get_list_ids = index_module.get_list_ids
+    monkeypatch.setattr(
+        index_module, 'get_list_ids',
+        lambda *args: list_reads.append(args) or get_list_ids(*args)
+    )
+    image_ids = np.arange(500) // 5
+    allowed_images = np.arange(2, 12)
+    _, (ids, _) = multi_id_index.query(
+        queries, k=10, allowed_ids=allowed_bitmap(allowed_images)
+    )
+    assert not list_reads
+    expected_rows = np.flatnonzero(np.isin(image_ids, allowed_images))
+    expected = exact_neighbors(vectors[expected_rows], queries, 10, expected_rows)
+    np.testing.assert_array_equal(ids, image_ids[expected])
+
+    # Removing more vectors takes effect on the next query
+    multi_id_index.remove_ids([2])
+    _, (ids, _) = multi_id_index.query(
+        queries, k=10, allowed_ids=allowed_bitmap(allowed_images)
+    )
+    assert not np.isin(ids, [0, 1, 2]).any()
+
+    # Large allowed sets are matched against the probed lists instead
+    _, (ids, _) = multi_id_index.query(
+        queries, k=10, n_probes=1, allowed_ids=allowed_bitmap(np.arange(90))
+    )
+    assert list_reads
+    assert not np.isin(ids, [0, 1, 2]).any()
+    assert (ids[ids >= 0] < 90).all()
+
+
+def test_compact_drops_removed_vectors(multi_id_index, vectors, tmp_path):
+    removed_images = np.arange(0, 100, 2)
+    multi_id_index.remove_ids(removed_images)
+    assert multi_id_index.get_tombstone_ratio() == pytest.approx(0.5)
+    assert multi_id_index.maybe_compact()
+
+    assert multi_id_index.n_removed == 0
+    assert multi_id_index.get_tombstone_ratio() == 0.0
+    assert sum(multi_id_index.get_cluster_sizes()) == 250
+
+    queries = vectors[:10]
+    _, (ids, _) = multi_id_index.query(queries, k=20)
+    assert not np.isin(ids, removed_images).any()
+
+    # Removing more IDs after compaction still works, and survives reloading
+    multi_id_index.remove_ids([1])
+    loaded = InteractiveIndex.load(str(tmp_path))
+    assert loaded.n_removed == 1
+    _, (ids, _) = loaded.query(vectors[5:10], k=5)
+    assert not np.isin(ids, [1]).any()
+    assert (ids >= 0).all()
+
+
+def test_multi_ids_round_trip_large_ids(tmp_path, vectors):
+    index = make_index(tmp_path, multi_id=True)
+    index.train(vectors)
+    image_ids = np.arange(500) // 5 + 10_000_000_000
+    index.add(vectors, image_ids, ids_extra=np.arange(500) % 5)
+    index.merge_partial_indexes()
+
+    _, (ids, ids_extra) = index.query(vectors[:20], k=1)
+    np.testing.assert_array_equal(ids[:, 0], image_ids[:20])
+    np.testing.assert_array_equal(ids_extra[:, 0], np.arange(20) % 5)
+
+
+def test_multi_ids_reject_extra_ids_that_dont_fit(tmp_path, vectors):
+    index = make_index(tmp_path, multi_id=True, id_extra_bits=2)
+    index.train(vectors)
+    with pytest.raises(ValueError):
+        index.add(vectors[:5], np.zeros(5), ids_extra=np.arange(5))
+
+
+def test_legacy_multi_id_index_keeps_cantor_encoding(multi_id_index, tmp_path):
+    meta_path = tmp_path / InteractiveIndex.META_FILE_NAME
+    meta = json.loads(meta_path.read_text())
+    assert meta['cfg'].pop('id_encoding') == 'bitpack'
+    meta_path.write_text(json.dumps(meta))
+
+    assert InteractiveIndex.load(str(tmp_path)).id_encoding == 'cantor'
@@ -0,0 +1,75 @@
+import numpy as np
+import pytest
+
+from interactive_index.utils import (bitmap_add, bitmap_contains, bitmap_remove,
+                                     bitpack_pairing, cantor_pairing,
+                                     invert_bitpack_pairing,
+                                     invert_cantor_pairing)
+
+
+def test_bitpack_round_trip():
+    rng = np.random.default_rng(0)
+    a = rng.integers(0, 1 << 47, 1000)
+    b = rng.integers(0, 1 << 16, 1000)
+
+    z = bitpack_pairing(a, b, 16)
+    assert z.dtype == np.int64 and (z >= 0).all()
+    decoded_a, decoded_b = invert_bitpack_pairing(z, 16)
+    np.testing.assert_array_equal(decoded_a, a)
+    np.testing.assert_array_equal(decoded_b, b)
+
+
+def test_bitpack_handles_ids_too_large_for_cantor():
+    a = np.array([10_000_000_000])
+    b = np.array([7])
+    # Cantor pairing overflows int64 well before this
+    assert cantor_pairing(int(a[0]), int(b[0])) >= 1 << 63
+
+    decoded_a, decoded_b = invert_bitpack_pairing(bitpack_pairing(a, b, 16), 16)
+    assert (decoded_a[0], decoded_b[0]) == (a[0], b[0])
+
+
+@pytest.mark.parametrize('a, b', [
+    ([-1], [0]),
+    ([1 << 47], [0]),
+    ([0], [-1]),
+    ([0], [1 << 16]),
+])
+def test_bitpack_rejects_out_of_range_ids(a, b):
+    with pytest.raises(ValueError):
+        bitpack_pairing(np.array(a), np.array(b), 16)
+
+
+def test_invert_bitpack_passes_missing_ids_through():
+    z = np.array([-1, bitpack_pairing(np.array([5]), np.array([2]), 16)[0]])
+    a, b = invert_bitpack_pairing(z, 16)
+    np.testing.assert_array_equal(a, [-1, 5])
+    np.testing.assert_array_equal(b, [-1, 2])
+
+
+def test_cantor_round_trip():
+    for a, b in [(0, 0), (3, 9), (12345, 678)]:
+        assert invert_cantor_pairing(cantor_pairing(a, b)) == (a, b)
+    assert invert_cantor_pairing(-1) == (-1, -1)
+
+
+def test_bitmap_operations():
+    empty = np.zeros(0, dtype=np.uint8)
+    bitmap = bitmap_add(empty, np.array([0, 9, 9, 63]))
+    assert len(bitmap) == 8
+    assert len(empty) == 0  # not modified in place
+
+    ids = np.array([-1, 0, 1, 9, 63, 64, 1000])
+    np.testing.assert_array_equal(
+        bitmap_contains(bitmap, ids),
+        [False, True, False, True, True, False, False],
+    )
+
+    removed = bitmap_remove(bitmap, bitmap_add(empty, np.array([9, 500])))
+    np.testing.assert_array_equal(
+        bitmap_contains(removed, ids),
+        [False, True, False, False, True, False, False],
+    )
+
+    with pytest.raises(ValueError):
+        bitmap_add(empty, np.array([-1]))
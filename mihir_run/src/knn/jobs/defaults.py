@@ -3,3 +3,5 @@ N_RETRIES = 3
 CHUNK_SIZE = 5
 DESIRED_ULIMIT = 8192
 REQUEST_TIMEOUT = 90  # seconds
+N_FINALIZE_ROUNDS = 10
+FINALIZE_REQUESTS_PER_WORKER = 2
@@ -90,6 +90,7 @@ class MapReduceJob:
         n_retries: int = defaults.N_RETRIES,
         chunk_size: int = defaults.CHUNK_SIZE,
         request_timeout: int = defaults.REQUEST_TIMEOUT,
+        finalize_mappers: bool = False,
     ) -> None:
         self.job_id = str(uuid.uuid4())
 
@@ -101,6 +102,7 @@ class MapReduceJob:
         self.n_retries = n_retries
         self.chunk_size = chunk_size
         self.request_timeout = aiohttp.ClientTimeout(total=request_timeout)
+        self.finalize_mappers = finalize_mappers
 
         self.owns_session = session is None
         self.session = session or utils.create_unlimited_aiohttp_session()
@@ -131,6 +133,10 @@ class MapReduceJob:
                 result = await self.run_until_complete(iterable, n_total)
             except asyncio.CancelledError:
                 pass
+            except Exception:
+                print("Error from MapReduceJob (failing the job)")
+                print(textwrap.indent(traceback.format_exc(), "  "))
+                raise
             else:
                 if callback:
                     callback(result)
@@ -161,6 +167,9 @@ class MapReduceJob:
                     response_tuple = await response
                     self._reduce_chunk(*response_tuple)
 
+                if self.finalize_mappers:
+                    await self._finalize(mapper_url)
+
             if self._n_total is None:
                 self._n_total = self._n_successful + self._n_failed
             else:
@@ -273,6 +282,51 @@ class MapReduceJob:
 
         return chunk, result, end_time - start_time
 
+    async def _finalize(self, mapper_url: str) -> None:
+        # Tells every mapper worker that processed a chunk that the job is over (see
+        # Mapper.finalize_job). Requests are load balanced across workers, so keep
+        # sending them, each on a new connection, until every worker has responded.
+        pending = set(self._n_chunks_per_mapper)
+        finalize_url = f"{mapper_url.rstrip('/')}/finalize"
+
+        for _ in range(defaults.N_FINALIZE_ROUNDS):
+            if not pending:
+                return
+
+            responses = await asyncio.gather(
+                *[
+                    self._finalize_request(finalize_url)
+                    for _ in range(defaults.FINALIZE_REQUESTS_PER_WORKER * len(pending))
+                ]
+            )
+            for worker_ids in responses:
+                pending.difference_update(worker_ids)
+
+        if pending:
+            # Their buffered outputs are lost (e.g., because they restarted, which
+            # also gives them new worker IDs), so the job's output is incomplete
+            raise RuntimeError(
+                f"Could not finalize job on {len(pending)} mapper workers"
+            )
+
+    async def _finalize_request(self, finalize_url: str) -> List[str]:
+        try:
+            async with self.session.post(
+                finalize_url,
+                json={"job_id": self.job_id},
+                headers={"Connection": "close"},
+                timeout=self.request_timeout,
+            ) as response:
+                if response.status == 200:
+                    return (await response.json())["worker_ids"]
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            print("Error from _finalize_request (ignoring)")
+            print(textwrap.indent(traceback.format_exc(), "  "))
+
+        return []
+
     def _reduce_chunk(
         self, chunk: List[JSONType], result: Optional[JSONType], elapsed_time: float
     ):
@@ -13,7 +13,7 @@ from sanic import Sanic
 from sanic.response import json
 from sanic_compress import Compress
 
-from typing import Any, DefaultDict, Dict, List, Optional, Tuple
+from typing import Any, DefaultDict, Dict, List, Optional, Set, Tuple
 
 from knn.utils import JSONType
 
@@ -44,7 +44,26 @@ def _apply_timed(f, *args, **kwargs):
     return result, end_time - start_time
 
 
+class _Unlimited:
+    async def __aenter__(self):
+        pass
+
+    async def __aexit__(self, type, value, traceback):
+        pass
+
+
 class Mapper(abc.ABC):
+    # Requests go through a pipeline of three stages: fetch_chunk (e.g., downloading
+    # images), process_chunk (e.g., inference) and postprocess_chunk (e.g., saving or
+    # serializing outputs). Since requests are handled concurrently, a worker can
+    # fetch the next chunk while the current one is being processed. Subclasses bound
+    # the stages by setting:
+    # - MAX_PREFETCHED_CHUNKS: how many chunks may have started fetch_chunk without
+    #   having finished process_chunk; further requests wait before fetching
+    # - MAX_CONCURRENT_CHUNKS: how many chunks may be in process_chunk at once
+    MAX_PREFETCHED_CHUNKS: Optional[int] = None  # None = unlimited
+    MAX_CONCURRENT_CHUNKS: Optional[int] = None
+
     # BASE CLASS
 
     def initialize_container(self, *args, **kwargs) -> None:
@@ -56,6 +75,16 @@ class Mapper(abc.ABC):
     async def initialize_job(self, job_args: JSONType) -> Any:
         return job_args
 
+    async def finalize_job(self, job_id: str, job_args: Any) -> None:
+        # Called once no more chunks of the job will be sent, if the job asks for it
+        # (e.g., to write out outputs that are buffered across chunks)
+        pass
+
+    async def fetch_chunk(
+        self, chunk: List[JSONType], job_id: str, job_args: Any, request_id: str
+    ) -> Any:
+        return chunk  # passed to process_chunk in place of the chunk
+
     async def process_chunk(
         self, chunk: List[JSONType], job_id: str, job_args: Any, request_id: str
     ) -> Any:
@@ -94,6 +123,10 @@ class Mapper(abc.ABC):
 
     # UTILITY FUNCTIONS
 
+    def record(self, request_id: str, category: str, value: float):
+        # Reports a profiling value other than a duration (e.g., a throughput)
+        self._profiling_results_by_request[request_id][category].append(value)
+
     async def apply_in_executor(self, f, *args, request_id, profiler_name, **kwargs):
         with self.profiler(request_id, f"{profiler_name}_total"):
             if self.executor:
@@ -120,6 +153,8 @@ class Mapper(abc.ABC):
 
         self.worker_id = str(uuid.uuid4())
         self._args_by_job: Dict[str, Any] = {}
+        self._finalized_jobs: Set[str] = set()
+        self._n_requests_by_job: DefaultDict[str, int] = collections.defaultdict(int)
         self._profiling_results_by_request: RequestProfiler.ProfilingDictType = (
             collections.defaultdict(lambda: collections.defaultdict(list))
         )
@@ -130,10 +165,17 @@ class Mapper(abc.ABC):
         self.initialize_container(*args, **kwargs)
         self.executor = self.register_executor()
 
+        # Can't be created until there's an event loop (see _handle_request)
+        self._fetch_slots: Optional[Any] = None
+        self._process_slots: Optional[Any] = None
+        self._finalize_lock: Optional[asyncio.Lock] = None
+        self._requests_done: Optional[asyncio.Condition] = None
+
         if start_server:
             self.server = Sanic(self.worker_id)
             Compress(self.server)
             self.server.add_route(self._handle_request, "/", methods=["POST"])
+            self.server.add_route(self._handle_finalize, "/finalize", methods=["POST"])
             self.server.add_route(self._sleep, "/sleep", methods=["POST"])
         else:
             self.server = None
@@ -146,6 +188,27 @@ class Mapper(abc.ABC):
 
         request_id = str(uuid.uuid4())
         await request.receive_body()
+
+        # Chunks of a finalized job (e.g., late retries) would start buffering
+        # outputs again that are never written out
+        job_id = request.json["job_id"]
+        if job_id in self._finalized_jobs:
+            return json(
+                {"reason": f"Job {job_id} was already finalized."}, status=409
+            )
+
+        self._n_requests_by_job[job_id] += 1
+        try:
+            return await self._handle_job_request(request, request_id, init_time)
+        finally:
+            self._n_requests_by_job[job_id] -= 1
+            if not self._n_requests_by_job[job_id]:
+                del self._n_requests_by_job[job_id]
+            if self._requests_done is not None:
+                async with self._requests_done:
+                    self._requests_done.notify_all()
+
+    async def _handle_job_request(self, request, request_id: str, init_time: float):
         with self.profiler(request_id, "billed_time", additional=init_time):
             with self.profiler(request_id, "request_time"):
                 job_id = request.json["job_id"]
@@ -153,10 +216,28 @@ class Mapper(abc.ABC):
                     job_id, await self.initialize_job(request.json["job_args"])
                 )  # memoized
 
+                if self._fetch_slots is None:
+                    self._fetch_slots = self._create_slots(self.MAX_PREFETCHED_CHUNKS)
+                    self._process_slots = self._create_slots(
+                        self.MAX_CONCURRENT_CHUNKS
+                    )
+
                 chunk = request.json["inputs"]
-                raw_outputs = await self.process_chunk(
-                    chunk, job_id, job_args, request_id
-                )
+                async with self._fetch_slots:
+                    with self.profiler(request_id, "fetch_stage_time"):
+                        fetched_chunk = await self.fetch_chunk(
+                            chunk, job_id, job_args, request_id
+                        )
+                    wait_start_time = time.perf_counter()
+                    async with self._process_slots:
+                        self.record(
+                            request_id,
+                            "process_wait_time",
+                            time.perf_counter() - wait_start_time,
+                        )
+                        raw_outputs = await self.process_chunk(
+                            fetched_chunk, job_id, job_args, request_id
+                        )
                 chunk_output, final_outputs = await self.postprocess_chunk(
                     chunk, raw_outputs, job_id, job_args, request_id
                 )
@@ -170,6 +251,37 @@ class Mapper(abc.ABC):
             }
         )
 
+    async def _handle_finalize(self, request):
+        await request.receive_body()
+        worker_ids = await self._finalize(request.json["job_id"])
+        return json({"worker_ids": worker_ids})
+
+    async def _finalize(self, job_id: str) -> List[str]:
+        # Returns the IDs of the workers that are done with the job. Concurrent
+        # requests for the same job wait for the first one to finish finalizing.
+        if self._finalize_lock is None:
+            self._finalize_lock = asyncio.Lock()
+            self._requests_done = asyncio.Condition()
+
+        async with self._finalize_lock:
+            # Turn away new chunks of the job, then let the ones that already
+            # started finish
+            self._finalized_jobs.add(job_id)
+            async with self._requests_done:
+                await self._requests_done.wait_for(
+                    lambda: job_id not in self._n_requests_by_job
+                )
+
+            job_args = self._args_by_job.pop(job_id, None)
+            if job_args is not None:
+                await self.finalize_job(job_id, job_args)
+
+        return [self.worker_id]
+
+    @staticmethod
+    def _create_slots(limit: Optional[int]):
+        return asyncio.Semaphore(limit) if limit else _Unlimited()
+
     async def _sleep(self, request):
         delay = float(request.json["delay"])
         await asyncio.sleep(delay)
@@ -2,6 +2,7 @@ import asyncio
 from collections import defaultdict
 import concurrent
 from dataclasses import dataclass
+import itertools
 import multiprocessing
 import os
 
@@ -18,6 +19,11 @@ class DummyRequest:
     json: JSONType
 
 
+@dataclass
+class DummyFinalizeRequest:
+    job_id: str
+
+
 @utils.unasync
 async def run_worker(
     cls: Type[Mapper],
@@ -29,7 +35,10 @@ async def run_worker(
     mapper = cls(*args, start_server=False, **kwargs)
     while True:
         request = input_queue.get()
-        response = await mapper._handle_request(request)
+        if isinstance(request, DummyFinalizeRequest):
+            response = await mapper._finalize(request.job_id)
+        else:
+            response = await mapper._handle_request(request)
         output_queue.put(response)
 
 
@@ -72,16 +81,20 @@ class MultiprocesingMapper(Mapper):
     def register_executor(self):
         return concurrent.futures.ThreadPoolExecutor(self.nproc)
 
-    async def _handle_request(self, request):
+    def _get_worker_queue(self) -> "asyncio.Queue[int]":
         # Can't be done in initialize_container because requires async context
         # Doesn't need lock because never "await"s
         if self.worker_queue is None:
             self.worker_queue = asyncio.Queue()
             for worker_id in self.input_queues:
                 self.worker_queue.put_nowait(worker_id)
+        return self.worker_queue
+
+    async def _handle_request(self, request):
+        worker_queue = self._get_worker_queue()
 
         # Get an available worker
-        worker_id = await self.worker_queue.get()
+        worker_id = await worker_queue.get()
 
         # Send request to mapper (use DummyRequest to minimize data to be pickled)
         self.input_queues[worker_id].put(DummyRequest(request.json))
@@ -94,9 +107,32 @@ class MultiprocesingMapper(Mapper):
         )
 
         # Mark the worker as available again
-        self.worker_queue.put_nowait(worker_id)
+        worker_queue.put_nowait(worker_id)
 
         return response
 
+    async def _finalize(self, job_id: str) -> List[str]:
+        # Finalize the job in every worker process, waiting for each to be available
+        worker_queue = self._get_worker_queue()
+        worker_ids = [await worker_queue.get() for _ in self.input_queues]
+        try:
+            for worker_id in worker_ids:
+                self.input_queues[worker_id].put(DummyFinalizeRequest(job_id))
+            responses = await asyncio.gather(
+                *[
+                    self.apply_in_executor(
+                        self.output_queues[worker_id].get,
+                        request_id="UNUSED",
+                        profiler_name="UNUSED",
+                    )
+                    for worker_id in worker_ids
+                ]
+            )
+        finally:
+            for worker_id in worker_ids:
+                worker_queue.put_nowait(worker_id)
+
+        return list(itertools.chain.from_iterable(responses))
+
     async def process_element(*args, **kwargs):
         raise NotImplementedError()
@@ -159,6 +159,19 @@ def log_exception_from_coro_but_return_none(coro):
     return wrapper
 
 
+def log_exception_but_return_none(f):
+    @functools.wraps(f)
+    def wrapper(*args, **kwargs):
+        try:
+            return f(*args, **kwargs)
+        except Exception:
+            print(f"Error from {f.__name__}")
+            print(textwrap.indent(traceback.format_exc(), "  "))
+        return None
+
+    return wrapper
+
+
 def numpy_to_base64(nda):
     import numpy as np
 
@@ -0,0 +1,45 @@
+import asyncio
+import itertools
+
+import pytest
+
+from knn.jobs import MapReduceJob, MapperSpec, defaults
+from knn.reducers import ListReducer
+
+
+def make_job(worker_ids, responding_worker_ids):
+    job = MapReduceJob(
+        MapperSpec(url="http://mapper", n_mappers=1),
+        ListReducer(),
+        session=object(),  # unused; requests are stubbed out below
+        finalize_mappers=True,
+    )
+    job._n_chunks_per_mapper.update({worker_id: 1 for worker_id in worker_ids})
+
+    # Load balancing sends each request to the next worker in turn
+    responses = itertools.cycle([[worker_id] for worker_id in responding_worker_ids])
+    job.finalize_urls = []
+
+    async def finalize_request(finalize_url):
+        job.finalize_urls.append(finalize_url)
+        return next(responses)
+
+    job._finalize_request = finalize_request
+    return job
+
+
+def test_finalize_stops_once_every_worker_responded():
+    job = make_job(["a", "b", "c"], ["a", "b", "c", "d"])
+    asyncio.run(job._finalize("http://mapper/"))
+
+    # Done after the first round of two requests per worker
+    assert job.finalize_urls == ["http://mapper/finalize"] * 6
+
+
+def test_finalize_fails_the_job_on_unreachable_workers():
+    job = make_job(["a", "b"], ["a"])
+    with pytest.raises(RuntimeError):
+        asyncio.run(job._finalize("http://mapper"))
+
+    n_requests = len(job.finalize_urls)
+    assert n_requests == 4 + 2 * (defaults.N_FINALIZE_ROUNDS - 1)
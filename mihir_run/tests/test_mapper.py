@@ -0,0 +1,159 @@
+import asyncio
+
+from knn.mappers import Mapper
+
+
+class DummyRequest:
+    def __init__(self, json):
+        self.json = json
+
+    async def receive_body(self):
+        pass
+
+
+def make_request(job_id, inputs):
+    return DummyRequest({"job_id": job_id, "job_args": {}, "inputs": inputs})
+
+
+class BufferingMapper(Mapper):
+    # Buffers every input of a job until the job is finalized
+    def initialize_container(self):
+        self.flushed = []
+
+    async def initialize_job(self, job_args):
+        return {"buffer": []}
+
+    async def process_chunk(self, chunk, job_id, job_args, request_id):
+        job_args["buffer"].extend(chunk)
+        return [True] * len(chunk)
+
+    async def finalize_job(self, job_id, job_args):
+        await asyncio.sleep(0.01)
+        self.flushed.append((job_id, job_args["buffer"]))
+
+    async def process_element(self, *args, **kwargs):
+        pass
+
+
+def test_finalize_job_runs_once_after_all_chunks():
+    mapper = BufferingMapper(start_server=False)
+
+    async def main():
+        await mapper._handle_request(make_request("job", [1, 2]))
+        await mapper._handle_request(make_request("job", [3]))
+        assert mapper.flushed == []
+
+        async def finalize():
+            worker_ids = await mapper._finalize("job")
+            # Every concurrent request waits until the job has been finalized
+            assert mapper.flushed == [("job", [1, 2, 3])]
+            return worker_ids
+
+        return await asyncio.gather(*[finalize() for _ in range(3)])
+
+    assert asyncio.run(main()) == [[mapper.worker_id]] * 3
+    assert "job" not in mapper._args_by_job
+
+
+def test_chunks_are_rejected_after_finalize():
+    mapper = BufferingMapper(start_server=False)
+
+    async def main():
+        await mapper._handle_request(make_request("job", [1]))
+        await mapper._finalize("job")
+        return await mapper._handle_request(make_request("job", [2]))
+
+    response = asyncio.run(main())
+    assert "reason" in response
+    assert mapper.flushed == [("job", [1])]
+    assert "job" not in mapper._args_by_job
+
+
+def test_finalize_waits_for_chunks_in_progress():
+    class SlowMapper(BufferingMapper):
+        async def process_chunk(self, chunk, job_id, job_args, request_id):
+            await asyncio.sleep(0.05)
+            return await super().process_chunk(chunk, job_id, job_args, request_id)
+
+    mapper = SlowMapper(start_server=False)
+
+    async def main():
+        request = asyncio.create_task(
+            mapper._handle_request(make_request("job", [1, 2]))
+        )
+        await asyncio.sleep(0.01)  # the chunk is being processed
+        await mapper._finalize("job")
+        await request
+
+    asyncio.run(main())
+    assert mapper.flushed == [("job", [1, 2])]
+    assert not mapper._n_requests_by_job
+
+
+def test_finalize_unknown_job_is_a_no_op():
+    mapper = BufferingMapper(start_server=False)
+    assert asyncio.run(mapper._finalize("job")) == [mapper.worker_id]
+    assert mapper.flushed == []
+
+
+class PipelinedMapper(Mapper):
+    # Records how many chunks are in each stage at once
+    MAX_PREFETCHED_CHUNKS = 2
+    MAX_CONCURRENT_CHUNKS = 1
+
+    def initialize_container(self):
+        self.n_prefetched = 0  # started fetching, not yet done processing
+        self.n_processing = 0
+        self.max_n_prefetched = 0
+        self.max_n_processing = 0
+        self.fetched_while_processing = False
+
+    async def fetch_chunk(self, chunk, job_id, job_args, request_id):
+        self.n_prefetched += 1
+        self.max_n_prefetched = max(self.max_n_prefetched, self.n_prefetched)
+        self.fetched_while_processing |= self.n_processing > 0
+        await asyncio.sleep(0.01)
+        return [x * 10 for x in chunk]
+
+    async def process_chunk(self, chunk, job_id, job_args, request_id):
+        self.n_processing += 1
+        self.max_n_processing = max(self.max_n_processing, self.n_processing)
+        await asyncio.sleep(0.01)
+        self.n_processing -= 1
+        self.n_prefetched -= 1
+        return [x + 1 for x in chunk]
+
+    async def process_element(self, *args, **kwargs):
+        pass
+
+
+def run_requests(mapper, n_requests):
+    async def main():
+        return await asyncio.gather(
+            *[
+                mapper._handle_request(make_request("job", [i]))
+                for i in range(n_requests)
+            ]
+        )
+
+    return [response["outputs"] for response in asyncio.run(main())]
+
+
+def test_pipeline_stages_are_bounded():
+    mapper = PipelinedMapper(start_server=False)
+    assert run_requests(mapper, 6) == [[i * 10 + 1] for i in range(6)]
+    assert mapper.max_n_processing == 1
+    assert mapper.max_n_prefetched == 2
+    # The next chunk is fetched while the current one is processed
+    assert mapper.fetched_while_processing
+
+
+def test_pipeline_stages_are_unbounded_by_default():
+    class UnboundedMapper(PipelinedMapper):
+        MAX_PREFETCHED_CHUNKS = None
+        MAX_CONCURRENT_CHUNKS = None
+
+    mapper = UnboundedMapper(start_server=False)
+    assert run_requests(mapper, 6) == [[i * 10 + 1] for i in range(6)]
+    assert mapper.max_n_prefetched == 6
+    assert mapper.max_n_processing == 6
@@ -1,30 +1,32 @@
-from scipy.spatial.distance import pdist, squareform
+import os
+from pathlib import Path
+import sys
+
 import numpy as np
 
+sys.path.append(str(Path(__file__).resolve().parent.parent / "index_server"))
+from distance_matrix import CondensedDistanceMatrix  # noqa: E402
+
 
 def run(
     embeddings_filename: str,
     num_embeddings: int,
     embedding_dim: int,
     distance_matrix_filename: str,
+    dtype: str = "float32",
+    num_threads: int = os.cpu_count() or 1,
 ):
+    # Writes a condensed (upper-triangular, as from pdist) distance matrix out of core
+    # without loading the embeddings into memory
     embeddings = np.memmap(
         embeddings_filename,
         dtype="float32",
         mode="r",
         shape=(num_embeddings, embedding_dim),
     )
-    embeddings_in_memory = np.copy(embeddings)
-
-    distances_in_memory = squareform(
-        pdist(embeddings_in_memory).astype(embeddings_in_memory.dtype)
-    )
 
-    distances = np.memmap(
-        distance_matrix_filename,
-        dtype=distances_in_memory.dtype,
-        mode="w+",
-        shape=distances_in_memory.shape,
+    distances = CondensedDistanceMatrix.create(
+        Path(distance_matrix_filename), num_embeddings, dtype
     )
-    distances[:] = distances_in_memory[:]
+    distances.build(embeddings, n_threads=num_threads)
     distances.flush()